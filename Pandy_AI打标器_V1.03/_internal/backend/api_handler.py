@@ -4,8 +4,38 @@ API 调用处理模块 - 支持多个 API 渠道
 import requests
 import base64
 import io
+import json
+import re
 import time
+from urllib.parse import urlparse
 from PIL import Image
+from rate_limiter import get_rate_limiter, parse_retry_after
+from payload_cache import get_payload_cache
+import image_encoder
+import image_decoder
+import prefetch
+import vision_budget
+import http_pool
+import metrics
+import scheduler
+import usage_ledger
+
+
+class APIError(Exception):
+    """上游 API 返回错误（携带 HTTP 状态码与 Retry-After）"""
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class APITimeoutError(APIError):
+    """请求超时（未收到响应）"""
+
+
+class APIConnectionError(APIError):
+    """网络或代理连接失败、请求未能完成"""
 
 
 class APIHandler:
@@ -15,6 +45,8 @@ class APIHandler:
         "siliconflow": {
             "name": "SiliconFlow (硅基流动)",
             "base_url": "https://api.siliconflow.cn/v1",
+            "max_concurrency": 4,
+            "max_rps": 4.0,
             "models": [
                 "Qwen/Qwen3-VL-8B-Instruct",
                 "Qwen/Qwen3-VL-32B-Instruct",
@@ -26,6 +58,8 @@ class APIHandler:
         "modelscope": {
             "name": "ModelScope (魔塔)",
             "base_url": "https://api-inference.modelscope.cn/v1",
+            "max_concurrency": 2,
+            "max_rps": 1.0,
             "models": [
                 "Qwen/Qwen3-VL-8B-Instruct",
                 "Qwen/Qwen3-VL-30B-A3B-Instruct",
@@ -37,6 +71,8 @@ class APIHandler:
         "tuzi": {
             "name": "Tuzi API",
             "base_url": "https://api.tu-zi.com/v1",
+            "max_concurrency": 4,
+            "max_rps": 4.0,
             "models": [
                 "gpt-4o",
                 "chatgpt-4o-latest",
@@ -46,34 +82,387 @@ class APIHandler:
             ]
         }
     }
+
+    DEFAULT_MAX_CONCURRENCY = 2
+    DEFAULT_MAX_RPS = 2.0
+    # 等待限流许可的最长时间（秒），避免长时间 Retry-After 无限阻塞接口请求
+    LIMITER_WAIT_TIMEOUT = 60
+    # 打包请求：一次请求最多包含的图片数
+    MAX_PACK_SIZE = 8
+    # 打包请求的输出格式要求（附加在用户提示词之后）
+    PACK_FORMAT_PROMPT = (
+        "以上共有 {count} 张图片，已按 [[1]] 到 [[{count}]] 编号。"
+        "请对每张图片分别独立完成上述要求，严格按以下格式输出，不要输出其他内容：\n"
+        "[[1]]\n第1张图片的结果\n[[2]]\n第2张图片的结果\n……\n"
+        "每个编号标记单独占一行，编号与图片一一对应，不要遗漏或合并。"
+    )
+    PACK_MARKER_PATTERN = r'\[\[\s*(\d+)\s*\]\]'
+    # 批量翻译：一次请求的原文 token 预算与最多条数
+    TRANSLATE_BATCH_TOKENS = 2000
+    TRANSLATE_BATCH_ITEMS = 40
+    # 批量翻译的分段标记（标签文本中不会出现，比 [[编号]] 更不容易与原文混淆）
+    TRANSLATE_MARKER_PATTERN = r'<<<\s*(\d+)\s*>>>'
+    TRANSLATE_FORMAT_PROMPT = (
+        "\n\n批量模式：用户消息包含 {count} 段文本，每段前有 <<<编号>>> 标记（<<<1>>> 到 <<<{count}>>>）。"
+        "按上述规则逐段独立翻译，每段译文前输出相同的编号标记，标记单独占一行，不要输出其他内容：\n"
+        "<<<1>>>\n第1段的译文\n<<<2>>>\n第2段的译文\n……\n"
+        "编号与原文一一对应，不要遗漏、合并或拆分段落。"
+    )
+
+    @staticmethod
+    def resolve_provider(url):
+        """
+        根据请求 URL 识别渠道标识（用于按渠道限流）
+
+        Args:
+            url: base_url 或完整请求 URL
+
+        Returns:
+            str: PROVIDERS 中的渠道标识；无法识别时返回主机名
+        """
+        host = (urlparse(url).netloc or url or '').lower()
+        normalized = host.replace('-', '')
+        for key in APIHandler.PROVIDERS:
+            if key in normalized:
+                return key
+        return host
+
+    @staticmethod
+    def get_max_rps(provider, apikey_config=None):
+        """获取渠道的请求速率上限（每秒请求数），优先读取 apikey.json 中的 max_rps"""
+        provider_cfg = ((apikey_config or {}).get('providers') or {}).get(provider) or {}
+        value = provider_cfg.get('max_rps')
+        if value is None:
+            value = APIHandler.PROVIDERS.get(provider, {}).get('max_rps', APIHandler.DEFAULT_MAX_RPS)
+        try:
+            return max(0.2, float(value))
+        except (TypeError, ValueError):
+            return APIHandler.DEFAULT_MAX_RPS
+
+    @staticmethod
+    def _get_limiter(url):
+        """获取 URL 对应渠道的限流器（首次使用时按 PROVIDERS 默认值创建）"""
+        provider = APIHandler.resolve_provider(url)
+        defaults = APIHandler.PROVIDERS.get(provider, {})
+        return get_rate_limiter(
+            provider,
+            max_concurrency=defaults.get('max_concurrency', APIHandler.DEFAULT_MAX_CONCURRENCY),
+            max_rps=defaults.get('max_rps', APIHandler.DEFAULT_MAX_RPS)
+        )
+
+    @staticmethod
+    def _post(url, headers, payload, timeout):
+        """
+        发送 POST 请求（经过渠道自适应限流器，复用渠道共享的长连接会话）
+
+        限流器根据响应状态调整窗口：成功时逐步提升并发与速率，
+        429 / Retry-After 时乘性降低并暂停发放许可
+        """
+        provider = APIHandler.resolve_provider(url)
+        model = payload.get('model')
+        limiter = APIHandler._acquire_limiter(url, model)
+        session = http_pool.get_session(provider)
+        status_code = None
+        retry_after = None
+        outcome = 'error'
+        http_pool.reset_connect_time()
+        try:
+            resp = session.post(url, headers=headers, json=payload, timeout=http_pool.get_timeout(timeout))
+            status_code = resp.status_code
+            retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+            outcome = metrics.outcome_label(status_code)
+            APIHandler._observe_response(provider, model, resp)
+            return resp
+        except requests.exceptions.Timeout:
+            outcome = 'timeout'
+            raise
+        except requests.exceptions.RequestException:
+            outcome = 'connection_error'
+            raise
+        finally:
+            limiter.release(status_code, retry_after)
+            metrics.count_request(provider, model, outcome)
+
+    @staticmethod
+    def _observe_response(provider, model, resp):
+        """记录建连耗时与首字节耗时（resp.elapsed 为发出请求到解析完响应头，含建连）"""
+        connect_time = http_pool.last_connect_time()
+        if connect_time:
+            metrics.observe_request_stage('connect', provider, model, connect_time)
+        metrics.observe_request_stage('ttfb', provider, model, resp.elapsed.total_seconds())
+
+    @staticmethod
+    def _acquire_limiter(url, model=None):
+        """
+        获取渠道限流许可（有界等待，按当前上下文的请求优先级排队），
+        返回需要在请求结束后 release 的限流器
+        """
+        limiter = APIHandler._get_limiter(url)
+        provider = APIHandler.resolve_provider(url)
+        wait_start = time.monotonic()
+        acquired = limiter.acquire(timeout=APIHandler.LIMITER_WAIT_TIMEOUT, priority=scheduler.current_level())
+        wait_time = time.monotonic() - wait_start
+        scheduler.record_wait(provider, wait_time)
+        metrics.observe_request_stage('queue_wait', provider, model, wait_time)
+        if not acquired:
+            print(f"[限流] {provider} 等待限流许可超时 ({APIHandler.LIMITER_WAIT_TIMEOUT}s)")
+            raise APIError(
+                f"API Error (429): 渠道限流中，等待超过 {APIHandler.LIMITER_WAIT_TIMEOUT}s，请稍后重试",
+                status_code=429
+            )
+        return limiter
+
+    @staticmethod
+    def _post_stream(url, headers, payload, timeout, log_tag, kind='chat', images=0):
+        """
+        以流式方式发送 chat/completions 请求（stream: true），逐段产出文本增量
+
+        限流许可在整个流结束（或调用方提前关闭生成器）后才释放；
+        渠道在流中返回 usage 时记入用量账本（kind / images 同 usage_ledger.record）
+        """
+        provider = APIHandler.resolve_provider(url)
+        model = payload.get('model')
+        limiter = APIHandler._acquire_limiter(url, model)
+        session = http_pool.get_session(provider)
+        status_code = None
+        retry_after = None
+        resp = None
+        outcome = 'error'
+        http_pool.reset_connect_time()
+        try:
+            try:
+                resp = session.post(url, headers=headers, json=dict(payload, stream=True),
+                                    timeout=http_pool.get_timeout(timeout), stream=True)
+            except requests.exceptions.Timeout:
+                outcome = 'timeout'
+                raise
+            except requests.exceptions.RequestException:
+                outcome = 'connection_error'
+                raise
+            status_code = resp.status_code
+            retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+            outcome = metrics.outcome_label(status_code)
+            APIHandler._observe_response(provider, model, resp)
+            if status_code != 200:
+                APIHandler._parse_response(resp, log_tag)
+
+            # 部分渠道忽略 stream 参数，直接返回完整 JSON
+            if 'text/event-stream' not in resp.headers.get('Content-Type', ''):
+                resp_json = APIHandler._parse_response(resp, log_tag)
+                usage_ledger.record(provider, model, resp_json.get('usage'), kind, images)
+                yield APIHandler.extract_content(resp_json, "流式请求")
+                return
+
+            usage = None
+
+            # SSE 响应常不带 charset，按字节读取后统一以 UTF-8 解码
+            for raw_line in resp.iter_lines():
+                line = raw_line.decode('utf-8', errors='replace').strip()
+                if not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                if chunk.get('error'):
+                    print(f"[{log_tag}] 流式响应错误: {chunk['error']}")
+                    raise APIError(f"API Error: {chunk['error']}")
+                if chunk.get('usage'):
+                    # 部分渠道在每个分块中返回累计 usage，以最后一次为准
+                    usage = chunk['usage']
+                choices = chunk.get('choices') or []
+                if choices:
+                    content = (choices[0].get('delta') or {}).get('content')
+                    if content:
+                        yield content
+            usage_ledger.record(provider, model, usage, kind, images)
+        finally:
+            if resp is not None:
+                resp.close()
+            limiter.release(status_code, retry_after)
+            metrics.count_request(provider, model, outcome)
+
+    @staticmethod
+    def stream_chat(url, headers, payload, timeout, log_tag, kind='chat', images=0):
+        """
+        流式调用 chat/completions，逐段产出文本增量，网络异常转换为与非流式调用一致的错误信息
+
+        Args:
+            url: chat/completions 地址
+            headers: 请求头
+            payload: 请求体（无需包含 stream）
+            timeout: 两次数据之间的最长等待秒数
+            log_tag: 日志标签（如 "API错误"）
+        """
+        start_time = time.time()
+        first_token_time = None
+        length = 0
+        try:
+            for delta in APIHandler._post_stream(url, headers, payload, timeout, log_tag, kind, images):
+                if first_token_time is None:
+                    first_token_time = time.time() - start_time
+                    print(f"[流式响应] 首个 token 耗时: {first_token_time:.2f}s")
+                length += len(delta)
+                yield delta
+            print(f"[流式响应] 完成 | 内容长度: {length} 字符 | 总耗时: {time.time() - start_time:.2f}s")
+        except requests.exceptions.Timeout:
+            elapsed = time.time() - start_time
+            print(f"[超时错误] ⏱️ 流式请求超时 | 已等待: {elapsed:.2f}s | 超时限制: {timeout}s")
+            raise APITimeoutError(f"API请求超时 (已等待 {elapsed:.1f}s)，请检查网络或稍后重试")
+        except requests.exceptions.ProxyError as e:
+            elapsed = time.time() - start_time
+            print(f"[代理错误] 🔌 代理连接失败 | 已等待: {elapsed:.2f}s | 错误: {str(e)[:100]}")
+            raise APIConnectionError(f"代理连接失败 (耗时 {elapsed:.1f}s)，请检查代理设置或关闭代理后重试")
+        except requests.exceptions.ConnectionError as e:
+            elapsed = time.time() - start_time
+            print(f"[连接错误] 🔌 网络连接失败 | 已等待: {elapsed:.2f}s | 错误: {str(e)[:100]}")
+            raise APIConnectionError(f"网络连接失败 (耗时 {elapsed:.1f}s)，请检查网络连接")
+        except requests.exceptions.RequestException as e:
+            elapsed = time.time() - start_time
+            print(f"[网络错误] 🔌 请求异常 | 已等待: {elapsed:.2f}s | 错误: {str(e)[:100]}")
+            raise APIConnectionError(f"网络请求错误 (耗时 {elapsed:.1f}s): {str(e)}")
+
+    @staticmethod
+    def warmup(base_url, api_key=None):
+        """后台预热指定渠道的连接（服务启动或切换渠道时调用）"""
+        http_pool.warmup(APIHandler.resolve_provider(base_url), base_url, api_key)
+
+    @staticmethod
+    def _parse_response(resp, log_tag):
+        """
+        解析响应 JSON，非 200 时抛出 APIError（保持原有错误信息格式）
+
+        Returns:
+            dict: 响应 JSON
+        """
+        try:
+            resp_json = resp.json()
+        except ValueError:
+            resp_json = {"message": (resp.text or '')[:500]}
+        return APIHandler.check_response(resp.status_code, resp_json, resp.headers, log_tag)
+
+    @staticmethod
+    def check_response(status_code, resp_json, headers, log_tag):
+        """检查响应状态码，非 200 时抛出 APIError，否则返回响应 JSON"""
+        if status_code == 200:
+            return resp_json
+
+        error_msg = resp_json.get('error', {}).get('message', 
+                    resp_json.get('errors', {}).get('message',
+                    resp_json.get('message', str(resp_json))))
+        print(f"[{log_tag}] 状态码: {status_code} | 错误: {error_msg}")
+        raise APIError(
+            f"API Error ({status_code}): {error_msg}",
+            status_code=status_code,
+            retry_after=parse_retry_after((headers or {}).get('Retry-After'))
+        )
+
+    @staticmethod
+    def get_max_concurrency(provider, apikey_config=None):
+        """
+        获取渠道的批量并发上限
+
+        优先读取 apikey.json 中 providers.<provider>.max_concurrency，
+        否则使用 PROVIDERS 中的默认值
+
+        Args:
+            provider: 渠道标识
+            apikey_config: API Key 配置（可选）
+
+        Returns:
+            int: 并发上限（至少为1）
+        """
+        provider_cfg = ((apikey_config or {}).get('providers') or {}).get(provider) or {}
+        value = provider_cfg.get('max_concurrency')
+        if value is None:
+            value = APIHandler.PROVIDERS.get(provider, {}).get('max_concurrency', APIHandler.DEFAULT_MAX_CONCURRENCY)
+        try:
+            return max(1, int(value))
+        except (TypeError, ValueError):
+            return APIHandler.DEFAULT_MAX_CONCURRENCY
     
     @staticmethod
-    def call_vision_api(image_path, system_prompt, user_prompt, api_key, base_url, model, crop_params=None):
+    def prepare_image(image_path, crop_params=None, model=None):
         """
-        调用多模态 Vision API 进行图片描述生成
-        
+        读取并预处理图片，生成 Vision API 所需的 Base64 data URL
+        （按模型的视觉 token 规则缩放，并按字节预算选择编码格式与质量，减少传输时间；
+        预处理结果写入磁盘缓存，重试和重复反推直接复用）
+
         Args:
             image_path: 图片文件路径
-            system_prompt: 系统提示词
-            user_prompt: 用户提示词
-            api_key: API 密钥
-            base_url: API 基础 URL
-            model: 模型名称
-            crop_params: 裁剪参数 (可选) {'crop_x', 'crop_y', 'crop_width', 'crop_height', 'target_width', 'target_height'}
-        
+            crop_params: 裁剪参数 (可选)
+            model: 目标模型（决定缩放尺寸；为空时长边限制在 1024）
+
         Returns:
-            str: API 返回的描述文本
+            dict: {'data_url', 'width', 'height', 'size_kb', 'format', 'elapsed'}
         """
-        total_start_time = time.time()
-        
-        # 1. 图片处理（如果太大则缩放到1024，减少传输时间）
+        # 批量任务已在后台预取该图片时直接取用（尚未完成时等待）
+        prepared = prefetch.take(image_path, crop_params, model)
+        if prepared is not None:
+            print(f"[图片处理] 使用预取结果: {image_path} | 尺寸: {prepared['width']}x{prepared['height']} | "
+                  f"大小: {prepared['size_kb']:.1f}KB")
+            return prepared
+        return APIHandler.prepare_image_now(image_path, crop_params, model)
+
+    @staticmethod
+    def prepare_image_now(image_path, crop_params=None, model=None):
+        """预处理图片（不查询预取结果，参数和返回值同 prepare_image；预取线程使用）"""
         print(f"[图片处理] 开始处理图片: {image_path}")
         img_start_time = time.time()
+
+        payload_cache = get_payload_cache()
+        # 编码配置变化后，旧的编码结果不再命中
+        variant = {"encoding": image_encoder.get_settings(), "budget": vision_budget.cache_variant(model)}
+        cache_key = payload_cache.make_key(image_path, crop_params, variant=variant)
+        img_bytes = payload_cache.get(cache_key)
+        if img_bytes is not None:
+            # 只读取文件头获取尺寸，不解码像素
+            with Image.open(io.BytesIO(img_bytes)) as cached_img:
+                width, height = cached_img.size
+                img_format = cached_img.format
+            encode_note = "来自缓存"
+        else:
+            encoded = APIHandler._encode_image(image_path, crop_params, model)
+            img_bytes, width, height = encoded['data'], encoded['width'], encoded['height']
+            img_format = encoded['format']
+            payload_cache.put(cache_key, img_bytes)
+            encode_note = f"质量: {encoded['quality']} | 编码耗时: {encoded['encode_elapsed']:.2f}s"
+
+        img_size_kb = len(img_bytes) / 1024
+        img_str = base64.b64encode(img_bytes).decode()
         
-        img = Image.open(image_path)
-        original_size = f"{img.width}x{img.height}"
+        img_elapsed = time.time() - img_start_time
+        print(f"[图片处理] 完成 | 尺寸: {width}x{height} | 格式: {img_format} | 大小: {img_size_kb:.1f}KB | "
+              f"{encode_note} | 耗时: {img_elapsed:.2f}s")
+        return {
+            "data_url": f"data:{image_encoder.mime_type(img_bytes)};base64,{img_str}",
+            "width": width,
+            "height": height,
+            "size_kb": img_size_kb,
+            "format": img_format,
+            "elapsed": img_elapsed,
+        }
+
+    @staticmethod
+    def _encode_image(image_path, crop_params=None, model=None):
+        """
+        解码原图并执行裁剪/缩放/去透明，按字节预算编码
+        （先按最终尺寸降分辨率解码，大图不再完整解码后再缩小）
+
+        Returns:
+            dict: image_encoder.encode_image 的返回值
+        """
+        decode_start = time.time()
+        # 只读取文件头获取原图尺寸
+        with Image.open(image_path) as header:
+            width, height = header.size
+        box = None
+        input_size = (width, height)
         
-        # 如果有裁剪参数，先进行裁剪
+        # 如果有裁剪参数，先计算裁剪区域
         if crop_params:
             crop_x = crop_params.get('crop_x', 0)
             crop_y = crop_params.get('crop_y', 0)
@@ -83,7 +472,6 @@ class APIHandler:
             target_height = crop_params.get('target_height', 1024)
             
             # 计算实际裁剪坐标
-            width, height = img.size
             left = int(crop_x * width)
             top = int(crop_y * height)
             right = int((crop_x + crop_width) * width)
@@ -95,13 +483,22 @@ class APIHandler:
             right = max(left + 1, min(right, width))
             bottom = max(top + 1, min(bottom, height))
             
-            # 裁剪并缩放
-            img = img.crop((left, top, right, bottom))
-            img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
+            box = (left, top, right, bottom)
+            input_size = (target_width, target_height)
             print(f"[图片处理] 已裁剪: ({left},{top})-({right},{bottom}) -> {target_width}x{target_height}")
-        elif img.width > 1024 or img.height > 1024:
-            img.thumbnail((1024, 1024))
-            print(f"[图片处理] 图片已缩放: {original_size} -> {img.width}x{img.height}")
+
+        # 按模型的视觉 token 规则缩小到满足细节档位的最小尺寸
+        # （裁剪区域直接缩放到最终尺寸，不再经过裁剪目标尺寸的中间结果）
+        budget_size = vision_budget.target_size(model, *input_size)
+        img = image_decoder.open_for_size(image_path, budget_size, box)
+        region_size = (box[2] - box[0], box[3] - box[1]) if box else (width, height)
+        if img.width < region_size[0]:
+            print(f"[图片处理] 降分辨率解码: {region_size[0]}x{region_size[1]} -> {img.width}x{img.height}")
+        if img.size != budget_size:
+            img = img.resize(budget_size, Image.Resampling.LANCZOS)
+        if budget_size != input_size:
+            print(f"[图片处理] 图片已缩放: {input_size[0]}x{input_size[1]} -> {img.width}x{img.height} | "
+                  f"预计视觉token: {vision_budget.estimate_tokens(model, *input_size)}")
         
         # 如果是RGBA模式，转换为RGB（去除透明通道）
         if img.mode == 'RGBA':
@@ -111,19 +508,20 @@ class APIHandler:
             img = background
         elif img.mode != 'RGB':
             img = img.convert('RGB')
-        
-        # 转换为 Base64
-        buffered = io.BytesIO()
-        img.save(buffered, format="JPEG", quality=95)
-        img_bytes = buffered.getvalue()
-        img_size_kb = len(img_bytes) / 1024
-        img_str = base64.b64encode(img_bytes).decode()
-        img_base64 = f"data:image/jpeg;base64,{img_str}"
-        
-        img_elapsed = time.time() - img_start_time
-        print(f"[图片处理] 完成 | 尺寸: {img.width}x{img.height} | 大小: {img_size_kb:.1f}KB | 耗时: {img_elapsed:.2f}s")
+        metrics.observe_image_stage('decode', model, time.time() - decode_start)
 
-        # 2. 构建请求
+        encoded = image_encoder.encode_image(img)
+        metrics.observe_image_stage('encode', model, encoded['encode_elapsed'])
+        return encoded
+
+    @staticmethod
+    def build_vision_request(base_url, api_key, model, system_prompt, user_prompt, image_data_url):
+        """
+        构建 Vision chat/completions 请求
+
+        Returns:
+            tuple: (url, headers, payload)
+        """
         url = f"{base_url.rstrip('/')}/chat/completions"
         headers = {
             "Content-Type": "application/json",
@@ -134,76 +532,200 @@ class APIHandler:
             "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": [
-                    {"type": "image_url", "image_url": {"url": img_base64}},
+                    {"type": "image_url", "image_url": {"url": image_data_url}},
                     {"type": "text", "text": user_prompt}
                 ]}
             ],
             "max_tokens": 1024
         }
+        return url, headers, payload
+
+    @staticmethod
+    def build_packed_vision_request(base_url, api_key, model, system_prompt, user_prompt, image_data_urls):
+        """
+        构建多图打包的 Vision 请求：每张图片前加编号标记，要求模型按编号分段输出
+
+        Returns:
+            tuple: (url, headers, payload)
+        """
+        count = len(image_data_urls)
+        url, headers, payload = APIHandler.build_vision_request(
+            base_url, api_key, model, system_prompt, user_prompt, image_data_urls[0]
+        )
+        content = []
+        for idx, data_url in enumerate(image_data_urls, start=1):
+            content.append({"type": "text", "text": f"[[{idx}]]"})
+            content.append({"type": "image_url", "image_url": {"url": data_url}})
+        content.append({"type": "text", "text": f"{user_prompt}\n\n{APIHandler.PACK_FORMAT_PROMPT.format(count=count)}"})
+        payload["messages"][1]["content"] = content
+        payload["max_tokens"] = min(1024 * count, 8192)
+        return url, headers, payload
+
+    @staticmethod
+    def parse_packed_response(text, count, pattern=None):
+        """
+        按 [[编号]] 标记拆分打包请求的返回内容
+
+        Args:
+            text: 模型返回的完整文本
+            count: 图片数量
+            pattern: 编号标记的正则（默认 PACK_MARKER_PATTERN，批量翻译使用 TRANSLATE_MARKER_PATTERN）
+
+        Returns:
+            list: 长度为 count，对应位置解析失败（缺失、重复或为空）时为 None
+        """
+        results = [None] * count
+        duplicated = set()
+        parts = re.split(pattern or APIHandler.PACK_MARKER_PATTERN, text or '')
+        for i in range(1, len(parts) - 1, 2):
+            idx = int(parts[i])
+            if not 1 <= idx <= count:
+                continue
+            if results[idx - 1] is not None:
+                duplicated.add(idx)
+            results[idx - 1] = parts[i + 1].strip() or None
+        for idx in duplicated:
+            results[idx - 1] = None
+        return results
+
+    @staticmethod
+    def extract_content(resp_json, log_tag, total_elapsed=None):
+        """从 chat/completions 响应中取出文本内容"""
+        if "choices" in resp_json and len(resp_json["choices"]) > 0:
+            result = resp_json["choices"][0]["message"]["content"]
+            elapsed_str = f" | 总耗时: {total_elapsed:.2f}s" if total_elapsed is not None else ""
+            print(f"[{log_tag}成功] 返回内容长度: {len(result)} 字符{elapsed_str}")
+            return result
+        print(f"[{log_tag}错误] 响应中无 choices: {resp_json}")
+        raise Exception(f"API Error: No choices in response - {resp_json}")
+
+    @staticmethod
+    def call_vision_api(image_path, system_prompt, user_prompt, api_key, base_url, model, crop_params=None):
+        """
+        调用多模态 Vision API 进行图片描述生成
+        
+        Args:
+            image_path: 图片文件路径
+            system_prompt: 系统提示词
+            user_prompt: 用户提示词
+            api_key: API 密钥
+            base_url: API 基础 URL
+            model: 模型名称
+            crop_params: 裁剪参数 (可选) {'crop_x', 'crop_y', 'crop_width', 'crop_height', 'target_width', 'target_height'}
+        
+        Returns:
+            str: API 返回的描述文本
+        """
+        total_start_time = time.time()
+        
+        # 1. 图片处理
+        prepared = APIHandler.prepare_image(image_path, crop_params, model)
+
+        # 2. 构建请求
+        url, headers, payload = APIHandler.build_vision_request(
+            base_url, api_key, model, system_prompt, user_prompt, prepared['data_url']
+        )
         
         # 3. 发送请求
         print(f"[API请求] 开始请求 | 模型: {model} | URL: {url}")
         api_start_time = time.time()
         
         try:
-            resp = requests.post(url, headers=headers, json=payload, timeout=120)
+            resp = APIHandler._post(url, headers, payload, timeout=120)
             api_elapsed = time.time() - api_start_time
             total_elapsed = time.time() - total_start_time
             
             print(f"[API响应] 状态码: {resp.status_code} | API耗时: {api_elapsed:.2f}s | 总耗时: {total_elapsed:.2f}s")
+            metrics.observe_request_stage('total', APIHandler.resolve_provider(url), model, total_elapsed)
             
-            resp_json = resp.json()
-            
-            if resp.status_code != 200:
-                error_msg = resp_json.get('error', {}).get('message', 
-                            resp_json.get('errors', {}).get('message',
-                            resp_json.get('message', str(resp_json))))
-                print(f"[API错误] 状态码: {resp.status_code} | 错误: {error_msg}")
-                raise Exception(f"API Error ({resp.status_code}): {error_msg}")
-            
-            if "choices" in resp_json and len(resp_json["choices"]) > 0:
-                result = resp_json["choices"][0]["message"]["content"]
-                print(f"[API成功] 返回内容长度: {len(result)} 字符 | 总耗时: {total_elapsed:.2f}s")
-                return result
-            else:
-                print(f"[API错误] 响应中无 choices: {resp_json}")
-                raise Exception(f"API Error: No choices in response - {resp_json}")
+            resp_json = APIHandler._parse_response(resp, "API错误")
+            usage_ledger.record(APIHandler.resolve_provider(url), model, resp_json.get('usage'), 'vision', images=1)
+            return APIHandler.extract_content(resp_json, "API", total_elapsed)
                 
         except requests.exceptions.Timeout:
             api_elapsed = time.time() - api_start_time
             total_elapsed = time.time() - total_start_time
             print(f"[超时错误] ⏱️ API请求超时 | 已等待: {api_elapsed:.2f}s | 超时限制: 120s")
-            raise Exception(f"API请求超时 (已等待 {api_elapsed:.1f}s)，请检查网络或稍后重试")
+            raise APITimeoutError(f"API请求超时 (已等待 {api_elapsed:.1f}s)，请检查网络或稍后重试")
             
         except requests.exceptions.ProxyError as e:
             api_elapsed = time.time() - api_start_time
             print(f"[代理错误] 🔌 代理连接失败 | 已等待: {api_elapsed:.2f}s | 错误: {str(e)[:100]}")
-            raise Exception(f"代理连接失败 (耗时 {api_elapsed:.1f}s)，请检查代理设置或关闭代理后重试")
+            raise APIConnectionError(f"代理连接失败 (耗时 {api_elapsed:.1f}s)，请检查代理设置或关闭代理后重试")
             
         except requests.exceptions.ConnectionError as e:
             api_elapsed = time.time() - api_start_time
             print(f"[连接错误] 🔌 网络连接失败 | 已等待: {api_elapsed:.2f}s | 错误: {str(e)[:100]}")
-            raise Exception(f"网络连接失败 (耗时 {api_elapsed:.1f}s)，请检查网络连接")
+            raise APIConnectionError(f"网络连接失败 (耗时 {api_elapsed:.1f}s)，请检查网络连接")
             
         except requests.exceptions.RequestException as e:
             api_elapsed = time.time() - api_start_time
             print(f"[网络错误] 🔌 请求异常 | 已等待: {api_elapsed:.2f}s | 错误: {str(e)[:100]}")
-            raise Exception(f"网络请求错误 (耗时 {api_elapsed:.1f}s): {str(e)}")
+            raise APIConnectionError(f"网络请求错误 (耗时 {api_elapsed:.1f}s): {str(e)}")
     
     @staticmethod
-    def translate_text(text, api_key, base_url, model, target_lang=None):
+    def call_packed_vision_api(items, system_prompt, user_prompt, api_key, base_url, model):
         """
-        使用API翻译文本（中英互译）
-        
+        将多张图片打包到一次 Vision 请求中
+
         Args:
-            text: 要翻译的文本
-            api_key: API 密钥
-            base_url: API 基础 URL
-            model: 模型名称
-            target_lang: 目标语言 ('en' 或 'zh')，如果不指定则自动检测
-        
+            items: [(image_path, crop_params), ...]
+            其余参数同 call_vision_api
+
         Returns:
-            str: 翻译后的文本
+            list: 每张图片的描述文本，解析失败的位置为 None（由调用方单独重试）
+        """
+        total_start_time = time.time()
+        data_urls = [APIHandler.prepare_image(image_path, crop_params, model)['data_url'] for image_path, crop_params in items]
+        url, headers, payload = APIHandler.build_packed_vision_request(
+            base_url, api_key, model, system_prompt, user_prompt, data_urls
+        )
+        timeout = 120 + 30 * (len(items) - 1)
+
+        print(f"[打包请求] 开始请求 | 图片数: {len(items)} | 模型: {model} | URL: {url}")
+        api_start_time = time.time()
+        try:
+            resp = APIHandler._post(url, headers, payload, timeout=timeout)
+        except requests.exceptions.Timeout:
+            api_elapsed = time.time() - api_start_time
+            print(f"[超时错误] ⏱️ 打包请求超时 | 已等待: {api_elapsed:.2f}s | 超时限制: {timeout}s")
+            raise APITimeoutError(f"API请求超时 (已等待 {api_elapsed:.1f}s)，请检查网络或稍后重试")
+        except requests.exceptions.RequestException as e:
+            api_elapsed = time.time() - api_start_time
+            print(f"[网络错误] 🔌 打包请求异常 | 已等待: {api_elapsed:.2f}s | 错误: {str(e)[:100]}")
+            raise APIConnectionError(f"网络请求错误 (耗时 {api_elapsed:.1f}s): {str(e)}")
+
+        api_elapsed = time.time() - api_start_time
+        total_elapsed = time.time() - total_start_time
+        print(f"[打包响应] 状态码: {resp.status_code} | API耗时: {api_elapsed:.2f}s | 总耗时: {total_elapsed:.2f}s")
+        metrics.observe_request_stage('total', APIHandler.resolve_provider(url), model, total_elapsed)
+        resp_json = APIHandler._parse_response(resp, "打包请求错误")
+        usage_ledger.record(APIHandler.resolve_provider(url), model, resp_json.get('usage'), 'vision', images=len(items))
+        content = APIHandler.extract_content(resp_json, "打包请求", total_elapsed)
+        results = APIHandler.parse_packed_response(content, len(items))
+        parsed = sum(1 for r in results if r is not None)
+        print(f"[打包解析] 成功拆分 {parsed}/{len(items)} 张图片的结果")
+        return results
+
+    @staticmethod
+    def stream_vision_api(image_path, system_prompt, user_prompt, api_key, base_url, model, crop_params=None):
+        """
+        流式调用 Vision API（参数同 call_vision_api），逐段产出描述文本
+        """
+        prepared = APIHandler.prepare_image(image_path, crop_params, model)
+        url, headers, payload = APIHandler.build_vision_request(
+            base_url, api_key, model, system_prompt, user_prompt, prepared['data_url']
+        )
+        print(f"[API请求] 开始流式请求 | 模型: {model} | URL: {url}")
+        yield from APIHandler.stream_chat(url, headers, payload, 120, "API错误", kind='vision', images=1)
+
+    @staticmethod
+    def build_translate_request(text, api_key, base_url, model, target_lang=None):
+        """
+        构建翻译 chat/completions 请求
+
+        Returns:
+            tuple: (url, headers, payload)
         """
         url = f"{base_url.rstrip('/')}/chat/completions"
         headers = {
@@ -211,6 +733,23 @@ class APIHandler:
             "Authorization": f"Bearer {api_key}"
         }
         
+        payload = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": APIHandler.translate_system_prompt(target_lang)},
+                {"role": "user", "content": text}
+            ],
+            "max_tokens": 1024
+        }
+        
+        # Qwen3 模型需要禁用 thinking 模式
+        if 'Qwen3' in model or 'qwen3' in model.lower():
+            payload["enable_thinking"] = False
+        return url, headers, payload
+
+    @staticmethod
+    def translate_system_prompt(target_lang=None):
+        """翻译的系统提示词（按目标语言）"""
         # 根据目标语言设置提示词 - 使用 / 作为句子分隔符
         if target_lang == 'en':
             system_prompt = """You are a professional translator. Translate the given Chinese text to English.
@@ -233,36 +772,90 @@ Only output the translated English text, nothing else."""
 If the text is in Chinese, translate it to English. If the text is in English, translate it to Chinese.
 IMPORTANT: Use "/" as sentence separator in your translation to mark sentence boundaries.
 Only output the translated text, nothing else."""
+        return system_prompt
+
+    @staticmethod
+    def estimate_text_tokens(text):
+        """粗略估算文本的 token 数（中日韩字符按 1 个，其余按 4 个字符 1 个）"""
+        text = text or ''
+        cjk = len(re.findall(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    @staticmethod
+    def plan_translate_batches(texts, max_tokens=None, max_items=None):
+        """
+        按 token 预算将待翻译文本分组（保持原顺序，超出预算的单条文本单独成组）
+
+        Returns:
+            list: [[文本序号, ...], ...]
+        """
+        max_tokens = max_tokens or APIHandler.TRANSLATE_BATCH_TOKENS
+        max_items = max_items or APIHandler.TRANSLATE_BATCH_ITEMS
+        batches, current, current_tokens = [], [], 0
+        for idx, text in enumerate(texts):
+            tokens = APIHandler.estimate_text_tokens(text)
+            if current and (current_tokens + tokens > max_tokens or len(current) >= max_items):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(idx)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    @staticmethod
+    def build_bulk_translate_request(texts, api_key, base_url, model, target_lang=None):
+        """
+        构建批量翻译请求：每段原文前加 <<<编号>>> 标记，要求模型按编号分段输出
+
+        Returns:
+            tuple: (url, headers, payload)
+        """
+        count = len(texts)
+        content = "\n".join(f"<<<{idx}>>>\n{text.strip()}" for idx, text in enumerate(texts, start=1))
+        url, headers, payload = APIHandler.build_translate_request(content, api_key, base_url, model, target_lang)
+        payload["messages"][0]["content"] += APIHandler.TRANSLATE_FORMAT_PROMPT.format(count=count)
+        # 译文长度按原文的 2 倍预留，另加每段标记的开销
+        input_tokens = sum(APIHandler.estimate_text_tokens(text) for text in texts)
+        payload["max_tokens"] = min(8192, max(1024, input_tokens * 2 + 8 * count))
+        return url, headers, payload
+
+    @staticmethod
+    def stream_translate(text, api_key, base_url, model, target_lang=None):
+        """
+        流式翻译（参数同 translate_text），逐段产出译文
+        """
+        url, headers, payload = APIHandler.build_translate_request(text, api_key, base_url, model, target_lang)
+        print(f"[翻译请求] 开始流式翻译 | 文本长度: {len(text)} | 模型: {model} | 目标语言: {target_lang or '自动'}")
+        yield from APIHandler.stream_chat(url, headers, payload, 60, "翻译错误", kind='translate')
+
+    @staticmethod
+    def translate_text(text, api_key, base_url, model, target_lang=None):
+        """
+        使用API翻译文本（中英互译）
         
-        payload = {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": text}
-            ],
-            "max_tokens": 1024
-        }
+        Args:
+            text: 要翻译的文本
+            api_key: API 密钥
+            base_url: API 基础 URL
+            model: 模型名称
+            target_lang: 目标语言 ('en' 或 'zh')，如果不指定则自动检测
         
-        # Qwen3 模型需要禁用 thinking 模式
-        if 'Qwen3' in model or 'qwen3' in model.lower():
-            payload["enable_thinking"] = False
+        Returns:
+            str: 翻译后的文本
+        """
+        url, headers, payload = APIHandler.build_translate_request(text, api_key, base_url, model, target_lang)
         
         print(f"[翻译请求] 开始翻译 | 文本长度: {len(text)} | 模型: {model} | 目标语言: {target_lang or '自动'}")
         start_time = time.time()
         
         try:
-            resp = requests.post(url, headers=headers, json=payload, timeout=60)
+            resp = APIHandler._post(url, headers, payload, timeout=60)
             elapsed = time.time() - start_time
             
             print(f"[翻译响应] 状态码: {resp.status_code} | 耗时: {elapsed:.2f}s")
-            resp_json = resp.json()
-            
-            if resp.status_code != 200:
-                error_msg = resp_json.get('error', {}).get('message', 
-                            resp_json.get('errors', {}).get('message',
-                            resp_json.get('message', str(resp_json))))
-                print(f"[翻译错误] 状态码: {resp.status_code} | 错误: {error_msg}")
-                raise Exception(f"API Error ({resp.status_code}): {error_msg}")
+            resp_json = APIHandler._parse_response(resp, "翻译错误")
+            usage_ledger.record(APIHandler.resolve_provider(url), model, resp_json.get('usage'), 'translate')
             
             if "choices" in resp_json and len(resp_json["choices"]) > 0:
                 result = resp_json["choices"][0]["message"]["content"]
@@ -275,22 +868,60 @@ Only output the translated text, nothing else."""
         except requests.exceptions.Timeout:
             elapsed = time.time() - start_time
             print(f"[超时错误] ⏱️ 翻译请求超时 | 已等待: {elapsed:.2f}s | 超时限制: 60s")
-            raise Exception(f"翻译请求超时 (已等待 {elapsed:.1f}s)")
+            raise APITimeoutError(f"翻译请求超时 (已等待 {elapsed:.1f}s)")
             
         except requests.exceptions.ProxyError as e:
             elapsed = time.time() - start_time
             print(f"[代理错误] 🔌 代理连接失败 | 已等待: {elapsed:.2f}s")
-            raise Exception(f"代理连接失败，请检查代理设置")
+            raise APIConnectionError(f"代理连接失败，请检查代理设置")
             
         except requests.exceptions.ConnectionError as e:
             elapsed = time.time() - start_time
             print(f"[连接错误] 🔌 网络连接失败 | 已等待: {elapsed:.2f}s")
-            raise Exception(f"网络连接失败，请检查网络")
+            raise APIConnectionError(f"网络连接失败，请检查网络")
             
         except requests.exceptions.RequestException as e:
             elapsed = time.time() - start_time
             print(f"[网络错误] 🔌 请求异常 | 已等待: {elapsed:.2f}s | 错误: {str(e)[:80]}")
-            raise Exception(f"网络请求错误: {str(e)}")
+            raise APIConnectionError(f"网络请求错误: {str(e)}")
+
+    @staticmethod
+    def translate_batch(texts, api_key, base_url, model, target_lang=None):
+        """
+        将多段文本打包到一次翻译请求中
+
+        Args:
+            texts: 原文列表（由 plan_translate_batches 按 token 预算分组）
+            其余参数同 translate_text
+
+        Returns:
+            list: 每段原文的译文，解析失败的位置为 None（由调用方单独重试）
+        """
+        url, headers, payload = APIHandler.build_bulk_translate_request(texts, api_key, base_url, model, target_lang)
+        timeout = 60 + 30 * ((len(texts) - 1) // 10)
+
+        print(f"[批量翻译] 开始请求 | 条数: {len(texts)} | 模型: {model} | 目标语言: {target_lang or '自动'}")
+        start_time = time.time()
+        try:
+            resp = APIHandler._post(url, headers, payload, timeout=timeout)
+        except requests.exceptions.Timeout:
+            elapsed = time.time() - start_time
+            print(f"[超时错误] ⏱️ 批量翻译请求超时 | 已等待: {elapsed:.2f}s | 超时限制: {timeout}s")
+            raise APITimeoutError(f"翻译请求超时 (已等待 {elapsed:.1f}s)")
+        except requests.exceptions.RequestException as e:
+            elapsed = time.time() - start_time
+            print(f"[网络错误] 🔌 批量翻译请求异常 | 已等待: {elapsed:.2f}s | 错误: {str(e)[:80]}")
+            raise APIConnectionError(f"网络请求错误: {str(e)}")
+
+        elapsed = time.time() - start_time
+        print(f"[批量翻译] 状态码: {resp.status_code} | 耗时: {elapsed:.2f}s")
+        resp_json = APIHandler._parse_response(resp, "翻译错误")
+        usage_ledger.record(APIHandler.resolve_provider(url), model, resp_json.get('usage'), 'translate')
+        content = APIHandler.extract_content(resp_json, "批量翻译", elapsed)
+        results = APIHandler.parse_packed_response(content, len(texts), APIHandler.TRANSLATE_MARKER_PATTERN)
+        parsed = sum(1 for r in results if r is not None)
+        print(f"[批量翻译] 成功拆分 {parsed}/{len(texts)} 段译文")
+        return results
 
     @staticmethod
     def analyze_training(training_data, api_key, base_url, model=None, system_prompt=None):
@@ -380,18 +1011,12 @@ Only output the translated text, nothing else."""
         start_time = time.time()
         
         try:
-            resp = requests.post(url, headers=headers, json=payload, timeout=120)
+            resp = APIHandler._post(url, headers, payload, timeout=120)
             elapsed = time.time() - start_time
             
             print(f"[AI分析响应] 状态码: {resp.status_code} | 耗时: {elapsed:.2f}s")
-            resp_json = resp.json()
-            
-            if resp.status_code != 200:
-                error_msg = resp_json.get('error', {}).get('message', 
-                            resp_json.get('errors', {}).get('message',
-                            resp_json.get('message', str(resp_json))))
-                print(f"[AI分析错误] 状态码: {resp.status_code} | 错误: {error_msg}")
-                raise Exception(f"API Error ({resp.status_code}): {error_msg}")
+            resp_json = APIHandler._parse_response(resp, "AI分析错误")
+            usage_ledger.record(APIHandler.resolve_provider(url), payload['model'], resp_json.get('usage'), 'analyze')
             
             if "choices" in resp_json and len(resp_json["choices"]) > 0:
                 result = resp_json["choices"][0]["message"]["content"]
@@ -404,19 +1029,19 @@ Only output the translated text, nothing else."""
         except requests.exceptions.Timeout:
             elapsed = time.time() - start_time
             print(f"[超时错误] ⏱️ AI分析请求超时 | 已等待: {elapsed:.2f}s | 超时限制: 120s")
-            raise Exception(f"AI分析请求超时 (已等待 {elapsed:.1f}s)，请稍后重试")
+            raise APITimeoutError(f"AI分析请求超时 (已等待 {elapsed:.1f}s)，请稍后重试")
             
         except requests.exceptions.ProxyError as e:
             elapsed = time.time() - start_time
             print(f"[代理错误] 🔌 代理连接失败 | 已等待: {elapsed:.2f}s")
-            raise Exception(f"代理连接失败，请检查代理设置")
+            raise APIConnectionError(f"代理连接失败，请检查代理设置")
             
         except requests.exceptions.ConnectionError as e:
             elapsed = time.time() - start_time
             print(f"[连接错误] 🔌 网络连接失败 | 已等待: {elapsed:.2f}s")
-            raise Exception(f"网络连接失败，请检查网络")
+            raise APIConnectionError(f"网络连接失败，请检查网络")
             
         except requests.exceptions.RequestException as e:
             elapsed = time.time() - start_time
             print(f"[网络错误] 🔌 请求异常 | 已等待: {elapsed:.2f}s | 错误: {str(e)[:80]}")
-            raise Exception(f"网络请求错误: {str(e)}")
+            raise APIConnectionError(f"网络请求错误: {str(e)}")
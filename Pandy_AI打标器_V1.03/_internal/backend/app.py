@@ -7,20 +7,46 @@ import sys
 import json
 import uuid
 import re
+import asyncio
 import io
 import shutil
+import time
 import threading
 import subprocess
 import webbrowser
 import tkinter as tk
 from tkinter import filedialog
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import traceback
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response
 from flask_cors import CORS
 from PIL import Image
-from api_handler import APIHandler
+from api_handler import APIHandler, APIError
 from image_processor import ImageProcessor
+from batch_runner import (
+    run_batch, retry_call, update_task, mark_item_completed, mark_item_failed, finalize_task,
+    group_items, packed_callbacks
+)
+from async_engine import get_async_engine, AIOHTTP_AVAILABLE
+from rate_limiter import configure_rate_limiter, get_all_limiter_stats
+from caption_cache import get_caption_cache
+from payload_cache import get_payload_cache
+from provider_router import get_provider_router
+from job_store import get_job_store, ITEM_IN_FLIGHT, ITEM_DONE, ITEM_FAILED, ITEM_SKIPPED
+from usage_ledger import get_usage_ledger
+from translation_memory import get_translation_memory
+from thumbnail_cache import get_thumbnail_cache
+from task_registry import TaskRegistry
+import http_pool
+import metrics
+import image_encoder
+import vision_budget
+import prefetch
+import retry_policy
+import scheduler
+import task_events
+import image_dedup
 from path_utils import (
     BASE_PATH, RESOURCE_PATH, CONFIG_DIR, CONFIG_FILE, APIKEY_FILE, 
     TEMPLATES_DIR, FRONTEND_DIR, TRAINING_DATA_DIR,
@@ -68,7 +94,16 @@ def get_tk_root():
 # 路径常量已从 path_utils 导入
 images_data = {}
 pairs_data = {}
-processing_tasks = {}
+# 批量任务（已结束的任务按存活时间和数量上限淘汰）
+processing_tasks = TaskRegistry()
+# 批量翻译任务的结果：task_id -> {条目ID: 译文}
+translation_results = {}
+# 淘汰任务时一并释放事件日志和翻译结果
+processing_tasks.on_evict(task_events.discard)
+processing_tasks.on_evict(lambda task_id: translation_results.pop(task_id, None))
+
+# 任务事件推送连接在没有事件时发送保活注释的间隔秒数
+TASK_EVENT_KEEPALIVE = 15
 
 DEFAULT_SYSTEM_PROMPT = "You are an AI prompt expert who can analyze images. Please look closely at the image and provide a detailed and accurate description as required."
 DEFAULT_USER_PROMPT = "Describe this image in detail for text-to-image training dataset captions."
@@ -150,6 +185,549 @@ def _get_selected_prompts(config, mode):
     return DEFAULT_SYSTEM_PROMPT, DEFAULT_USER_PROMPT
 
 
+def _resolve_batch_workers(data, provider_limit):
+    """根据请求参数 concurrency 计算本次批量任务的并发数（不超过渠道上限）"""
+    requested = (data or {}).get('concurrency')
+    if requested is None:
+        return provider_limit
+    try:
+        return max(1, min(int(requested), provider_limit))
+    except (TypeError, ValueError):
+        return provider_limit
+
+
+def _resolve_batch_engine(data, apikey_config):
+    """选择批量任务执行引擎：'thread'（线程池）或 'async'（asyncio + aiohttp）"""
+    engine = (data or {}).get('engine') or apikey_config.get('batch_engine') or 'thread'
+    if engine == 'async' and not AIOHTTP_AVAILABLE:
+        print("[批量任务] 未安装 aiohttp，异步引擎不可用，回退到线程池引擎")
+        return 'thread'
+    return 'async' if engine == 'async' else 'thread'
+
+
+def _lookup_caption_cache(image_path, crop_params, vision_args, bypass=False):
+    """
+    查询反推结果缓存
+
+    Returns:
+        tuple: (cache_key, cached_text)，未命中时 cached_text 为 None
+    """
+    cache = get_caption_cache()
+    cache_key = cache.make_key(image_path, crop_params, vision_args['system_prompt'],
+                               vision_args['user_prompt'], vision_args['model'])
+    return cache_key, cache.get(cache_key, bypass=bypass)
+
+
+def _build_failover_chain(apikey_config, model, data=None):
+    """
+    启用故障转移时构建渠道调用链（请求参数 failover 优先于 apikey.json 配置）
+
+    Returns:
+        list: 调用链；未启用或可用渠道不足两个时返回 None
+    """
+    router = get_provider_router()
+    enabled = (data or {}).get('failover')
+    if enabled is None:
+        enabled = router.enabled
+    if not enabled:
+        return None
+    chain = router.build_chain(apikey_config, model)
+    if len(chain) < 2:
+        return None
+    # 备用渠道同样按 apikey.json 中的上限限流
+    for entry in chain[1:]:
+        configure_rate_limiter(APIHandler.resolve_provider(entry['base_url']),
+                               max_concurrency=APIHandler.get_max_concurrency(entry['provider'], apikey_config),
+                               max_rps=APIHandler.get_max_rps(entry['provider'], apikey_config))
+    print(f"[故障转移] 调用链: {' -> '.join(e['provider'] for e in chain)}")
+    return chain
+
+
+def _chain_vision_args(vision_args, entry):
+    """用调用链中渠道的 api_key / base_url / model 替换 vision_args 中的对应字段"""
+    return dict(vision_args, api_key=entry['api_key'], base_url=entry['base_url'], model=entry['model'])
+
+
+def _call_vision_api(image_path, crop_params, vision_args, chain=None):
+    """调用 Vision API；提供调用链时经渠道路由执行故障转移与对冲请求"""
+    if not chain:
+        return APIHandler.call_vision_api(image_path, crop_params=crop_params, **vision_args)
+    return get_provider_router().call(chain, lambda entry: APIHandler.call_vision_api(
+        image_path, crop_params=crop_params, **_chain_vision_args(vision_args, entry)
+    ))
+
+
+def _call_packed_vision_api(jobs, vision_args, chain=None):
+    """将多个条目打包为一次 Vision 请求，返回每个条目的描述（解析失败为 None）"""
+    items = [(job['image_path'], job.get('crop_params')) for job in jobs]
+    if not chain:
+        return APIHandler.call_packed_vision_api(items, **vision_args)
+    return get_provider_router().call(chain, lambda entry: APIHandler.call_packed_vision_api(
+        items, **_chain_vision_args(vision_args, entry)
+    ))
+
+
+def _is_pack_rejected(error):
+    """渠道拒绝打包请求（请求体过大、模型不支持多图等），此时改为逐张请求"""
+    return isinstance(error, APIError) and error.status_code in (400, 413, 422)
+
+
+def _resolve_pack_size(data, apikey_config):
+    """根据请求参数或 apikey.json 中的 pack_size 计算每次打包的图片数（1 表示不打包）"""
+    value = (data or {}).get('pack_size')
+    if value is None:
+        value = apikey_config.get('pack_size', 1)
+    try:
+        return max(1, min(int(value), APIHandler.MAX_PACK_SIZE))
+    except (TypeError, ValueError):
+        return 1
+
+
+def _vision_input_size(info):
+    """图片送入 Vision API 前的尺寸（有裁剪参数时为裁剪目标尺寸）"""
+    crop_params = (info or {}).get('crop_params')
+    if crop_params:
+        return int(crop_params.get('target_width', 1024)), int(crop_params.get('target_height', 1024))
+    return int((info or {}).get('width') or 0), int((info or {}).get('height') or 0)
+
+
+def _estimate_vision_tokens(infos, model):
+    """
+    估算一批图片的视觉 token
+
+    Args:
+        infos: 图片信息列表（images_data 条目或成对图片的一侧）
+        model: 模型名
+
+    Returns:
+        dict: {'model', 'profile', 'detail', 'images', 'total_tokens', 'avg_tokens', 'items'}
+    """
+    items = []
+    for info in infos:
+        width, height = _vision_input_size(info)
+        input_width, input_height = vision_budget.target_size(model, width, height)
+        items.append({
+            "id": info.get('id'),
+            "name": info.get('name'),
+            "width": input_width,
+            "height": input_height,
+            "tokens": vision_budget.estimate_tokens(model, width, height),
+        })
+    total = sum(item['tokens'] for item in items)
+    return {
+        "model": model,
+        "profile": vision_budget.get_profile(model)['name'],
+        "detail": vision_budget.get_settings()['detail'],
+        "images": len(items),
+        "total_tokens": total,
+        "avg_tokens": round(total / len(items)) if items else 0,
+        "items": items,
+    }
+
+
+def _pair_vision_side(pair):
+    """成对图片中用于反推的一侧（优先左图）"""
+    if pair.get('left') and pair['left'].get('path'):
+        return pair['left']
+    return pair.get('right') or {}
+
+
+# 成对图片计算近似重复时比较的各侧
+PAIR_DEDUP_SIDES = ('left', 'left2', 'right')
+
+
+def _ensure_dhash(info):
+    """
+    图片的 dHash（整数）；导入时未计算的图片（例如从缓存恢复的图片）按需计算并记录
+
+    Returns:
+        int: 哈希，没有图片或无法读取时返回 None
+    """
+    path = (info or {}).get('path')
+    if not path:
+        return None
+    value = image_dedup.from_hex(info.get('dhash'))
+    if value is None and os.path.exists(path):
+        value = image_dedup.hash_image_file(path)
+        if value is not None:
+            info['dhash'] = image_dedup.to_hex(value)
+    return value
+
+
+def _pair_dhash(pair):
+    """成对图片各侧哈希拼接成的整体哈希（缺少的一侧按 0 计算），各侧都没有图片时返回 None"""
+    values = [_ensure_dhash(pair.get(side)) for side in PAIR_DEDUP_SIDES]
+    if all(value is None for value in values):
+        return None
+    combined = 0
+    for value in values:
+        combined = (combined << image_dedup.HASH_BITS) | (value or 0)
+    return combined
+
+
+def _image_dedup_entry(img_id):
+    """图片的近似重复分区键（裁剪参数不同的图片不视为重复）和哈希"""
+    img = images_data.get(img_id)
+    if img is None:
+        return None
+    return json.dumps(img.get('crop_params'), sort_keys=True), _ensure_dhash(img)
+
+
+def _pair_dedup_entry(pair_id):
+    """成对图片的近似重复分区键和整体哈希（导出、查找重复时使用）"""
+    pair = pairs_data.get(pair_id)
+    return (None, _pair_dhash(pair)) if pair else None
+
+
+def _pair_vision_dedup_entry(pair_id):
+    """成对图片用于反推一侧的哈希（反推结果只取决于这一侧，批量反推复用结果时使用）"""
+    pair = pairs_data.get(pair_id)
+    return (None, _ensure_dhash(_pair_vision_side(pair))) if pair else None
+
+
+def _dedup_ids(ids, entry_of, max_distance=None, bits=image_dedup.HASH_BITS):
+    """
+    把条目按近似重复分组，每组保留第一个条目
+
+    Args:
+        ids: 条目ID列表
+        entry_of: entry_of(item_id) -> (分区键, 哈希)，条目不存在时返回 None；分区键不同的条目不会被视为重复
+        max_distance: 最大汉明距离（默认使用配置值）
+        bits: 哈希位数
+
+    Returns:
+        tuple: (representatives, followers)，同 image_dedup.plan_duplicates
+    """
+    partitions = {}
+    for item_id in ids:
+        entry = entry_of(item_id)
+        if entry is not None and entry[1] is not None:
+            partitions.setdefault(entry[0], []).append((item_id, entry[1]))
+    followers = {}
+    for entries in partitions.values():
+        if len(entries) > 1:
+            followers.update(image_dedup.plan_duplicates(entries, max_distance, bits)[1])
+    duplicate_ids = {dup_id for group in followers.values() for dup_id in group}
+    return [item_id for item_id in ids if item_id not in duplicate_ids], followers
+
+
+def _pair_dedup_args(max_distance):
+    """成对图片整体哈希的距离阈值和位数（每侧的阈值乘以侧数）"""
+    return max_distance * len(PAIR_DEDUP_SIDES), image_dedup.HASH_BITS * len(PAIR_DEDUP_SIDES)
+
+
+def _resolve_dedup_mode(data):
+    """批量反推时近似重复的处理方式（请求中的 dedup 优先，其次为配置的 batch_mode）"""
+    mode = data.get('dedup')
+    if mode is True:
+        return 'reuse'
+    if mode is False:
+        return 'off'
+    return mode if mode in image_dedup.BATCH_MODES else image_dedup.get_settings()['batch_mode']
+
+
+def _plan_batch_duplicates(task, ids, data, entry_of):
+    """
+    批量反推前把近似重复的条目分组，只请求每组的代表条目
+
+    reuse：重复条目在代表条目完成时复用其结果；skip：重复条目不处理（从任务总数中扣除）
+
+    Returns:
+        tuple: (需要请求的ID列表, {代表ID: [复用结果的重复ID, ...]})
+    """
+    mode = _resolve_dedup_mode(data)
+    if mode == 'off':
+        return ids, {}
+    representatives, followers = _dedup_ids(ids, entry_of)
+    duplicates = len(ids) - len(representatives)
+    if not duplicates:
+        return ids, {}
+    if mode == 'skip':
+        update_task(task, total=task['total'] - duplicates, duplicates=duplicates)
+        followers = {}
+    else:
+        update_task(task, duplicates=duplicates)
+    print(f"[近似重复] {duplicates} 项与批量中的其他条目近似重复 | "
+          f"处理方式: {'复用代表条目的结果' if mode == 'reuse' else '跳过'}")
+    return representatives, followers
+
+
+def _duplicates_note(task, unit):
+    """启动批量任务的提示中附加的近似重复说明"""
+    duplicates = task.get('duplicates')
+    return f"，其中 {duplicates} {unit}近似重复不再请求" if duplicates else ""
+
+
+def _run_vision_batch(task, ids, begin_item, finish_item, vision_args, max_workers, engine='thread',
+                      bypass_cache=False, chain=None, pack_size=1, resolve_item=None):
+    """
+    执行批量 Vision 反推；提供 resolve_item 时在后台预取后续图片的预处理结果，
+    请求在途时提前完成解码和编码（其余参数同 _execute_vision_batch）
+
+    Args:
+        resolve_item: resolve_item(item_id) -> (image_path, crop_params)，条目不存在时返回 None（可选）
+    """
+    prefetcher = None
+    if resolve_item is not None:
+        cache = get_caption_cache()
+
+        def cached(image_path, crop_params):
+            # 反推结果已缓存的条目不会请求 API，不需要预处理
+            return cache.contains(cache.make_key(image_path, crop_params, vision_args['system_prompt'],
+                                                 vision_args['user_prompt'], vision_args['model']))
+
+        prefetcher = prefetch.start(task, ids, resolve_item, APIHandler.prepare_image_now, vision_args['model'],
+                                    lag=max_workers * pack_size, skip=None if bypass_cache else cached)
+    if prefetcher is not None:
+        item_begin = begin_item
+
+        def begin_item(idx, item_id):
+            prefetcher.advance(idx)
+            return item_begin(idx, item_id)
+
+    try:
+        _execute_vision_batch(task, ids, begin_item, finish_item, vision_args, max_workers, engine,
+                              bypass_cache, chain, pack_size)
+    finally:
+        stats = prefetch.stop(prefetcher)
+        if stats:
+            update_task(task, prefetch=stats)
+            print(f"[图片预取] 预取 {stats['prefetched']} 张 | 命中 {stats['hits']} | "
+                  f"丢弃 {stats['dropped']} | 累计等待 {stats['wait_time']:.2f}s")
+
+
+# 批量反推的调用步骤：缓存查询、打包与逐张回退的流程只写一份（_vision_item_steps / _vision_group_steps），
+# 生成器产出 (步骤, 参数)，由线程池引擎直接调用、异步引擎 await 执行后把结果（或异常）送回
+STEP_LOOKUP = 'lookup'    # 参数 job，返回 (cache_key, 缓存结果或 None)
+STEP_STORE = 'store'      # 参数 (cache_key, 结果)，写入反推结果缓存
+STEP_SINGLE = 'single'    # 参数 job，单张请求（含重试），返回描述
+STEP_PACKED = 'packed'    # 参数 (group_job, [job, ...])，打包请求（含重试），返回每张的描述（解析失败为 None）
+
+
+def _lookup_step(job):
+    job['cache_key'], cached = yield STEP_LOOKUP, job
+    if cached is not None:
+        print(f"[反推缓存] 命中 {job['id']}，跳过 API 请求")
+    return cached
+
+
+def _single_step(job):
+    result = yield STEP_SINGLE, job
+    yield STEP_STORE, (job['cache_key'], result)
+    return result
+
+
+def _vision_item_steps(job):
+    """单个条目：先查缓存，未命中再请求 API"""
+    cached = yield from _lookup_step(job)
+    if cached is not None:
+        return cached
+    return (yield from _single_step(job))
+
+
+def _vision_group_steps(group_job):
+    """
+    一组条目：未命中缓存的条目打包请求，渠道拒绝打包或解析失败的条目单独请求
+
+    Returns:
+        list: [(job, result, error), ...]
+    """
+    outcomes = []
+    pending = []
+    for job in group_job['jobs']:
+        cached = yield from _lookup_step(job)
+        if cached is not None:
+            outcomes.append((job, cached, None))
+        else:
+            pending.append(job)
+
+    packed = [None] * len(pending)
+    if len(pending) > 1:
+        try:
+            packed = yield STEP_PACKED, (group_job, pending)
+        except Exception as e:
+            if not _is_pack_rejected(e):
+                return outcomes + [(job, None, e) for job in pending]
+            print(f"[打包请求] 渠道拒绝打包请求，改为逐张请求: {str(e)[:100]}")
+
+    # 解析失败（或未打包）的条目单独请求
+    for job, result in zip(pending, packed):
+        if result is None:
+            try:
+                result = yield from _single_step(job)
+            except Exception as e:
+                outcomes.append((job, None, e))
+                continue
+        else:
+            yield STEP_STORE, (job['cache_key'], result)
+        outcomes.append((job, result, None))
+    return outcomes
+
+
+def _drive_vision_steps(steps, handle):
+    """在当前线程中执行调用步骤，返回步骤生成器的结果"""
+    value, error = None, None
+    while True:
+        try:
+            step, arg = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value, error = None, None
+        try:
+            value = handle(step, arg)
+        except Exception as e:
+            error = e
+
+
+async def _drive_vision_steps_async(steps, handle):
+    """异步版 _drive_vision_steps（handle 为协程函数）"""
+    value, error = None, None
+    while True:
+        try:
+            step, arg = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value, error = None, None
+        try:
+            value = await handle(step, arg)
+        except Exception as e:
+            error = e
+
+
+def _execute_vision_batch(task, ids, begin_item, finish_item, vision_args, max_workers, engine='thread',
+                          bypass_cache=False, chain=None, pack_size=1):
+    """
+    使用指定引擎执行批量 Vision 反推（先查反推结果缓存，未命中才请求 API）
+
+    Args:
+        task: processing_tasks 中的任务字典
+        ids: 条目ID列表
+        begin_item: begin_item(idx, item_id) -> job（需包含 id / image_path，可选 crop_params）
+        finish_item: finish_item(job, result, error) -> bool
+        vision_args: dict，传给 call_vision_api 的 system_prompt / user_prompt / api_key / base_url / model
+        max_workers: 并发数
+        engine: 'thread' 或 'async'
+        bypass_cache: 为 True 时跳过反推结果缓存，强制重新请求 API
+        chain: 渠道调用链（可选，启用故障转移/对冲时由 _build_failover_chain 生成）
+        pack_size: 每次请求打包的图片数，大于 1 时按组请求，解析失败的条目单独重试
+    """
+    # 任务取消后不再等待重试
+    cancelled = lambda: task.get('cancel_requested')
+
+    if pack_size > 1:
+        batch_ids = group_items(ids, pack_size)
+        batch_begin, batch_finish = packed_callbacks(task, begin_item, finish_item)
+        steps = _vision_group_steps
+    else:
+        batch_ids, batch_begin, batch_finish = ids, begin_item, finish_item
+        steps = _vision_item_steps
+
+    if engine == 'async':
+        async_engine = get_async_engine()
+        router = get_provider_router()
+
+        async def handle_async(step, arg):
+            loop = asyncio.get_running_loop()
+            if step == STEP_LOOKUP:
+                # 计算缓存键需要读取图片文件，放到线程池中执行，避免阻塞事件循环
+                return await loop.run_in_executor(None, _lookup_caption_cache, arg['image_path'],
+                                                  arg.get('crop_params'), vision_args, bypass_cache)
+            if step == STEP_STORE:
+                return await loop.run_in_executor(None, get_caption_cache().put, *arg)
+            if step == STEP_SINGLE:
+                request = lambda args: async_engine.call_vision_api(arg['image_path'], crop_params=arg.get('crop_params'),
+                                                                    **args)
+                label, give_up = arg['id'], None
+            else:
+                group_job, pending = arg
+                items = [(job['image_path'], job.get('crop_params')) for job in pending]
+                request = lambda args: async_engine.call_packed_vision_api(items, **args)
+                label, give_up = group_job['id'], _is_pack_rejected
+            if chain:
+                call = lambda: router.acall(chain, lambda entry: request(_chain_vision_args(vision_args, entry)))
+            else:
+                call = lambda: request(vision_args)
+            return await async_engine.retry_call(call, label, give_up=give_up, cancelled=cancelled)
+
+        async def call_async(job):
+            return await _drive_vision_steps_async(steps(job), handle_async)
+
+        async_engine.run_batch(task, batch_ids, batch_begin, call_async, batch_finish, max_concurrency=max_workers)
+        return
+
+    def handle(step, arg):
+        if step == STEP_LOOKUP:
+            return _lookup_caption_cache(arg['image_path'], arg.get('crop_params'), vision_args, bypass_cache)
+        if step == STEP_STORE:
+            return get_caption_cache().put(*arg)
+        if step == STEP_SINGLE:
+            return retry_call(lambda: _call_vision_api(arg['image_path'], arg.get('crop_params'), vision_args, chain),
+                              arg['id'], cancelled=cancelled)
+        group_job, pending = arg
+        return retry_call(lambda: _call_packed_vision_api(pending, vision_args, chain), group_job['id'],
+                          give_up=_is_pack_rejected, cancelled=cancelled)
+
+    def call(job):
+        return _drive_vision_steps(steps(job), handle)
+
+    run_batch(task, batch_ids, batch_begin, call, batch_finish, max_workers=max_workers)
+
+
+def _sse_event(data, event=None, event_id=None):
+    """格式化一条 Server-Sent Event（event_id 为断线重连时浏览器回传的 Last-Event-ID）"""
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    prefix += f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _sse_response(deltas, on_complete, on_error=None, on_abort=None):
+    """
+    将文本增量生成器包装为 Server-Sent Events 响应
+
+    事件格式：
+        data: {"delta": "..."}                              文本增量
+        event: done  data: {"success": true, ...}           完成，附带 on_complete 返回的字段
+        event: error data: {"success": false, "message": ...} 失败
+
+    Args:
+        deltas: 产出文本增量的生成器（在响应迭代时才开始执行）
+        on_complete: on_complete(full_text) -> dict，全部增量接收完后写回结果
+        on_error: on_error(error)，失败时调用（可选）
+        on_abort: on_abort()，客户端在完成前断开连接时调用（可选，用于恢复条目状态）
+    """
+    def generate():
+        parts = []
+        finished = False
+        try:
+            for delta in deltas:
+                parts.append(delta)
+                yield _sse_event({"delta": delta})
+            result = on_complete(''.join(parts)) or {}
+            finished = True
+            yield _sse_event(dict(result, success=True), 'done')
+        except GeneratorExit:
+            # 客户端断开连接：停止读取上游响应（finally 中关闭），不写回结果
+            if not finished:
+                print("[流式响应] 客户端已断开连接")
+                if on_abort:
+                    on_abort()
+            raise
+        except Exception as e:
+            finished = True
+            print(f"[流式响应] 失败: {e}")
+            if on_error:
+                on_error(e)
+            yield _sse_event({"success": False, "message": str(e)}, 'error')
+        finally:
+            # 关闭增量生成器，释放上游连接和限流许可
+            close = getattr(deltas, 'close', None)
+            if close:
+                close()
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 def load_config():
     """加载配置文件"""
     if os.path.exists(CONFIG_FILE):
@@ -209,6 +787,71 @@ def save_apikey_config(config):
         json.dump(config, f, indent=2, ensure_ascii=False)
 
 
+def _apply_http_settings(apikey_config, warmup=True):
+    """应用连接池配置，并预热当前渠道的连接"""
+    http_pool.configure(apikey_config.get('http'))
+    if not warmup:
+        return
+    provider = apikey_config.get('current_provider')
+    provider_cfg = (apikey_config.get('providers') or {}).get(provider) or {}
+    if provider_cfg.get('base_url'):
+        APIHandler.warmup(provider_cfg['base_url'], provider_cfg.get('api_key'))
+
+
+def _apply_failover_settings(apikey_config):
+    """应用多渠道故障转移与对冲请求配置"""
+    get_provider_router().configure(apikey_config.get('failover'))
+
+
+def _apply_encoding_settings(apikey_config):
+    """应用请求图片编码配置（字节预算、候选格式、质量范围）、视觉输入预算配置（细节档位）与预取配置"""
+    image_encoder.configure(apikey_config.get('image_encoding'))
+    vision_budget.configure(apikey_config.get('vision_budget'))
+    prefetch.configure(apikey_config.get('prefetch'))
+
+
+def _apply_retry_settings(apikey_config):
+    """应用批量请求重试策略配置"""
+    retry_policy.configure(apikey_config.get('retry_policy'))
+
+
+def _apply_job_store_settings(apikey_config):
+    """应用批量任务持久化与用量账本配置"""
+    get_job_store().configure(apikey_config.get('job_store'))
+    get_usage_ledger().configure(apikey_config.get('usage_ledger'))
+
+
+def _apply_task_settings(apikey_config):
+    """应用任务注册表（已结束任务的淘汰）与任务事件日志配置"""
+    processing_tasks.configure(apikey_config.get('task_registry'))
+    task_events.configure(apikey_config.get('task_registry'))
+
+
+def _apply_dedup_settings(apikey_config):
+    """应用近似重复检测配置（距离阈值、批量反推时的处理方式）"""
+    image_dedup.configure(apikey_config.get('dedup'))
+
+
+def _apply_cache_settings(apikey_config):
+    """应用反推结果缓存、请求图片缓存、缩略图缓存与翻译记忆配置"""
+    get_caption_cache().configure(apikey_config.get('caption_cache'))
+    get_payload_cache().configure(apikey_config.get('payload_cache'))
+    get_thumbnail_cache().configure(apikey_config.get('thumbnail_cache'))
+    get_translation_memory().configure(apikey_config.get('translation_memory'))
+
+
+def apply_apikey_settings(apikey_config, warmup=True):
+    """应用 apikey.json 中的全部运行参数（启动时和保存配置后调用）"""
+    _apply_http_settings(apikey_config, warmup=warmup)
+    _apply_cache_settings(apikey_config)
+    _apply_failover_settings(apikey_config)
+    _apply_encoding_settings(apikey_config)
+    _apply_retry_settings(apikey_config)
+    _apply_job_store_settings(apikey_config)
+    _apply_task_settings(apikey_config)
+    _apply_dedup_settings(apikey_config)
+
+
 def list_prompt_templates():
     """列出所有提示词模板文件"""
     templates = []
@@ -260,20 +903,100 @@ def delete_prompt_template(filename):
     return False
 
 
-def _build_pair_side_info(image_path):
-    info = ImageProcessor.load_image_with_txt(image_path)
+def _build_pair_side_info(image_path, with_thumbnail=True):
+    info = ImageProcessor.load_image_with_txt(image_path, with_thumbnail=with_thumbnail)
     if not info:
         return None
 
-    return {
+    side_info = {
         "path": info.get("path"),
         "name": info.get("name"),
         "width": info.get("width"),
         "height": info.get("height"),
         "thumbnail": info.get("thumbnail"),
+        "dhash": info.get("dhash"),
         "text": info.get("text", ""),
         "status": info.get("status", "idle")
     }
+    if info.get("thumbnail_pending"):
+        side_info["thumbnail_pending"] = True
+    return side_info
+
+
+def _start_thumbnail_task(entries, target='images'):
+    """
+    在后台线程池中生成导入图片的缩略图（导入接口只登记尺寸和文本后立即返回）
+    每生成一张推送一条 item 事件 {id, status, side, thumbnail}，side 为成对图片的一侧（单张图片为 None）
+    缩略图任务标记为 background：不计入批量反推的指标，已结束的任务不占用注册表的 max_finished 名额
+
+    Args:
+        entries: [(条目ID, 侧, 图片信息), ...]，图片信息为 images_data 中的图片或成对图片的一侧，
+                 只处理标记了 thumbnail_pending 的图片
+        target: 'images' 或 'pairs'，条目所在的列表
+
+    Returns:
+        str: 任务ID（没有需要生成的缩略图时为 None）
+    """
+    entries = [entry for entry in entries if entry[2] and entry[2].get('thumbnail_pending')]
+    if not entries:
+        return None
+
+    task_id = str(uuid.uuid4())
+    processing_tasks[task_id] = {
+        "id": task_id,
+        "status": "processing",
+        "type": "thumbnails",
+        "target": target,
+        "background": True,
+        "total": len(entries),
+        "completed": 0,
+        "failed": 0,
+        "cancel_requested": False,
+        "failed_ids": []
+    }
+    task = processing_tasks[task_id]
+    cache = get_thumbnail_cache()
+
+    def render(entry):
+        item_id, side, info = entry
+        try:
+            if task.get('cancel_requested') or (item_id not in images_data and item_id not in pairs_data):
+                # 任务已取消或条目已被删除
+                return
+            thumbnail, image_hash = cache.thumbnail(info['path'], with_hash=True)
+            if thumbnail is None:
+                raise ValueError(f"无法生成缩略图: {info.get('name', '')}")
+        except Exception as e:
+            mark_item_failed(task, item_id, e)
+            return
+        finally:
+            info.pop('thumbnail_pending', None)
+        info['thumbnail'], info['dhash'] = thumbnail, image_hash
+        mark_item_completed(task, item_id, fields={"side": side, "thumbnail": thumbnail})
+
+    def run():
+        with ThreadPoolExecutor(max_workers=cache.workers, thread_name_prefix='thumbnail') as executor:
+            list(executor.map(render, entries))
+        finalize_task(task)
+
+    threading.Thread(target=run, daemon=True).start()
+    return task_id
+
+
+def _running_thumbnail_tasks(target):
+    """正在为 target（'images' / 'pairs'）生成缩略图的任务ID（页面刷新或启动恢复任务后，前端据此继续接收缩略图）"""
+    return [task['id'] for task in processing_tasks.values()
+            if task.get('type') == 'thumbnails' and task.get('target') == target and task.get('status') == 'processing']
+
+
+def _start_pair_thumbnail_task(pair_ids):
+    """为新导入的成对图片启动后台缩略图任务，返回任务ID（没有需要生成的缩略图时为 None）"""
+    entries = []
+    for pair_id in pair_ids:
+        pair = pairs_data.get(pair_id) or {}
+        for side in PAIR_DEDUP_SIDES:
+            entries.append((pair_id, side, pair.get(side)))
+    return _start_thumbnail_task(entries, 'pairs')
 
 
 def _get_pair_text(left_side, right_side):
@@ -487,7 +1210,10 @@ def update_apikey_config():
         config = request.get_json(silent=True) or {}
         if 'available_providers' in config:
             del config['available_providers']
+        previous_provider = load_apikey_config().get('current_provider')
         save_apikey_config(config)
+        # 切换渠道时预热新渠道的连接
+        apply_apikey_settings(config, warmup=config.get('current_provider') != previous_provider)
         return jsonify({"success": True, "message": "API Key配置已保存"})
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
@@ -514,10 +1240,11 @@ def test_api_connection():
             "Content-Type": "application/json"
         }
         
-        # 尝试调用models接口检测连通性
+        # 尝试调用models接口检测连通性（复用渠道共享会话，顺便预热连接）
+        session = http_pool.get_session(APIHandler.resolve_provider(base_url))
         test_url = f"{base_url.rstrip('/')}/models"
         try:
-            response = requests.get(test_url, headers=headers, timeout=10)
+            response = session.get(test_url, headers=headers, timeout=http_pool.get_timeout(10))
             if response.status_code == 200:
                 return jsonify({"success": True, "message": "连接成功！API可用"})
             elif response.status_code == 401:
@@ -532,7 +1259,7 @@ def test_api_connection():
                     "messages": [{"role": "user", "content": "Hi"}],
                     "max_tokens": 5
                 }
-                chat_response = requests.post(chat_url, headers=headers, json=chat_data, timeout=15)
+                chat_response = session.post(chat_url, headers=headers, json=chat_data, timeout=http_pool.get_timeout(15))
                 if chat_response.status_code == 200:
                     return jsonify({"success": True, "message": "连接成功！API可用"})
                 else:
@@ -665,25 +1392,31 @@ def add_images():
         paths = data.get('paths', [])
         
         added = 0
+        existing_paths = {img['path'] for img in images_data.values()}
+        thumbnail_entries = []
         for path in paths:
             if not os.path.exists(path):
                 continue
             
-            if any(img['path'] == path for img in images_data.values()):
+            if path in existing_paths:
                 continue
             
-            img_info = ImageProcessor.load_image_with_txt(path)
+            # 只读取尺寸和文本，缩略图由后台任务生成
+            img_info = ImageProcessor.load_image_with_txt(path, with_thumbnail=False)
             if img_info:
                 img_id = str(uuid.uuid4())
                 img_info['id'] = img_id
                 images_data[img_id] = img_info
+                existing_paths.add(path)
+                thumbnail_entries.append((img_id, None, img_info))
                 added += 1
         
         return jsonify({
             "success": True,
             "added": added,
             "total": len(images_data),
-            "images": list(images_data.values())
+            "images": list(images_data.values()),
+            "thumbnail_task_id": _start_thumbnail_task(thumbnail_entries)
         })
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
@@ -714,6 +1447,7 @@ def upload_images_drop():
         
         added = 0
         matched = 0
+        thumbnail_entries = []
         
         for img_file in image_files:
             # 保存图片到上传目录
@@ -730,8 +1464,8 @@ def upload_images_drop():
             
             img_file.save(img_path)
             
-            # 加载图片信息
-            img_info = ImageProcessor.load_image_with_txt(img_path)
+            # 加载图片信息（缩略图由后台任务生成）
+            img_info = ImageProcessor.load_image_with_txt(img_path, with_thumbnail=False)
             if img_info:
                 img_id = str(uuid.uuid4())
                 img_info['id'] = img_id
@@ -744,6 +1478,7 @@ def upload_images_drop():
                     matched += 1
                 
                 images_data[img_id] = img_info
+                thumbnail_entries.append((img_id, None, img_info))
                 added += 1
         
         return jsonify({
@@ -751,7 +1486,8 @@ def upload_images_drop():
             "added": added,
             "matched": matched,
             "total": len(images_data),
-            "images": list(images_data.values())
+            "images": list(images_data.values()),
+            "thumbnail_task_id": _start_thumbnail_task(thumbnail_entries)
         })
     except Exception as e:
         import traceback
@@ -764,7 +1500,8 @@ def get_pairs():
     """获取所有成对图片（编辑模式）"""
     return jsonify({
         "success": True,
-        "pairs": list(pairs_data.values())
+        "pairs": list(pairs_data.values()),
+        "thumbnail_task_ids": _running_thumbnail_tasks('pairs')
     })
 
 
@@ -1006,6 +1743,8 @@ def import_pairs_from_folder():
         print(f"[Import] Copied {len(copied_files)} images to input_datas_image folder")
 
         added = 0
+        # 导入时只读取尺寸和文本，新增组的缩略图由后台任务生成
+        existing_pair_ids = set(pairs_data)
         
         if import_mode == 'default':
             # 默认模式：按顺序两两配对
@@ -1024,8 +1763,8 @@ def import_pairs_from_folder():
                     continue
 
                 pair_id = str(uuid.uuid4())
-                left_side = _build_pair_side_info(left_path) if left_path else None
-                right_side = _build_pair_side_info(right_path) if right_path else None
+                left_side = _build_pair_side_info(left_path, with_thumbnail=False) if left_path else None
+                right_side = _build_pair_side_info(right_path, with_thumbnail=False) if right_path else None
                 
                 # 尝试查找对应的txt文件
                 pair_text = ""
@@ -1100,8 +1839,8 @@ def import_pairs_from_folder():
                     continue
 
                 pair_id = str(uuid.uuid4())
-                left_side = _build_pair_side_info(left_path) if left_path else None
-                right_side = _build_pair_side_info(right_path) if right_path else None
+                left_side = _build_pair_side_info(left_path, with_thumbnail=False) if left_path else None
+                right_side = _build_pair_side_info(right_path, with_thumbnail=False) if right_path else None
                 
                 # 根据txt_follows设置查找txt文件
                 pair_text = ""
@@ -1170,10 +1909,10 @@ def import_pairs_from_folder():
                     continue
 
                 pair_id = str(uuid.uuid4())
-                left_side = _build_pair_side_info(left_path) if left_path else None
+                left_side = _build_pair_side_info(left_path, with_thumbnail=False) if left_path else None
                 # left2 stored as separate key in pair dict if present
-                left2_side = _build_pair_side_info(left2_path) if left2_path else None
-                right_side = _build_pair_side_info(right_path) if right_path else None
+                left2_side = _build_pair_side_info(left2_path, with_thumbnail=False) if left2_path else None
+                right_side = _build_pair_side_info(right_path, with_thumbnail=False) if right_path else None
 
                 # 尝试查找同名txt（优先使用对应侧的同名txt）
                 pair_text = ""
@@ -1221,7 +1960,9 @@ def import_pairs_from_folder():
                 "success": True,
                 "added": added,
                 "total": len(pairs_data),
-                "pairs": list(pairs_data.values())
+                "pairs": list(pairs_data.values()),
+                "thumbnail_task_id": _start_pair_thumbnail_task(
+                    [pair_id for pair_id in pairs_data if pair_id not in existing_pair_ids])
             })
 
         # 原来的 match 分支继续在这里（保留）
@@ -1274,9 +2015,9 @@ def import_pairs_from_folder():
                     continue
 
                 pair_id = str(uuid.uuid4())
-                left_side = _build_pair_side_info(left_path) if left_path else None
-                left2_side = _build_pair_side_info(left2_path) if left2_path else None
-                right_side = _build_pair_side_info(right_path) if right_path else None
+                left_side = _build_pair_side_info(left_path, with_thumbnail=False) if left_path else None
+                left2_side = _build_pair_side_info(left2_path, with_thumbnail=False) if left2_path else None
+                right_side = _build_pair_side_info(right_path, with_thumbnail=False) if right_path else None
                 
                 # 根据txt_follows设置查找txt文件
                 pair_text = ""
@@ -1331,7 +2072,9 @@ def import_pairs_from_folder():
             "success": True,
             "added": added,
             "total": len(pairs_data),
-            "pairs": list(pairs_data.values())
+            "pairs": list(pairs_data.values()),
+            "thumbnail_task_id": _start_pair_thumbnail_task(
+                [pair_id for pair_id in pairs_data if pair_id not in existing_pair_ids])
         })
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
@@ -1369,6 +2112,14 @@ def export_pairs():
         if not ids:
             return jsonify({"success": False, "message": "未选择成对图片组"}), 400
 
+        # 可选：近似重复的图片组只导出每组的第一组
+        skipped_duplicates = 0
+        if data.get('skip_duplicates'):
+            max_distance, bits = _pair_dedup_args(image_dedup.resolve_distance(data.get('max_distance')))
+            kept_ids, _ = _dedup_ids(ids, _pair_dedup_entry, max_distance, bits)
+            skipped_duplicates = len(ids) - len(kept_ids)
+            ids = kept_ids
+
         selected_pairs = []
         for pair_id in ids:
             pair = pairs_data.get(pair_id)
@@ -1549,7 +2300,8 @@ def export_pairs():
 
         return jsonify({
             "success": True,
-            "message": f"已导出 {len(selected_pairs)} 组图片",
+            "message": f"已导出 {len(selected_pairs)} 组图片"
+                       + (f"（跳过 {skipped_duplicates} 组近似重复）" if skipped_duplicates else ""),
             "file": result_path
         })
     except Exception as e:
@@ -1580,7 +2332,7 @@ def resize_pairs():
             if left_path and os.path.exists(left_path):
                 if ImageProcessor.resize_image_by_longest_edge(left_path, max_size):
                     # 更新缩略图
-                    thumb = ImageProcessor.create_thumbnail(left_path)
+                    thumb = get_thumbnail_cache().thumbnail(left_path)
                     pairs_data[pair_id]['left']['thumbnail'] = thumb
                     # 更新尺寸信息
                     img = Image.open(left_path)
@@ -1593,7 +2345,7 @@ def resize_pairs():
             if right_path and os.path.exists(right_path):
                 if ImageProcessor.resize_image_by_longest_edge(right_path, max_size):
                     # 更新缩略图
-                    thumb = ImageProcessor.create_thumbnail(right_path)
+                    thumb = get_thumbnail_cache().thumbnail(right_path)
                     pairs_data[pair_id]['right']['thumbnail'] = thumb
                     # 更新尺寸信息
                     img = Image.open(right_path)
@@ -1623,6 +2375,7 @@ def tag_single_pair(pair_id):
     try:
         apikey_config = load_apikey_config()
         config = load_config()
+        data = request.get_json(silent=True) or {}
         provider = apikey_config['current_provider']
         api_key = apikey_config['providers'][provider]['api_key']
         base_url = apikey_config['providers'][provider]['base_url']
@@ -1645,9 +2398,13 @@ def tag_single_pair(pair_id):
         # 使用原图进行反推（如果有目标图，可以同时发送两张图）
         image_path = left_path or right_path
         
-        result = APIHandler.call_vision_api(
-            image_path, system_prompt, user_prompt, api_key, base_url, model
-        )
+        vision_args = {"system_prompt": system_prompt, "user_prompt": user_prompt,
+                       "api_key": api_key, "base_url": base_url, "model": model}
+        cache_key, result = _lookup_caption_cache(image_path, None, vision_args, bool(data.get('bypass_cache')))
+        if result is None:
+            chain = _build_failover_chain(apikey_config, model, data)
+            result = _call_vision_api(image_path, None, vision_args, chain)
+            get_caption_cache().put(cache_key, result)
         
         pairs_data[pair_id]['text'] = result
         pairs_data[pair_id]['status'] = 'success'
@@ -1682,6 +2439,7 @@ def tag_batch_pairs():
         
         task_id = str(uuid.uuid4())
         processing_tasks[task_id] = {
+            "id": task_id,
             "status": "processing",
             "type": "pairs",
             "total": len(ids),
@@ -1694,27 +2452,42 @@ def tag_batch_pairs():
             "failed_ids": []  # 记录失败的图片组ID
         }
         
+        task = processing_tasks[task_id]
+        provider_limit = APIHandler.get_max_concurrency(provider, apikey_config)
+        max_workers = _resolve_batch_workers(data, provider_limit)
+        # 限流器按请求 URL 识别渠道，这里使用同样的标识，保证配置作用到实际使用的限流器
+        configure_rate_limiter(APIHandler.resolve_provider(apikey_config['providers'][provider]['base_url']),
+                               max_concurrency=provider_limit,
+                               max_rps=APIHandler.get_max_rps(provider, apikey_config))
+        engine = _resolve_batch_engine(data, apikey_config)
+        task['engine'] = engine
+        bypass_cache = bool(data.get('bypass_cache'))
+        chain = _build_failover_chain(apikey_config, apikey_config.get('model', 'Qwen/Qwen2.5-VL-72B-Instruct'), data)
+        pack_size = _resolve_pack_size(data, apikey_config)
+        task['pack_size'] = pack_size
+        batch_ids, followers = _plan_batch_duplicates(task, ids, data, _pair_vision_dedup_entry)
+        estimate = _estimate_vision_tokens([_pair_vision_side(pairs_data[i]) for i in batch_ids if i in pairs_data],
+                                           apikey_config.get('model', 'Qwen/Qwen2.5-VL-72B-Instruct'))
+        task['estimated_tokens'] = estimate['total_tokens']
+        print(f"[视觉预算] {estimate['images']} 组图片 | 档位: {estimate['detail']} | "
+              f"预计视觉token: {estimate['total_tokens']}（平均 {estimate['avg_tokens']}）")
+        
         def process_batch():
             base_url = apikey_config['providers'][provider]['base_url']
             model = apikey_config.get('model', 'Qwen/Qwen2.5-VL-72B-Instruct')
             system_prompt, user_prompt = _get_selected_prompts(config, 'editing')
             
-            for idx, pair_id in enumerate(ids, start=1):
-                if processing_tasks.get(task_id, {}).get('cancel_requested'):
-                    processing_tasks[task_id]['status'] = 'cancelled'
-                    break
+            def begin_item(idx, pair_id):
                 if pair_id not in pairs_data:
-                    continue
+                    return None
                 
                 pair = pairs_data[pair_id]
-                pairs_data[pair_id]['status'] = 'processing'
+                pair['status'] = 'processing'
 
                 left_name = (pair.get('left') or {}).get('name')
                 right_name = (pair.get('right') or {}).get('name')
                 display_name = left_name or right_name or pair_id
-                processing_tasks[task_id]['current_index'] = idx
-                processing_tasks[task_id]['current_id'] = pair_id
-                processing_tasks[task_id]['current_name'] = display_name
+                update_task(task, current_index=idx, current_id=pair_id, current_name=display_name)
                 
                 # 获取图片路径
                 left_path = pair.get('left', {}).get('path') if pair.get('left') else None
@@ -1722,52 +2495,45 @@ def tag_batch_pairs():
                 image_path = left_path or right_path
                 
                 if not image_path:
-                    processing_tasks[task_id]['failed'] += 1
-                    processing_tasks[task_id]['failed_ids'].append(pair_id)
-                    continue
-                
-                # 尝试处理，失败后自动重试1次
-                max_retries = 1
-                success = False
-                last_error = None
-                
-                for attempt in range(max_retries + 1):
-                    try:
-                        result = APIHandler.call_vision_api(
-                            image_path, system_prompt, user_prompt, api_key, base_url, model
-                        )
-                        pairs_data[pair_id]['text'] = result
-                        pairs_data[pair_id]['status'] = 'success'
-                        processing_tasks[task_id]['completed'] += 1
-                        success = True
-                        break
-                    except Exception as e:
-                        last_error = e
-                        error_str = str(e)
-                        # 如果是429错误（速率限制），等待后重试
-                        if '429' in error_str and attempt < max_retries:
-                            print(f"[重试] {pair_id} 遇到429限流，等待2秒后重试...")
-                            import time
-                            time.sleep(2)
-                        elif attempt < max_retries:
-                            print(f"[重试] {pair_id} 处理失败，尝试重试 ({attempt + 1}/{max_retries})...")
-                            import time
-                            time.sleep(2)
-                        else:
-                            break
+                    return False
+                return {"id": pair_id, "image_path": image_path}
+            
+            def finish_one(pair_id, result, error):
+                pair = pairs_data.get(pair_id)
+                if error is None:
+                    if pair is not None:
+                        pair['text'] = result
+                        pair['status'] = 'success'
+                    mark_item_completed(task, pair_id, result)
+                    return True
                 
-                if not success:
-                    print(f"Failed to process pair {pair_id}: {last_error}")
-                    pairs_data[pair_id]['status'] = 'error'
-                    pairs_data[pair_id]['error_message'] = str(last_error)
-                    processing_tasks[task_id]['failed'] += 1
-                    processing_tasks[task_id]['failed_ids'].append(pair_id)
+                print(f"Failed to process pair {pair_id}: {error}")
+                if pair is not None:
+                    pair['status'] = 'error'
+                    pair['error_message'] = str(error)
+                mark_item_failed(task, pair_id, error)
+                return False
+            
+            def finish_item(job, result, error):
+                # 反推一侧近似重复的图片组直接复用代表图片组的结果
+                for dup_id in followers.get(job['id'], ()):
+                    finish_one(dup_id, result, error)
+                return finish_one(job['id'], result, error)
+            
+            vision_args = {
+                "system_prompt": system_prompt,
+                "user_prompt": user_prompt,
+                "api_key": api_key,
+                "base_url": base_url,
+                "model": model,
+            }
+            def resolve_item(pair_id):
+                pair = pairs_data.get(pair_id)
+                image_path = _pair_vision_side(pair).get('path') if pair else None
+                return (image_path, None) if image_path else None
             
-            processing_tasks[task_id]['status'] = 'completed'
-            if processing_tasks[task_id]['cancel_requested']:
-                processing_tasks[task_id]['status'] = 'cancelled'
-            processing_tasks[task_id]['current_id'] = None
-            processing_tasks[task_id]['current_name'] = ""
+            _run_vision_batch(task, batch_ids, begin_item, finish_item, vision_args, max_workers, engine,
+                              bypass_cache, chain, pack_size, resolve_item)
         
         thread = threading.Thread(target=process_batch, daemon=True)
         thread.start()
@@ -1775,52 +2541,86 @@ def tag_batch_pairs():
         return jsonify({
             "success": True,
             "task_id": task_id,
-            "message": f"开始处理 {len(ids)} 组图片"
+            "message": f"开始处理 {len(ids)} 组图片（预计视觉token约 {estimate['total_tokens']}）"
+                       + _duplicates_note(task, '组'),
+            "estimate": {k: v for k, v in estimate.items() if k != 'items'}
         })
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
 
+def _resolve_translate_target(data, apikey_config):
+    """
+    确定翻译使用的渠道和模型
+
+    Returns:
+        tuple: (provider, api_key, base_url, model)
+    """
+    model_id = data.get('model_id', None)  # 可选的翻译模型ID
+    provider_key = data.get('provider', None)  # 可选的API厂商
+    
+    # 如果指定了厂商，使用指定的厂商；否则使用当前厂商
+    if provider_key and provider_key in apikey_config['providers']:
+        provider = provider_key
+    else:
+        provider = apikey_config['current_provider']
+    
+    api_key = apikey_config['providers'][provider]['api_key']
+    base_url = apikey_config['providers'][provider]['base_url']
+    
+    # 如果指定了翻译模型，使用指定的模型；否则使用默认翻译模型
+    if model_id:
+        model = model_id
+    else:
+        model = 'Qwen/Qwen2.5-7B-Instruct'  # 默认翻译模型
+    return provider, api_key, base_url, model
+
+
 @app.route('/api/translate', methods=['POST'])
 def translate_text():
-    """翻译文本"""
+    """翻译文本（先查询翻译记忆）"""
     try:
         data = request.get_json(silent=True) or {}
         text = data.get('text', '')
         target_lang = data.get('target_lang', None)  # 'en' 或 'zh'
-        model_id = data.get('model_id', None)  # 可选的翻译模型ID
-        provider_key = data.get('provider', None)  # 可选的API厂商
         
         # 调试日志：打印接收到的参数
-        print(f"[翻译API] 接收参数: model_id={model_id}, provider={provider_key}, target_lang={target_lang}")
+        print(f"[翻译API] 接收参数: model_id={data.get('model_id')}, provider={data.get('provider')}, target_lang={target_lang}")
         
         if not text:
             return jsonify({"success": False, "message": "请输入要翻译的文本"}), 400
         
         apikey_config = load_apikey_config()
-        
-        # 如果指定了厂商，使用指定的厂商；否则使用当前厂商
-        if provider_key and provider_key in apikey_config['providers']:
-            provider = provider_key
-        else:
-            provider = apikey_config['current_provider']
-        
-        api_key = apikey_config['providers'][provider]['api_key']
-        base_url = apikey_config['providers'][provider]['base_url']
-        
-        # 如果指定了翻译模型，使用指定的模型；否则使用默认翻译模型
-        if model_id:
-            model = model_id
-        else:
-            model = 'Qwen/Qwen2.5-7B-Instruct'  # 默认翻译模型
+        provider, api_key, base_url, model = _resolve_translate_target(data, apikey_config)
         
         print(f"[翻译API] 最终使用: model={model}, provider={provider}")
         
         if not api_key:
             return jsonify({"success": False, "message": f"请先配置 {provider} 的 API Key"}), 400
         
+        memory = get_translation_memory()
+        cached = memory.get(text, target_lang, model)
+        if cached is not None:
+            print(f"[翻译记忆] 命中 | 文本长度: {len(text)} | 模型: {model}")
+        
+        # 流式模式：逐段推送译文
+        if data.get('stream'):
+            if cached is not None:
+                return _sse_response(iter([cached]), lambda translated: {"translated": translated, "cached": True})
+            
+            def on_complete(translated):
+                memory.put(text, translated, target_lang, model)
+                return {"translated": translated}
+            
+            deltas = APIHandler.stream_translate(text, api_key, base_url, model, target_lang)
+            return _sse_response(deltas, on_complete)
+        
+        if cached is not None:
+            return jsonify({"success": True, "translated": cached, "cached": True})
+        
         # 使用API进行翻译
         translated = APIHandler.translate_text(text, api_key, base_url, model, target_lang)
+        memory.put(text, translated, target_lang, model)
         
         return jsonify({
             "success": True,
@@ -1830,12 +2630,182 @@ def translate_text():
         return jsonify({"success": False, "message": str(e)}), 500
 
 
+@app.route('/api/translate/batch', methods=['POST'])
+def translate_batch():
+    """
+    批量翻译：先查询翻译记忆，其余文本按 token 预算打包为少量请求，在后台任务中执行
+
+    请求体: {items: [{id, text}, ...], target_lang, model_id, provider, concurrency}
+    进度通过 /api/tasks/<task_id> 查询，结果通过 /api/translate/batch/<task_id> 获取
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        target_lang = data.get('target_lang', None)
+        items = [(item.get('id'), item.get('text') or '') for item in (data.get('items') or [])
+                 if isinstance(item, dict) and (item.get('text') or '').strip()]
+        
+        if not items:
+            return jsonify({"success": False, "message": "没有需要翻译的文本"}), 400
+        
+        apikey_config = load_apikey_config()
+        provider, api_key, base_url, model = _resolve_translate_target(data, apikey_config)
+        
+        if not api_key:
+            return jsonify({"success": False, "message": f"请先配置 {provider} 的 API Key"}), 400
+        
+        memory = get_translation_memory()
+        cached = memory.get_many([text for _, text in items], target_lang, model)
+        results = {item_id: cached[text] for item_id, text in items if text in cached}
+        
+        # 相同的原文只翻译一次，译文写回所有对应条目
+        ids_by_text = {}
+        for item_id, text in items:
+            if item_id not in results:
+                ids_by_text.setdefault(text, []).append(item_id)
+        texts = list(ids_by_text)
+        
+        task_id = str(uuid.uuid4())
+        processing_tasks[task_id] = {
+            "id": task_id,
+            "status": "processing" if texts else "completed",
+            "type": "translate",
+            "total": len(items),
+            "completed": len(results),
+            "failed": 0,
+            "cached": len(results),
+            "current_index": 0,
+            "current_id": None,
+            "current_name": "",
+            "cancel_requested": False,
+            "failed_ids": []
+        }
+        translation_results[task_id] = results
+        task = processing_tasks[task_id]
+        
+        batches = APIHandler.plan_translate_batches(texts)
+        print(f"[批量翻译] {len(items)} 条 | 翻译记忆命中: {len(results)} | 待翻译: {len(texts)} 段，"
+              f"分 {len(batches)} 次请求 | 模型: {model}")
+        
+        if not texts:
+            return jsonify({
+                "success": True,
+                "task_id": task_id,
+                "message": f"{len(items)} 条文本全部命中翻译记忆"
+            })
+        
+        provider_limit = APIHandler.get_max_concurrency(provider, apikey_config)
+        max_workers = _resolve_batch_workers(data, provider_limit)
+        configure_rate_limiter(APIHandler.resolve_provider(base_url),
+                               max_concurrency=provider_limit,
+                               max_rps=APIHandler.get_max_rps(provider, apikey_config))
+        
+        def process_batch():
+            cancelled = lambda: task.get('cancel_requested')
+            
+            def begin_item(idx, text_idx):
+                text = texts[text_idx]
+                item_id = ids_by_text[text][0]
+                update_task(task, current_index=idx, current_id=item_id, current_name=text[:40])
+                return {"id": item_id, "text": text}
+            
+            def call_group(group_job):
+                jobs = group_job['jobs']
+                translated = [None] * len(jobs)
+                if len(jobs) > 1:
+                    try:
+                        translated = retry_call(
+                            lambda: APIHandler.translate_batch([job['text'] for job in jobs], api_key, base_url,
+                                                               model, target_lang),
+                            group_job['id'], give_up=_is_pack_rejected, cancelled=cancelled)
+                    except Exception as e:
+                        if not _is_pack_rejected(e):
+                            raise
+                        print(f"[批量翻译] 渠道拒绝打包请求，改为逐条翻译: {str(e)[:100]}")
+                outcomes = []
+                for job, result in zip(jobs, translated):
+                    error = None
+                    if result is None:
+                        # 未能从打包结果中拆分出来的文本单独翻译
+                        try:
+                            result = retry_call(
+                                lambda: APIHandler.translate_text(job['text'], api_key, base_url, model, target_lang),
+                                job['id'], cancelled=cancelled)
+                        except Exception as e:
+                            error = e
+                    outcomes.append((job, result, error))
+                memory.put_many({job['text']: result for job, result, error in outcomes if error is None},
+                                target_lang, model)
+                return outcomes
+            
+            def finish_item(job, result, error):
+                item_ids = ids_by_text[job['text']]
+                if error is None:
+                    for item_id in item_ids:
+                        results[item_id] = result
+                        mark_item_completed(task, item_id, result)
+                    return True
+                
+                print(f"[批量翻译] 翻译失败 {job['id']}: {error}")
+                for item_id in item_ids:
+                    mark_item_failed(task, item_id, error)
+                return False
+            
+            begin_group, finish_group = packed_callbacks(task, begin_item, finish_item)
+            groups = [(batch[0] + 1, batch) for batch in batches]
+            # 批量翻译不急于完成，排队时让出给交互请求和批量反推
+            run_batch(task, groups, begin_group, call_group, finish_group, max_workers,
+                      priority=scheduler.PRIORITY_BACKGROUND)
+            print(f"[批量翻译] 任务结束 | 成功: {task['completed']} | 失败: {task['failed']}")
+        
+        thread = threading.Thread(target=process_batch, daemon=True)
+        thread.start()
+        
+        return jsonify({
+            "success": True,
+            "task_id": task_id,
+            "message": f"开始翻译 {len(items)} 条文本（翻译记忆命中 {len(results)} 条，"
+                       f"其余分 {len(batches)} 次请求）"
+        })
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)}), 500
+
+
+@app.route('/api/translate/batch/<task_id>', methods=['GET'])
+def get_translate_batch_results(task_id):
+    """获取批量翻译任务的状态和已完成的译文"""
+    if task_id not in translation_results:
+        return jsonify({"success": False, "message": "任务不存在"}), 404
+    
+    return jsonify({
+        "success": True,
+        "task": processing_tasks.get(task_id),
+        "results": translation_results[task_id]
+    })
+
+
+@app.route('/api/translation-memory', methods=['GET'])
+def get_translation_memory_stats():
+    """获取翻译记忆统计"""
+    return jsonify({
+        "success": True,
+        "memory": get_translation_memory().stats()
+    })
+
+
+@app.route('/api/translation-memory/clear', methods=['POST'])
+def clear_translation_memory():
+    """清空翻译记忆"""
+    get_translation_memory().clear()
+    return jsonify({"success": True, "message": "翻译记忆已清空"})
+
+
 @app.route('/api/images', methods=['GET'])
 def get_images():
-    """获取所有图片"""
+    """获取所有图片（thumbnail_task_ids 为正在生成缩略图的后台任务，前端订阅后逐张显示）"""
     return jsonify({
         "success": True,
-        "images": list(images_data.values())
+        "images": list(images_data.values()),
+        "thumbnail_task_ids": _running_thumbnail_tasks('images')
     })
 
 
@@ -1928,9 +2898,47 @@ def tag_single_image(img_id):
         # 获取裁剪参数（如果有）
         crop_params = images_data[img_id].get('crop_params')
         
-        result = APIHandler.call_vision_api(
-            image_path, system_prompt, user_prompt, api_key, base_url, model, crop_params
-        )
+        vision_args = {"system_prompt": system_prompt, "user_prompt": user_prompt,
+                       "api_key": api_key, "base_url": base_url, "model": model}
+        cache_key, result = _lookup_caption_cache(image_path, crop_params, vision_args, bool(data.get('bypass_cache')))
+
+        # 流式模式：逐段推送描述文本，结束后再写回 images_data
+        if data.get('stream'):
+            cached = result is not None
+            if cached:
+                deltas = iter([result])
+            else:
+                deltas = APIHandler.stream_vision_api(
+                    image_path, system_prompt, user_prompt, api_key, base_url, model, crop_params
+                )
+            previous_status = images_data[img_id].get('status', 'idle')
+            images_data[img_id]['status'] = 'processing'
+
+            def on_complete(text):
+                if not cached:
+                    get_caption_cache().put(cache_key, text)
+                img = images_data.get(img_id)
+                if img is not None:
+                    img['text'] = text
+                    img['status'] = 'success'
+                return {"text": text, "image": img}
+
+            def on_error(error):
+                img = images_data.get(img_id)
+                if img is not None:
+                    img['status'] = 'error'
+
+            def on_abort():
+                img = images_data.get(img_id)
+                if img is not None and img.get('status') == 'processing':
+                    img['status'] = previous_status
+
+            return _sse_response(deltas, on_complete, on_error, on_abort)
+
+        if result is None:
+            chain = _build_failover_chain(apikey_config, model, data)
+            result = _call_vision_api(image_path, crop_params, vision_args, chain)
+            get_caption_cache().put(cache_key, result)
         
         images_data[img_id]['text'] = result
         images_data[img_id]['status'] = 'success'
@@ -1947,6 +2955,190 @@ def tag_single_image(img_id):
         return jsonify({"success": False, "message": str(e)}), 500
 
 
+# 批量任务中需要持久化、恢复时复用的请求参数
+BATCH_OPTION_KEYS = ('concurrency', 'engine', 'bypass_cache', 'pack_size', 'failover', 'dedup')
+
+
+def _start_image_tag_batch(task_id, ids, data, apikey_config, provider, model, system_prompt, user_prompt):
+    """
+    在后台线程中执行图片批量反推（新建任务和启动时恢复任务共用）
+
+    Args:
+        task_id: processing_tasks 中已创建的任务ID
+        ids: 待处理的图片ID列表
+        data: 批量参数（concurrency / engine / bypass_cache / pack_size / failover / dedup）
+        apikey_config: API Key 配置
+        provider: 渠道
+        model: 模型
+        system_prompt, user_prompt: 提示词
+
+    Returns:
+        dict: 视觉 token 估算（_estimate_vision_tokens 的返回值）
+    """
+    task = processing_tasks[task_id]
+    store = get_job_store()
+    api_key = apikey_config['providers'][provider]['api_key']
+    base_url = apikey_config['providers'][provider]['base_url']
+    provider_limit = APIHandler.get_max_concurrency(provider, apikey_config)
+    max_workers = _resolve_batch_workers(data, provider_limit)
+    # 限流器按请求 URL 识别渠道，这里使用同样的标识，保证配置作用到实际使用的限流器
+    configure_rate_limiter(APIHandler.resolve_provider(base_url),
+                           max_concurrency=provider_limit,
+                           max_rps=APIHandler.get_max_rps(provider, apikey_config))
+    engine = _resolve_batch_engine(data, apikey_config)
+    task['engine'] = engine
+    bypass_cache = bool(data.get('bypass_cache'))
+    chain = _build_failover_chain(apikey_config, model, data)
+    pack_size = _resolve_pack_size(data, apikey_config)
+    task['pack_size'] = pack_size
+    planned_ids, followers = _plan_batch_duplicates(task, ids, data, _image_dedup_entry)
+    # dedup=skip 跳过的图片在任务存储中标记为已跳过，中断后恢复时不再处理
+    handled = set(planned_ids).union(*followers.values())
+    store.set_items_state(task_id, [i for i in ids if i not in handled], ITEM_SKIPPED)
+    ids = planned_ids
+    estimate = _estimate_vision_tokens([images_data[i] for i in ids if i in images_data], model)
+    task['estimated_tokens'] = estimate['total_tokens']
+    print(f"[视觉预算] {estimate['images']} 张图片 | 档位: {estimate['detail']} | "
+          f"预计视觉token: {estimate['total_tokens']}（平均 {estimate['avg_tokens']}）")
+
+    def begin_item(idx, img_id):
+        if img_id not in images_data:
+            return None
+        
+        images_data[img_id]['status'] = 'processing'
+        update_task(task, current_index=idx, current_id=img_id,
+                    current_name=images_data[img_id].get('name') or img_id)
+        store.set_item_state(task_id, img_id, ITEM_IN_FLIGHT)
+        # 获取裁剪参数（如果有）
+        return {
+            "id": img_id,
+            "image_path": images_data[img_id]['path'],
+            "crop_params": images_data[img_id].get('crop_params')
+        }
+    
+    def finish_one(img_id, result, error):
+        img = images_data.get(img_id)
+        if error is None:
+            if img is not None:
+                img['text'] = result
+                img['status'] = 'success'
+            # 结果立即写入任务存储，中断后恢复时不再请求 API
+            store.set_item_state(task_id, img_id, ITEM_DONE, result=result)
+            mark_item_completed(task, img_id, result)
+            return True
+        
+        print(f"Failed to process {img_id}: {error}")
+        if img is not None:
+            img['status'] = 'error'
+            img['error_message'] = str(error)
+        store.set_item_state(task_id, img_id, ITEM_FAILED, error=error)
+        mark_item_failed(task, img_id, error)
+        return False
+
+    def finish_item(job, result, error):
+        # 与代表图片近似重复的图片直接复用其结果
+        for dup_id in followers.get(job['id'], ()):
+            finish_one(dup_id, result, error)
+        return finish_one(job['id'], result, error)
+
+    def resolve_item(img_id):
+        img = images_data.get(img_id)
+        return (img['path'], img.get('crop_params')) if img else None
+
+    def process_batch():
+        vision_args = {
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt,
+            "api_key": api_key,
+            "base_url": base_url,
+            "model": model,
+        }
+        try:
+            _run_vision_batch(task, ids, begin_item, finish_item, vision_args, max_workers, engine,
+                              bypass_cache, chain, pack_size, resolve_item)
+        finally:
+            store.finish_job(task_id, task['status'])
+    
+    thread = threading.Thread(target=process_batch, daemon=True)
+    thread.start()
+    return estimate
+
+
+def _resume_unfinished_jobs():
+    """启动时恢复上次中断的图片批量反推任务（已完成的条目直接写回结果，只请求未完成的条目）"""
+    store = get_job_store()
+    jobs = store.unfinished_jobs()
+    if not jobs:
+        return
+    apikey_config = load_apikey_config()
+    thumbnail_entries = []
+    for job in jobs:
+        task_id = job['task_id']
+        params = job['params']
+        if job['type'] != 'images' or not store.auto_resume:
+            store.finish_job(task_id, 'interrupted')
+            continue
+
+        # 恢复图片列表（保留原图片ID）和已完成的结果；缩略图由后台任务生成，不阻塞启动
+        pending_ids = []
+        failed_ids = []
+        completed = 0
+        skipped = 0
+        for item in job['items']:
+            img_id = item['item_id']
+            if img_id not in images_data:
+                img_info = (ImageProcessor.load_image_with_txt(item['image_path'], with_thumbnail=False)
+                            if item['image_path'] else None)
+                if not img_info:
+                    store.set_item_state(task_id, img_id, ITEM_FAILED, error="图片文件不存在")
+                    failed_ids.append(img_id)
+                    continue
+                img_info['id'] = img_id
+                if item['crop_params']:
+                    img_info['crop_params'] = item['crop_params']
+                images_data[img_id] = img_info
+                thumbnail_entries.append((img_id, None, img_info))
+            img = images_data[img_id]
+            if item['state'] == ITEM_SKIPPED:
+                skipped += 1
+            elif item['state'] == ITEM_DONE:
+                img['text'] = item['result'] or ''
+                img['status'] = 'success'
+                completed += 1
+            elif item['state'] == ITEM_FAILED:
+                img['status'] = 'error'
+                failed_ids.append(img_id)
+            else:
+                pending_ids.append(img_id)
+
+        provider = params.get('provider')
+        provider_cfg = (apikey_config.get('providers') or {}).get(provider) or {}
+        if not pending_ids or not provider_cfg.get('api_key'):
+            status = 'completed' if not pending_ids else 'interrupted'
+            store.finish_job(task_id, status)
+            print(f"[任务恢复] {task_id[:8]} 已恢复 {completed} 条结果 | 未完成 {len(pending_ids)} 条 | 状态: {status}")
+            continue
+
+        processing_tasks[task_id] = {
+            "id": task_id,
+            "status": "processing",
+            "type": "images",
+            "total": len(job['items']) - skipped,
+            "completed": completed,
+            "failed": len(failed_ids),
+            "current_index": 0,
+            "current_id": None,
+            "current_name": "",
+            "cancel_requested": False,
+            "failed_ids": failed_ids,
+            "resumed": True,
+        }
+        print(f"[任务恢复] {task_id[:8]} 已恢复 {completed} 条结果 | 继续处理剩余 {len(pending_ids)} 张图片")
+        _start_image_tag_batch(task_id, pending_ids, params.get('options') or {}, apikey_config, provider,
+                               params.get('model'), params.get('system_prompt'), params.get('user_prompt'))
+    _start_thumbnail_task(thumbnail_entries)
+
+
 @app.route('/api/images/tag', methods=['POST'])
 def tag_batch_images():
     """批量打标"""
@@ -1967,6 +3159,7 @@ def tag_batch_images():
         
         task_id = str(uuid.uuid4())
         processing_tasks[task_id] = {
+            "id": task_id,
             "status": "processing",
             "type": "images",
             "total": len(ids),
@@ -1979,75 +3172,24 @@ def tag_batch_images():
             "failed_ids": []  # 记录失败的图片ID
         }
         
-        def process_batch():
-            base_url = apikey_config['providers'][provider]['base_url']
-            model = apikey_config.get('model', 'Qwen/Qwen2.5-VL-72B-Instruct')
-            system_prompt, user_prompt = _get_selected_prompts(config, 'tagging')
-            
-            for idx, img_id in enumerate(ids, start=1):
-                if processing_tasks.get(task_id, {}).get('cancel_requested'):
-                    processing_tasks[task_id]['status'] = 'cancelled'
-                    break
-                if img_id not in images_data:
-                    continue
-                
-                images_data[img_id]['status'] = 'processing'
-                processing_tasks[task_id]['current_index'] = idx
-                processing_tasks[task_id]['current_id'] = img_id
-                processing_tasks[task_id]['current_name'] = images_data[img_id].get('name') or img_id
-                
-                # 尝试处理，失败后自动重试1次
-                max_retries = 1
-                success = False
-                last_error = None
-                
-                for attempt in range(max_retries + 1):
-                    try:
-                        # 获取裁剪参数（如果有）
-                        crop_params = images_data[img_id].get('crop_params')
-                        result = APIHandler.call_vision_api(
-                            images_data[img_id]['path'],
-                            system_prompt, user_prompt, api_key, base_url, model, crop_params
-                        )
-                        images_data[img_id]['text'] = result
-                        images_data[img_id]['status'] = 'success'
-                        processing_tasks[task_id]['completed'] += 1
-                        success = True
-                        break
-                    except Exception as e:
-                        last_error = e
-                        error_str = str(e)
-                        # 如果是429错误（速率限制），等待后重试
-                        if '429' in error_str and attempt < max_retries:
-                            print(f"[重试] {img_id} 遇到429限流，等待2秒后重试...")
-                            import time
-                            time.sleep(2)
-                        elif attempt < max_retries:
-                            print(f"[重试] {img_id} 处理失败，尝试重试 ({attempt + 1}/{max_retries})...")
-                            import time
-                            time.sleep(2)
-                        else:
-                            break
-                
-                if not success:
-                    print(f"Failed to process {img_id}: {last_error}")
-                    images_data[img_id]['status'] = 'error'
-                    images_data[img_id]['error_message'] = str(last_error)
-                    processing_tasks[task_id]['failed'] += 1
-                    processing_tasks[task_id]['failed_ids'].append(img_id)
-            
-            if not processing_tasks.get(task_id, {}).get('cancel_requested') and processing_tasks.get(task_id, {}).get('status') != 'cancelled':
-                processing_tasks[task_id]['status'] = 'completed'
-            processing_tasks[task_id]['current_id'] = None
-            processing_tasks[task_id]['current_name'] = ""
-        
-        thread = threading.Thread(target=process_batch, daemon=True)
-        thread.start()
+        model = apikey_config.get('model', 'Qwen/Qwen2.5-VL-72B-Instruct')
+        system_prompt, user_prompt = _get_selected_prompts(config, 'tagging')
+        # 持久化任务（不含 API Key），程序中断后可在启动时恢复
+        get_job_store().create_job(
+            task_id, 'images',
+            [(i, images_data[i]['path'], images_data[i].get('crop_params')) for i in ids if i in images_data],
+            {"provider": provider, "model": model, "system_prompt": system_prompt, "user_prompt": user_prompt,
+             "options": {key: data[key] for key in BATCH_OPTION_KEYS if key in data}}
+        )
+        estimate = _start_image_tag_batch(task_id, ids, data, apikey_config, provider, model,
+                                          system_prompt, user_prompt)
         
         return jsonify({
             "success": True,
             "task_id": task_id,
-            "message": f"开始处理 {len(ids)} 张图片"
+            "message": f"开始处理 {len(ids)} 张图片（预计视觉token约 {estimate['total_tokens']}）"
+                       + _duplicates_note(processing_tasks[task_id], '张'),
+            "estimate": {k: v for k, v in estimate.items() if k != 'items'}
         })
     except Exception as e:
         print(f"tag_batch_images failed: {e}")
@@ -2055,18 +3197,116 @@ def tag_batch_images():
         return jsonify({"success": False, "message": str(e)}), 500
 
 
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """获取最近的持久化批量任务及各状态条目数"""
+    store = get_job_store()
+    return jsonify({
+        "success": True,
+        "enabled": store.enabled,
+        "jobs": store.list_jobs()
+    })
+
+
+def _parse_event_seq(value):
+    """解析客户端传入的事件序号（since 参数或 Last-Event-ID），无效时返回 None"""
+    try:
+        return max(0, int(value)) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
 @app.route('/api/tasks/<task_id>', methods=['GET'])
 def get_task_status(task_id):
-    """获取任务状态"""
+    """
+    获取任务状态
+
+    带 since=序号 时只返回进度快照和此后的事件（增量查询）；
+    truncated 为 true 表示部分事件已被挤出事件日志，需要不带 since 重新拉取完整状态
+    """
     if task_id not in processing_tasks:
         return jsonify({"success": False, "message": "任务不存在"}), 404
     
+    task = processing_tasks[task_id]
+    since = _parse_event_seq(request.args.get('since'))
+    if since is None:
+        return jsonify({
+            "success": True,
+            "task": task,
+            "seq": task_events.latest_seq(task_id)
+        })
+    
+    events, seq, truncated = task_events.events_since(task_id, since)
     return jsonify({
         "success": True,
-        "task": processing_tasks[task_id]
+        "task": task_events.progress_snapshot(task),
+        "events": [{"seq": event_seq, "event": name, "data": data} for event_seq, name, data in events],
+        "seq": seq,
+        "truncated": truncated
     })
 
 
+@app.route('/api/tasks/<task_id>/events', methods=['GET'])
+def stream_task_events(task_id):
+    """
+    以 Server-Sent Events 推送任务进度
+
+    事件格式：
+        event: progress  data: {status, total, completed, failed, current_name, ...}   任务进度
+        event: item      data: {id, status, text?, error?}                            单个条目完成
+        event: resync    data: {}                                                     事件积压被丢弃，客户端需重新拉取
+    每条事件带有序号（id），断线重连时浏览器通过 Last-Event-ID（或 since 参数）补发遗漏的事件；
+    未指定序号时先推送一次当前进度。任务结束（completed / cancelled）后关闭连接
+    """
+    if task_id not in processing_tasks:
+        return jsonify({"success": False, "message": "任务不存在"}), 404
+
+    task = processing_tasks[task_id]
+    since = _parse_event_seq(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    # 订阅与读取补发事件在同一把锁内完成，两者之间不会遗漏或重复事件
+    subscription, backlog, truncated = task_events.subscribe(task_id, since)
+
+    def generate():
+        try:
+            if since is None or truncated:
+                if truncated:
+                    yield _sse_event({}, task_events.EVENT_RESYNC)
+                snapshot = task_events.progress_snapshot(task)
+                yield _sse_event(snapshot, task_events.EVENT_PROGRESS)
+                if snapshot.get('status') in task_events.FINISHED_STATUSES:
+                    return
+            else:
+                for event_seq, name, data in backlog:
+                    yield _sse_event(data, name, event_seq)
+                if task.get('status') in task_events.FINISHED_STATUSES:
+                    # 任务已结束：补发的事件中没有结束进度时（已发送过或尚未记录）补一条当前进度后关闭
+                    if not any(name == task_events.EVENT_PROGRESS and data.get('status') in task_events.FINISHED_STATUSES
+                               for _, name, data in backlog):
+                        yield _sse_event(task_events.progress_snapshot(task), task_events.EVENT_PROGRESS)
+                    return
+            while True:
+                event = subscription.get(timeout=TASK_EVENT_KEEPALIVE)
+                if event is None:
+                    # 保活注释行，防止代理或浏览器断开空闲连接
+                    yield ": keepalive\n\n"
+                    continue
+                event_seq, name, data = event
+                yield _sse_event(data, name, event_seq)
+                if name == task_events.EVENT_RESYNC:
+                    # 积压的事件（可能包括结束进度）已被丢弃：补发当前进度，任务已结束时关闭连接
+                    snapshot = task_events.progress_snapshot(task)
+                    yield _sse_event(snapshot, task_events.EVENT_PROGRESS)
+                    if snapshot.get('status') in task_events.FINISHED_STATUSES:
+                        return
+                elif name == task_events.EVENT_PROGRESS and data.get('status') in task_events.FINISHED_STATUSES:
+                    return
+        finally:
+            task_events.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.route('/api/tasks/<task_id>/cancel', methods=['POST'])
 def cancel_task(task_id):
     """取消任务"""
@@ -2081,6 +3321,185 @@ def cancel_task(task_id):
     return jsonify({"success": True, "message": "已请求取消"})
 
 
+@app.route('/api/rate-limits', methods=['GET'])
+def get_rate_limits():
+    """获取各渠道自适应限流器状态、各优先级请求的排队时间及各类错误的重试统计"""
+    return jsonify({
+        "success": True,
+        "limiters": get_all_limiter_stats(),
+        "queue_wait": scheduler.get_stats(),
+        "retries": retry_policy.get_stats()
+    })
+
+
+def _collect_runtime_metrics():
+    """抓取 /api/metrics 时采集任务、限流器和重试状态"""
+    # 后台任务（缩略图生成）不计入批量任务
+    active = [task for task in list(processing_tasks.values())
+              if task.get('status') == 'processing' and not task.get('background')]
+    limiters = get_all_limiter_stats()
+    retries = retry_policy.get_stats()
+    registry = processing_tasks.stats()
+    return [
+        ('pandy_batch_tasks_active', 'gauge', '正在运行的批量任务数', [({}, len(active))]),
+        ('pandy_batch_in_flight', 'gauge', '批量任务的在途请求数',
+         [({}, sum(task.get('in_flight', 0) for task in active))]),
+        ('pandy_provider_in_flight', 'gauge', '各渠道的在途请求数',
+         [({'provider': item['provider']}, item['in_flight']) for item in limiters]),
+        ('pandy_provider_concurrency_limit', 'gauge', '各渠道限流器当前的并发窗口',
+         [({'provider': item['provider']}, item['concurrency_limit']) for item in limiters]),
+        ('pandy_provider_rate_per_second', 'gauge', '各渠道限流器当前的每秒请求上限',
+         [({'provider': item['provider']}, item['rate_per_second']) for item in limiters]),
+        ('pandy_retries_total', 'counter', '按错误类别统计的重试次数',
+         [({'category': category}, count) for category, count in retries['retries'].items()]),
+        ('pandy_retry_gave_up_total', 'counter', '按错误类别统计的放弃重试次数',
+         [({'category': category}, count) for category, count in retries['gave_up'].items()]),
+        ('pandy_task_event_subscribers', 'gauge', '任务进度推送（SSE）的连接数', [({}, task_events.subscriber_count())]),
+        ('pandy_tasks_registered', 'gauge', '任务注册表中的任务数',
+         [({'state': 'running'}, registry['running']), ({'state': 'finished'}, registry['finished'])]),
+        ('pandy_tasks_evicted_total', 'counter', '已淘汰的结束任务数', [({}, registry['evicted'])]),
+    ] + get_usage_ledger().metric_families()
+
+
+metrics.register_collector(_collect_runtime_metrics)
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """以 Prometheus 文本格式输出各阶段耗时直方图、请求结果、批量吞吐与在途请求数"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/api/usage', methods=['GET'])
+def get_usage():
+    """获取用量账本（最近 days 天，按天 + 渠道 + 模型）、启动以来的累计用量与实时吞吐"""
+    try:
+        days = max(1, min(int(request.args.get('days', 30)), 3650))
+    except (TypeError, ValueError):
+        days = 30
+    ledger = get_usage_ledger()
+    return jsonify({
+        "success": True,
+        "days": days,
+        "ledger": ledger.query(days),
+        **ledger.live()
+    })
+
+
+@app.route('/api/providers/health', methods=['GET'])
+def get_provider_health():
+    """获取各渠道故障转移统计（成功/失败次数、耗时分位数、健康状态）"""
+    return jsonify({
+        "success": True,
+        **get_provider_router().stats()
+    })
+
+
+@app.route('/api/vision-budget', methods=['GET'])
+def get_vision_budget():
+    """获取视觉输入预算配置与各模型系列的 token 规则"""
+    return jsonify({
+        "success": True,
+        **vision_budget.describe()
+    })
+
+
+@app.route('/api/vision-budget/estimate', methods=['POST'])
+def estimate_vision_budget():
+    """批量反推前估算所选图片的视觉 token（type 为 images 或 pairs，model 为空时使用当前模型）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        ids = data.get('ids', [])
+        model = data.get('model') or load_apikey_config().get('model', 'Qwen/Qwen2.5-VL-72B-Instruct')
+        if data.get('type') == 'pairs':
+            infos = [dict(_pair_vision_side(pairs_data[i]), id=i) for i in ids if i in pairs_data]
+        else:
+            infos = [images_data[i] for i in ids if i in images_data]
+        return jsonify({
+            "success": True,
+            "estimate": _estimate_vision_tokens(infos, model)
+        })
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)}), 500
+
+
+@app.route('/api/caption-cache', methods=['GET'])
+def get_caption_cache_stats():
+    """获取反推结果缓存统计"""
+    return jsonify({
+        "success": True,
+        "cache": get_caption_cache().stats()
+    })
+
+
+@app.route('/api/caption-cache/clear', methods=['POST'])
+def clear_caption_cache():
+    """清空反推结果缓存"""
+    get_caption_cache().clear()
+    return jsonify({"success": True, "message": "反推结果缓存已清空"})
+
+
+@app.route('/api/payload-cache', methods=['GET'])
+def get_payload_cache_stats():
+    """获取请求图片缓存统计"""
+    return jsonify({
+        "success": True,
+        "cache": get_payload_cache().stats()
+    })
+
+
+@app.route('/api/payload-cache/clear', methods=['POST'])
+def clear_payload_cache():
+    """清空请求图片缓存"""
+    get_payload_cache().clear()
+    return jsonify({"success": True, "message": "请求图片缓存已清空"})
+
+
+# 缩略图地址中的缓存键随原图修改而变化，同一地址的内容不会改变，浏览器可长期缓存
+THUMBNAIL_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+
+@app.route('/api/thumbnails/<key>', methods=['GET'])
+def get_thumbnail(key):
+    """获取缩略图（支持 If-None-Match 条件请求）"""
+    if not re.fullmatch(r'[0-9a-f]{64}', key):
+        return jsonify({"success": False, "message": "缩略图不存在"}), 404
+    if key in request.if_none_match:
+        response = Response(status=304)
+    else:
+        result = get_thumbnail_cache().read(key)
+        if result is None:
+            return jsonify({"success": False, "message": "缩略图不存在"}), 404
+        data, mimetype = result
+        response = Response(data, mimetype=mimetype)
+    response.set_etag(key)
+    response.headers['Cache-Control'] = THUMBNAIL_CACHE_CONTROL
+    return response
+
+
+@app.route('/api/thumbnail-cache', methods=['GET'])
+def get_thumbnail_cache_stats():
+    """获取缩略图缓存统计"""
+    return jsonify({
+        "success": True,
+        "cache": get_thumbnail_cache().stats()
+    })
+
+
+@app.route('/api/thumbnail-cache/clear', methods=['POST'])
+def clear_thumbnail_cache():
+    """清空缩略图缓存（列表中的缩略图在下次显示时重新生成）"""
+    get_thumbnail_cache().clear()
+    return jsonify({"success": True, "message": "缩略图缓存已清空"})
+
+
+def _cache_crop_thumbnail(img_path, thumb_base64, crop_params):
+    """把裁剪后的缩略图写入缩略图缓存，返回其地址（缓存未启用时原样返回 Base64）"""
+    def regenerate():
+        return ImageProcessor.crop_image_to_base64(img_path, **crop_params)[0]
+    return get_thumbnail_cache().store_data_uri(thumb_base64, img_path, crop_params, regenerate)
+
+
 @app.route('/api/batch/rename', methods=['POST'])
 def batch_rename():
     """批量重命名"""
@@ -2204,6 +3623,8 @@ def batch_crop():
                     'target_width': target_width,
                     'target_height': target_height
                 }
+                # 裁剪后的缩略图写入缩略图缓存，图片信息中只保存地址
+                thumb_base64 = _cache_crop_thumbnail(img_path, thumb_base64, img['crop_params'])
                 # 更新显示用的缩略图（裁剪后的）
                 img['cropped_thumbnail'] = thumb_base64
                 # 保留原始缩略图用于重新裁剪
@@ -2409,6 +3830,8 @@ def batch_crop_individual():
                     'fill_background': fill_background,  # 保存是否填充背景
                     'background_color': background_color  # 保存背景颜色
                 }
+                # 裁剪后的缩略图写入缩略图缓存，图片信息中只保存地址
+                thumb_base64 = _cache_crop_thumbnail(img_path, thumb_base64, img['crop_params'])
                 # 更新显示用的缩略图（裁剪后的）
                 img['cropped_thumbnail'] = thumb_base64
                 # 保留原始缩略图用于重新裁剪
@@ -2478,7 +3901,7 @@ def batch_resize():
                     if ImageProcessor.resize_image_by_longest_edge(img_path, max_size, allow_upscale=True):
                         resized_count += 1
                         # 更新缩略图
-                        thumb = ImageProcessor.create_thumbnail(img_path)
+                        thumb = get_thumbnail_cache().thumbnail(img_path)
                         if thumb:
                             img['thumbnail'] = thumb
                         # 更新尺寸信息
@@ -2505,6 +3928,61 @@ def batch_resize():
         return jsonify({"success": False, "message": str(e)}), 500
 
 
+def _duplicate_clusters(kind, items, hash_of, max_distance, bits=image_dedup.HASH_BITS):
+    """
+    查找全部条目中的近似重复分组（全局索引按当前条目增量同步）
+
+    Args:
+        kind: 索引名称（'images' / 'pairs'）
+        items: {条目ID: 条目}
+        hash_of: hash_of(条目) -> 哈希或 None
+        max_distance: 最大汉明距离
+        bits: 哈希位数
+    """
+    start_time = time.time()
+    hashes = {}
+    for item_id, item in list(items.items()):
+        value = hash_of(item)
+        if value is not None:
+            hashes[item_id] = value
+    index = image_dedup.get_duplicate_index(kind, max_distance, bits)
+    index.sync(hashes)
+    clusters = index.clusters()
+    elapsed = round(time.time() - start_time, 3)
+    duplicates = sum(len(group) - 1 for group in clusters)
+    print(f"[近似重复] {len(hashes)} 项中找到 {len(clusters)} 组近似重复（{duplicates} 项重复）| 耗时 {elapsed}s")
+    return jsonify({
+        "success": True,
+        "clusters": [{"representative": group[0], "ids": group} for group in clusters],
+        "duplicates": duplicates,
+        "indexed": len(hashes),
+        "max_distance": max_distance,
+        "elapsed": elapsed
+    })
+
+
+@app.route('/api/images/duplicates', methods=['GET'])
+def find_duplicate_images():
+    """查找近似重复的图片（max_distance 参数可选，默认使用配置值）"""
+    try:
+        max_distance = image_dedup.resolve_distance(request.args.get('max_distance'))
+        return _duplicate_clusters('images', images_data, _ensure_dhash, max_distance)
+    except Exception as e:
+        print(traceback.format_exc())
+        return jsonify({"success": False, "message": str(e)}), 500
+
+
+@app.route('/api/pairs/duplicates', methods=['GET'])
+def find_duplicate_pairs():
+    """查找各侧图片都近似重复的成对图片组（max_distance 为每侧的阈值）"""
+    try:
+        max_distance, bits = _pair_dedup_args(image_dedup.resolve_distance(request.args.get('max_distance')))
+        return _duplicate_clusters('pairs', pairs_data, _pair_dhash, max_distance, bits)
+    except Exception as e:
+        print(traceback.format_exc())
+        return jsonify({"success": False, "message": str(e)}), 500
+
+
 @app.route('/api/export', methods=['POST'])
 def export_images():
     """导出单图数据集"""
@@ -2518,6 +3996,13 @@ def export_images():
         if not ids:
             return jsonify({"success": False, "message": "请选择要导出的图片"}), 400
         
+        # 可选：近似重复的图片只导出每组的第一张
+        skipped_duplicates = 0
+        if data.get('skip_duplicates'):
+            kept_ids, _ = _dedup_ids(ids, _image_dedup_entry, image_dedup.resolve_distance(data.get('max_distance')))
+            skipped_duplicates = len(ids) - len(kept_ids)
+            ids = kept_ids
+        
         # 确保格式正确
         if image_format not in ['png', 'jpg', 'jpeg']:
             image_format = 'png'
@@ -2715,10 +4200,12 @@ def export_images():
         
         return jsonify({
             "success": True,
-            "message": f"成功导出 {len(export_data)} 张图片",
+            "message": f"成功导出 {len(export_data)} 张图片"
+                       + (f"（跳过 {skipped_duplicates} 张近似重复）" if skipped_duplicates else ""),
             "file": result_path,
             "folder": export_folder,
-            "count": len(export_data)
+            "count": len(export_data),
+            "skipped_duplicates": skipped_duplicates
         })
         
     except Exception as e:
@@ -2744,22 +4231,27 @@ def select_folder():
                     image_paths.append(os.path.join(root, filename))
         
         added = 0
+        existing_paths = {img['path'] for img in images_data.values()}
+        thumbnail_entries = []
         for path in image_paths:
-            if any(img['path'] == path for img in images_data.values()):
+            if path in existing_paths:
                 continue
             
-            img_info = ImageProcessor.load_image_with_txt(path)
+            img_info = ImageProcessor.load_image_with_txt(path, with_thumbnail=False)
             if img_info:
                 img_id = str(uuid.uuid4())
                 img_info['id'] = img_id
                 images_data[img_id] = img_info
+                existing_paths.add(path)
+                thumbnail_entries.append((img_id, None, img_info))
                 added += 1
         
         return jsonify({
             "success": True,
             "added": added,
             "total": len(images_data),
-            "images": list(images_data.values())
+            "images": list(images_data.values()),
+            "thumbnail_task_id": _start_thumbnail_task(thumbnail_entries)
         })
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
@@ -3347,8 +4839,13 @@ def chat_message():
         print(f"[Chat] 模型: {text_model}")
         print(f"[Chat] Provider: {current_provider}")
         
+        # 流式模式：逐段推送回复，前端接收完后写入会话
+        if data.get('stream'):
+            deltas = APIHandler.stream_chat(url, headers, payload, 60, "Chat")
+            return _sse_response(deltas, lambda reply: {"reply": reply})
+        
         import requests
-        resp = requests.post(url, headers=headers, json=payload, timeout=60)
+        resp = APIHandler._post(url, headers, payload, timeout=60)
         print(f"[Chat] 响应状态: {resp.status_code}")
         print(f"[Chat] 响应内容: {resp.text[:500] if resp.text else '(empty)'}")
         try:
@@ -4382,6 +5879,12 @@ if __name__ == '__main__':
         webbrowser.open('http://localhost:5000')
         
     threading.Timer(1.5, open_browser).start()
+
+    # 初始化连接池并预热当前渠道
+    apikey_config = load_apikey_config()
+    apply_apikey_settings(apikey_config)
+    # 在后台恢复上次中断的批量任务
+    threading.Thread(target=_resume_unfinished_jobs, daemon=True).start()
     
     print(f"📍 访问地址: http://localhost:5000")
     print(f"📂 前端路径: {app.static_folder}")
@@ -0,0 +1,310 @@
+"""
+异步打标引擎 - 在独立事件循环线程中以协程方式执行批量反推
+需要 aiohttp；未安装时 AIOHTTP_AVAILABLE 为 False，批量任务回退到线程池引擎
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api_handler import APIHandler, APITimeoutError, APIConnectionError
+from batch_runner import task_lock, mark_item_failed, fail_unexpected, finalize_task, update_task, RETRY_POLL_INTERVAL
+from rate_limiter import parse_retry_after
+import http_pool
+import metrics
+import retry_policy
+import scheduler
+import usage_ledger
+
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    aiohttp = None
+    AIOHTTP_AVAILABLE = False
+
+
+def _connect_trace_config():
+    """记录新建连接耗时的 TraceConfig（写入请求的 trace_request_ctx）"""
+    async def on_start(session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx['connect_start'] = time.monotonic()
+
+    async def on_end(session, context, params):
+        ctx = context.trace_request_ctx
+        if ctx is not None and 'connect_start' in ctx:
+            ctx['connect'] = ctx.get('connect', 0.0) + time.monotonic() - ctx.pop('connect_start')
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_start)
+    trace_config.on_connection_create_end.append(on_end)
+    return trace_config
+
+
+class AsyncTaggingEngine:
+    """异步打标引擎（单例，事件循环在后台守护线程中运行）"""
+
+    def __init__(self, prepare_workers=4):
+        self._loop = None
+        self._thread = None
+        self._started = threading.Event()
+        self._lock = threading.Lock()
+        self._sessions = {}
+        # 图片解码/编码是 CPU 操作，放到线程池中执行，避免阻塞事件循环
+        self._prepare_pool = ThreadPoolExecutor(max_workers=prepare_workers, thread_name_prefix='async-prepare')
+        # 批量任务的 begin_item / finish_item 回调（写任务存储、缓存等阻塞操作）在此线程池中执行
+        self._callback_pool = ThreadPoolExecutor(max_workers=prepare_workers, thread_name_prefix='async-callback')
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+
+            def _run():
+                asyncio.set_event_loop(self._loop)
+                self._started.set()
+                self._loop.run_forever()
+
+            self._thread = threading.Thread(target=_run, name='async-tagging-loop', daemon=True)
+            self._thread.start()
+        self._started.wait()
+
+    def submit(self, coro):
+        """将协程提交到引擎事件循环，返回 concurrent.futures.Future"""
+        self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def _get_session(self, provider):
+        session = self._sessions.get(provider)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=http_pool.get_pool_size(), keepalive_timeout=60)
+            session = aiohttp.ClientSession(connector=connector, trace_configs=[_connect_trace_config()])
+            self._sessions[provider] = session
+        return session
+
+    async def _acquire(self, limiter, provider, model=None):
+        # 使用非阻塞方式获取限流许可，等待期间让出事件循环；按当前上下文的请求优先级排队
+        level = scheduler.current_level()
+        wait_start = time.monotonic()
+        wait_time = limiter.try_acquire(level)
+        if wait_time:
+            limiter.enter_queue(level)
+            try:
+                while wait_time:
+                    await asyncio.sleep(wait_time)
+                    wait_time = limiter.try_acquire(level)
+            finally:
+                limiter.leave_queue(level)
+        wait_time = time.monotonic() - wait_start
+        scheduler.record_wait(provider, wait_time)
+        metrics.observe_request_stage('queue_wait', provider, model, wait_time)
+
+    async def post_json(self, url, headers, payload, timeout):
+        """
+        异步发送 POST 请求（经过渠道自适应限流器）
+
+        Returns:
+            tuple: (status_code, resp_json, headers)
+        """
+        provider = APIHandler.resolve_provider(url)
+        limiter = APIHandler._get_limiter(url)
+        session = self._get_session(provider)
+        connect_timeout, read_timeout = http_pool.get_timeout(timeout)
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+
+        model = payload.get('model')
+        await self._acquire(limiter, provider, model)
+        status_code = None
+        retry_after = None
+        outcome = 'error'
+        trace_ctx = {}
+        request_start = time.monotonic()
+        try:
+            async with session.post(url, headers=headers, json=payload, timeout=client_timeout,
+                                    trace_request_ctx=trace_ctx) as resp:
+                status_code = resp.status
+                retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+                outcome = metrics.outcome_label(status_code)
+                if trace_ctx.get('connect'):
+                    metrics.observe_request_stage('connect', provider, model, trace_ctx['connect'])
+                metrics.observe_request_stage('ttfb', provider, model, time.monotonic() - request_start)
+                try:
+                    resp_json = await resp.json(content_type=None)
+                except ValueError:
+                    resp_json = {"message": (await resp.text())[:500]}
+                return status_code, resp_json, dict(resp.headers)
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            raise
+        except aiohttp.ClientError:
+            outcome = 'connection_error'
+            raise
+        finally:
+            limiter.release(status_code, retry_after)
+            metrics.count_request(provider, model, outcome)
+
+    async def call_vision_api(self, image_path, system_prompt, user_prompt, api_key, base_url, model, crop_params=None):
+        """异步版 APIHandler.call_vision_api，返回描述文本"""
+        total_start_time = time.time()
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(self._prepare_pool, APIHandler.prepare_image, image_path, crop_params, model)
+
+        url, headers, payload = APIHandler.build_vision_request(
+            base_url, api_key, model, system_prompt, user_prompt, prepared['data_url']
+        )
+        print(f"[异步请求] 开始请求 | 模型: {model} | URL: {url}")
+        api_start_time = time.time()
+        try:
+            status_code, resp_json, resp_headers = await self.post_json(url, headers, payload, timeout=120)
+        except asyncio.TimeoutError:
+            api_elapsed = time.time() - api_start_time
+            print(f"[超时错误] ⏱️ API请求超时 | 已等待: {api_elapsed:.2f}s | 超时限制: 120s")
+            raise APITimeoutError(f"API请求超时 (已等待 {api_elapsed:.1f}s)，请检查网络或稍后重试")
+        except aiohttp.ClientConnectionError as e:
+            api_elapsed = time.time() - api_start_time
+            print(f"[连接错误] 🔌 网络连接失败 | 已等待: {api_elapsed:.2f}s | 错误: {str(e)[:100]}")
+            raise APIConnectionError(f"网络连接失败 (耗时 {api_elapsed:.1f}s)，请检查网络连接")
+        except aiohttp.ClientError as e:
+            api_elapsed = time.time() - api_start_time
+            print(f"[网络错误] 🔌 请求异常 | 已等待: {api_elapsed:.2f}s | 错误: {str(e)[:100]}")
+            raise APIConnectionError(f"网络请求错误 (耗时 {api_elapsed:.1f}s): {str(e)}")
+
+        api_elapsed = time.time() - api_start_time
+        total_elapsed = time.time() - total_start_time
+        print(f"[异步响应] 状态码: {status_code} | API耗时: {api_elapsed:.2f}s | 总耗时: {total_elapsed:.2f}s")
+        metrics.observe_request_stage('total', APIHandler.resolve_provider(url), model, total_elapsed)
+        resp_json = APIHandler.check_response(status_code, resp_json, resp_headers, "API错误")
+        usage_ledger.record(APIHandler.resolve_provider(url), model, resp_json.get('usage'), 'vision', images=1)
+        return APIHandler.extract_content(resp_json, "API", total_elapsed)
+
+    async def call_packed_vision_api(self, items, system_prompt, user_prompt, api_key, base_url, model):
+        """异步版 APIHandler.call_packed_vision_api，返回每张图片的描述（解析失败为 None）"""
+        total_start_time = time.time()
+        loop = asyncio.get_running_loop()
+        prepared = await asyncio.gather(*[
+            loop.run_in_executor(self._prepare_pool, APIHandler.prepare_image, image_path, crop_params, model)
+            for image_path, crop_params in items
+        ])
+        url, headers, payload = APIHandler.build_packed_vision_request(
+            base_url, api_key, model, system_prompt, user_prompt, [p['data_url'] for p in prepared]
+        )
+        timeout = 120 + 30 * (len(items) - 1)
+        print(f"[异步打包请求] 开始请求 | 图片数: {len(items)} | 模型: {model} | URL: {url}")
+        api_start_time = time.time()
+        try:
+            status_code, resp_json, resp_headers = await self.post_json(url, headers, payload, timeout=timeout)
+        except asyncio.TimeoutError:
+            api_elapsed = time.time() - api_start_time
+            print(f"[超时错误] ⏱️ 打包请求超时 | 已等待: {api_elapsed:.2f}s | 超时限制: {timeout}s")
+            raise APITimeoutError(f"API请求超时 (已等待 {api_elapsed:.1f}s)，请检查网络或稍后重试")
+        except aiohttp.ClientError as e:
+            api_elapsed = time.time() - api_start_time
+            print(f"[网络错误] 🔌 打包请求异常 | 已等待: {api_elapsed:.2f}s | 错误: {str(e)[:100]}")
+            raise APIConnectionError(f"网络请求错误 (耗时 {api_elapsed:.1f}s): {str(e)}")
+
+        total_elapsed = time.time() - total_start_time
+        print(f"[异步打包响应] 状态码: {status_code} | API耗时: {time.time() - api_start_time:.2f}s | 总耗时: {total_elapsed:.2f}s")
+        metrics.observe_request_stage('total', APIHandler.resolve_provider(url), model, total_elapsed)
+        resp_json = APIHandler.check_response(status_code, resp_json, resp_headers, "打包请求错误")
+        usage_ledger.record(APIHandler.resolve_provider(url), model, resp_json.get('usage'), 'vision', images=len(items))
+        content = APIHandler.extract_content(resp_json, "打包请求", total_elapsed)
+        results = APIHandler.parse_packed_response(content, len(items))
+        print(f"[打包解析] 成功拆分 {sum(1 for r in results if r is not None)}/{len(items)} 张图片的结果")
+        return results
+
+    async def retry_call(self, coro_fn, label, give_up=None, cancelled=None):
+        """异步版 batch_runner.retry_call"""
+        state = retry_policy.RetryState(label)
+        while True:
+            try:
+                result = await coro_fn()
+            except Exception as e:
+                if give_up is not None and give_up(e):
+                    raise
+                delay = state.next_delay(e)
+                if delay is None:
+                    raise
+                wake_time = time.monotonic() + delay
+                while time.monotonic() < wake_time:
+                    if cancelled is not None and cancelled():
+                        raise
+                    await asyncio.sleep(min(RETRY_POLL_INTERVAL, wake_time - time.monotonic()))
+                if cancelled is not None and cancelled():
+                    raise
+                continue
+            state.succeeded()
+            return result
+
+    async def _run_batch(self, task, item_ids, begin_item, call_item, finish_item, max_concurrency):
+        # 批量请求使用 batch 优先级（之后创建的协程继承该上下文）
+        scheduler.set_priority(scheduler.PRIORITY_BATCH)
+        usage_ledger.set_task(task)
+        semaphore = asyncio.Semaphore(max(1, int(max_concurrency or 1)))
+        update_task(task, workers=max(1, int(max_concurrency or 1)), in_flight=0)
+
+        loop = asyncio.get_running_loop()
+
+        async def _worker(idx, item_id):
+            try:
+                # 与线程池引擎一致：开始处理前检查取消标记，已取消的条目保持原状态
+                if task.get('cancel_requested'):
+                    return
+                # begin_item / finish_item 会写任务存储（SQLite）和结果缓存，放到线程池中执行，避免阻塞其他协程
+                job = await loop.run_in_executor(self._callback_pool, begin_item, idx, item_id)
+                if job is None:
+                    return
+                if job is False:
+                    mark_item_failed(task, item_id)
+                    return
+                with task_lock:
+                    task['in_flight'] = task.get('in_flight', 0) + 1
+                try:
+                    result = await call_item(job)
+                except Exception as e:
+                    await loop.run_in_executor(self._callback_pool, finish_item, job, None, e)
+                    return
+                finally:
+                    with task_lock:
+                        task['in_flight'] = max(0, task.get('in_flight', 1) - 1)
+                await loop.run_in_executor(self._callback_pool, finish_item, job, result, None)
+            except Exception as e:
+                fail_unexpected(task, item_id, e)
+            finally:
+                semaphore.release()
+
+        workers = []
+        for idx, item_id in enumerate(item_ids, start=1):
+            # 有界提交：先占用并发槽位再创建协程
+            await semaphore.acquire()
+            if task.get('cancel_requested'):
+                semaphore.release()
+                # 最终状态由 finalize_task 在在途条目全部结束后设置
+                break
+            workers.append(asyncio.ensure_future(_worker(idx, item_id)))
+
+        if workers:
+            # 条目的异常已在 _worker 中记为失败，这里只等待全部结束
+            await asyncio.gather(*workers, return_exceptions=True)
+        finalize_task(task)
+
+    def run_batch(self, task, item_ids, begin_item, call_item, finish_item, max_concurrency=1):
+        """
+        在引擎事件循环中执行批量任务并阻塞等待完成（参数语义同 batch_runner.run_batch，
+        call_item 为协程函数）
+        """
+        future = self.submit(self._run_batch(task, item_ids, begin_item, call_item, finish_item, max_concurrency))
+        return future.result()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_async_engine():
+    """获取全局异步打标引擎实例"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncTaggingEngine()
+        return _engine
@@ -0,0 +1,239 @@
+"""
+批量任务执行模块 - 有界线程池并发处理批量反推任务
+"""
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
+import retry_policy
+import scheduler
+import task_events
+import usage_ledger
+
+
+# 任务字典（processing_tasks 中的条目）的并发写锁
+task_lock = threading.RLock()
+
+
+def update_task(task, **fields):
+    """线程安全地更新任务字段，并推送进度"""
+    with task_lock:
+        task.update(fields)
+        snapshot = task_events.progress_snapshot(task)
+    task_events.publish_progress(task, snapshot)
+
+
+def mark_item_failed(task, item_id, error=None):
+    """记录失败项，并推送该条目的结果和任务进度（后台任务，即 task['background'] 为真时不计入批量指标）"""
+    with task_lock:
+        task['failed'] += 1
+        task['failed_ids'].append(item_id)
+        snapshot = task_events.progress_snapshot(task)
+    if not task.get('background'):
+        metrics.count_batch_item('failed')
+    task_events.publish_item(task, item_id, 'error', error=error)
+    task_events.publish_progress(task, snapshot)
+
+
+def mark_item_completed(task, item_id=None, text=None, fields=None):
+    """记录成功项，并推送该条目的结果（提供 item_id 时，fields 为附加到条目事件的字段）和任务进度"""
+    with task_lock:
+        task['completed'] += 1
+        snapshot = task_events.progress_snapshot(task)
+    if not task.get('background'):
+        metrics.count_batch_item('completed')
+    if item_id is not None:
+        task_events.publish_item(task, item_id, 'success', text=text, fields=fields)
+    task_events.publish_progress(task, snapshot)
+
+
+# 等待重试期间检查取消标记的间隔秒数
+RETRY_POLL_INTERVAL = 0.5
+
+
+def retry_call(fn, label, give_up=None, cancelled=None):
+    """
+    执行 fn()，失败时按 retry_policy 的规则（按错误类别的次数、退避等待与截止时间）重试
+
+    Args:
+        fn: 无参调用
+        label: 日志中显示的条目标识
+        give_up: give_up(error) 返回 True 时不再重试（可选）
+        cancelled: cancelled() 返回 True 时停止等待并抛出最近一次的错误（可选，用于任务取消）
+    """
+    state = retry_policy.RetryState(label)
+    while True:
+        try:
+            result = fn()
+        except Exception as e:
+            if give_up is not None and give_up(e):
+                raise
+            delay = state.next_delay(e)
+            if delay is None:
+                raise
+            wake_time = time.monotonic() + delay
+            while time.monotonic() < wake_time:
+                if cancelled is not None and cancelled():
+                    raise
+                time.sleep(min(RETRY_POLL_INTERVAL, wake_time - time.monotonic()))
+            if cancelled is not None and cancelled():
+                raise
+            continue
+        state.succeeded()
+        return result
+
+
+def fail_unexpected(task, item_id, error):
+    """begin_item / finish_item 中出现未预期的异常时记为失败并输出日志，避免异常随工作线程的返回值一起丢失"""
+    print(f"[批量任务] 处理 {item_id} 时出现未预期的错误: {error}")
+    traceback.print_exc()
+    mark_item_failed(task, item_id, error)
+
+
+def finalize_task(task):
+    """批量任务结束时更新最终状态"""
+    with task_lock:
+        if task.get('cancel_requested'):
+            task['status'] = 'cancelled'
+        else:
+            task['status'] = 'completed'
+        task['current_id'] = None
+        task['current_name'] = ""
+        task['in_flight'] = 0
+        snapshot = task_events.progress_snapshot(task)
+    task_events.publish_progress(task, snapshot)
+
+
+def group_items(item_ids, pack_size):
+    """
+    将条目按 pack_size 分组（打包请求使用）
+
+    Returns:
+        list: [(首个条目的序号, [item_id, ...]), ...]，序号从 1 开始
+    """
+    pack_size = max(1, int(pack_size or 1))
+    item_ids = list(item_ids)
+    return [(start + 1, item_ids[start:start + pack_size]) for start in range(0, len(item_ids), pack_size)]
+
+
+def packed_callbacks(task, begin_item, finish_item):
+    """
+    将单条目的 begin_item / finish_item 包装为分组版本，配合 group_items 使用
+
+    分组 job 为 {'id': 显示标识, 'jobs': [单条目 job, ...]}；
+    分组 call_item 返回 [(job, result, error), ...]，由 finish_group 逐条写回
+
+    Returns:
+        tuple: (begin_group, finish_group)
+    """
+    def begin_group(idx, group):
+        start, group_ids = group
+        jobs = []
+        for offset, item_id in enumerate(group_ids):
+            if task.get('cancel_requested'):
+                break
+            try:
+                job = begin_item(start + offset, item_id)
+            except Exception as e:
+                fail_unexpected(task, item_id, e)
+                continue
+            if job is None:
+                continue
+            if job is False:
+                mark_item_failed(task, item_id)
+                continue
+            jobs.append(job)
+        if not jobs:
+            return None
+        return {"id": f"{jobs[0]['id']} 等 {len(jobs)} 项", "jobs": jobs}
+
+    def finish_group(group_job, outcomes, error):
+        if error is not None:
+            outcomes = [(job, None, error) for job in group_job['jobs']]
+        success = True
+        for job, result, item_error in outcomes:
+            try:
+                success = finish_item(job, result, item_error) and success
+            except Exception as e:
+                fail_unexpected(task, job['id'], e)
+                success = False
+        return success
+
+    return begin_group, finish_group
+
+
+def run_batch(task, item_ids, begin_item, call_item, finish_item, max_workers=1, priority=scheduler.PRIORITY_BATCH):
+    """
+    使用有界线程池执行批量任务，保持 processing_tasks 的进度语义不变
+
+    Args:
+        task: processing_tasks 中的任务字典
+        item_ids: 待处理的条目ID列表（按顺序提交）
+        begin_item: begin_item(idx, item_id) -> job，在工作线程中调用；返回 None 表示跳过该条目，
+                    返回 False 表示该条目直接记为失败
+        call_item: call_item(job) -> result，执行耗时的 API 调用（可抛出异常）
+        finish_item: finish_item(job, result, error) -> bool，写回结果，返回是否成功
+        max_workers: 本任务的最大并发数
+        priority: 本任务请求在限流器排队时的优先级（默认 batch；批量翻译等不急的任务使用 background）
+
+    渠道级的实际在途请求数由 rate_limiter 中的自适应限流器控制，
+    这里的 max_workers 只是本任务的线程上限
+    """
+    max_workers = max(1, int(max_workers or 1))
+
+    update_task(task, workers=max_workers, in_flight=0)
+
+    def _is_cancelled():
+        return task.get('cancel_requested')
+
+    def _worker(idx, item_id):
+        try:
+            return _process(idx, item_id)
+        except Exception as e:
+            fail_unexpected(task, item_id, e)
+            return False
+
+    def _process(idx, item_id):
+        # 与原串行逻辑一致：开始处理前检查取消标记，已取消的条目保持原状态
+        if _is_cancelled():
+            return None
+        # 批量请求使用 batch（或更低的）优先级，单图反推等交互请求排队时让出限流许可
+        scheduler.set_priority(priority)
+        # API 调用返回的 usage 汇总到本任务
+        usage_ledger.set_task(task)
+        job = begin_item(idx, item_id)
+        if job is None:
+            return None
+        if job is False:
+            mark_item_failed(task, item_id)
+            return False
+
+        with task_lock:
+            task['in_flight'] = task.get('in_flight', 0) + 1
+        try:
+            result = call_item(job)
+        except Exception as e:
+            return finish_item(job, None, e)
+        finally:
+            with task_lock:
+                task['in_flight'] = max(0, task.get('in_flight', 1) - 1)
+        return finish_item(job, result, None)
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='batch') as executor:
+        for idx, item_id in enumerate(item_ids, start=1):
+            if _is_cancelled():
+                # 只停止提交；在途条目完成后由 finalize_task 设置最终状态，结束事件不会早于在途条目的结果
+                break
+
+            pending.add(executor.submit(_worker, idx, item_id))
+
+            # 有界提交：在途数量达到上限时等待任一完成
+            if len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+        if pending:
+            wait(pending)
+
+    finalize_task(task)
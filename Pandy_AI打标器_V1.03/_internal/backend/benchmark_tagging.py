@@ -0,0 +1,179 @@
+"""
+批量反推基准测试 - 在进程内启动后端，通过 /api/images/tag 对模拟 Vision 服务执行批量反推，
+统计吞吐、请求耗时分位数（p50 / p95 / p99）与重试次数，用于离线比较并发、引擎和打包参数
+
+示例：python benchmark_tagging.py --images 100 --concurrency 8 --engine async --rate-429 0.05
+使用单独运行的模拟服务：python benchmark_tagging.py --mock-url http://127.0.0.1:8808/v1
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+from PIL import Image
+
+import mock_vision_server
+
+
+def generate_images(directory, count, size):
+    """生成 count 张渐变叠加噪声的 JPEG 测试图片（编码体积和耗时接近真实照片）"""
+    width, height = size
+    gradient = Image.merge('RGB', [Image.linear_gradient('L').resize(size), Image.radial_gradient('L').resize(size),
+                                   Image.linear_gradient('L').rotate(90).resize(size)])
+    noise = Image.merge('RGB', [Image.effect_noise((width, height), sigma) for sigma in (40, 60, 80)])
+    base = Image.blend(gradient, noise, 0.25)
+    paths = []
+    for idx in range(count):
+        path = os.path.join(directory, f"bench_{idx:05d}.jpg")
+        # 每张图片旋转不同角度，避免内容完全相同
+        base.rotate(idx % 360).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def build_apikey_config(base_url, args):
+    """基准测试使用的 apikey 配置：只配置模拟渠道，关闭缓存与持久化，避免影响用户数据"""
+    return {
+        "providers": {
+            "mock": {"api_key": "mock", "base_url": base_url,
+                     "max_concurrency": args.concurrency, "max_rps": args.max_rps},
+        },
+        "current_provider": "mock",
+        "model": args.model,
+        "caption_cache": {"enabled": False},
+        "payload_cache": {"enabled": False},
+        # 缩略图不写入用户的 api_cache/thumbnails
+        "thumbnail_cache": {"enabled": False},
+        "job_store": {"enabled": False},
+        "usage_ledger": {"enabled": False},
+        "prefetch": {"enabled": not args.no_prefetch},
+    }
+
+
+def diff_counts(after, before):
+    return {key: after[key] - before.get(key, 0) for key in after}
+
+
+def run(args):
+    server = None
+    base_url = args.mock_url
+    if not base_url:
+        server = mock_vision_server.MockVisionServer(settings=mock_vision_server.settings_from_args(args))
+        base_url = server.start()
+
+    workdir = tempfile.mkdtemp(prefix='pandy_bench_')
+    try:
+        size = tuple(int(v) for v in args.size.lower().split('x'))
+        print(f"[基准测试] 生成 {args.images} 张 {size[0]}x{size[1]} 测试图片...")
+        paths = generate_images(workdir, args.images, size)
+
+        # 后端模块在生成图片后再导入，读取基准测试专用的 apikey 配置
+        import app as backend
+        import metrics
+        import retry_policy
+        from api_handler import APIHandler
+
+        apikey_file = os.path.join(workdir, 'apikey.json')
+        apikey_config = build_apikey_config(base_url, args)
+        with open(apikey_file, 'w', encoding='utf-8') as f:
+            json.dump(apikey_config, f)
+        backend.APIKEY_FILE = apikey_file
+        backend.apply_apikey_settings(apikey_config, warmup=False)
+
+        client = backend.app.test_client()
+        added = client.post('/api/images/add', json={"paths": paths}).get_json()
+        ids = [img['id'] for img in added['images'] if img['path'] in set(paths)]
+        # 等待导入后的后台缩略图任务结束，避免与计时的批量反推争用 CPU
+        thumbnail_task_id = added.get('thumbnail_task_id')
+        while thumbnail_task_id:
+            thumbnail_task = client.get(f'/api/tasks/{thumbnail_task_id}').get_json()['task']
+            if thumbnail_task['status'] != 'processing':
+                break
+            time.sleep(0.1)
+
+        provider = APIHandler.resolve_provider(base_url)
+        retries_before = retry_policy.get_stats()
+        log = io.StringIO()
+        print(f"[基准测试] 开始 | 渠道: {base_url} | 并发: {args.concurrency} | 引擎: {args.engine} | "
+              f"打包: {args.pack_size}")
+
+        start_time = time.time()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else log):
+            resp = client.post('/api/images/tag', json={
+                "ids": ids, "concurrency": args.concurrency, "engine": args.engine,
+                "pack_size": args.pack_size, "bypass_cache": True,
+            }).get_json()
+            if not resp.get('success'):
+                raise RuntimeError(f"启动批量任务失败: {resp.get('message')}")
+            task_id = resp['task_id']
+            while True:
+                task = client.get(f'/api/tasks/{task_id}').get_json()['task']
+                if task['status'] != 'processing':
+                    break
+                time.sleep(0.2)
+        elapsed = time.time() - start_time
+
+        retries = retry_policy.get_stats()
+        report = {
+            "images": len(ids),
+            "completed": task['completed'],
+            "failed": task['failed'],
+            "elapsed": round(elapsed, 2),
+            "images_per_second": round(task['completed'] / elapsed, 2) if elapsed else 0.0,
+            "images_per_minute": round(task['completed'] * 60 / elapsed, 1) if elapsed else 0.0,
+            "latency": metrics.request_stage_percentiles('total', provider),
+            "ttfb": metrics.request_stage_percentiles('ttfb', provider),
+            "queue_wait": metrics.request_stage_percentiles('queue_wait', provider),
+            "retries": diff_counts(retries['retries'], retries_before['retries']),
+            "gave_up": diff_counts(retries['gave_up'], retries_before['gave_up']),
+            "usage": task.get('usage'),
+            "mock": server.stats() if server else None,
+        }
+        return report
+    finally:
+        if server:
+            server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(report):
+    print("=" * 60)
+    print(f"图片数: {report['images']} | 成功: {report['completed']} | 失败: {report['failed']} | "
+          f"耗时: {report['elapsed']}s")
+    print(f"吞吐: {report['images_per_second']} 张/秒 ({report['images_per_minute']} 张/分钟)")
+    for name, title in (("latency", "请求耗时"), ("ttfb", "首字节"), ("queue_wait", "排队等待")):
+        stats = report[name]
+        print(f"{title}: p50 {stats['p50']}s | p95 {stats['p95']}s | p99 {stats['p99']}s | 样本 {stats['count']}")
+    print(f"重试: {sum(report['retries'].values())} 次 {report['retries']}")
+    if any(report['gave_up'].values()):
+        print(f"放弃重试: {report['gave_up']}")
+    if report['mock']:
+        print(f"模拟服务: {report['mock']}")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="批量反推吞吐基准测试（使用本地模拟 Vision 服务）")
+    parser.add_argument("--images", type=int, default=50, help="测试图片数量")
+    parser.add_argument("--size", default="1024x768", help="测试图片尺寸，如 1024x768")
+    parser.add_argument("--concurrency", type=int, default=4, help="批量并发数（同时作为模拟渠道的并发上限）")
+    parser.add_argument("--max-rps", type=float, default=50.0, help="模拟渠道的每秒请求上限")
+    parser.add_argument("--engine", choices=("thread", "async"), default="thread")
+    parser.add_argument("--pack-size", type=int, default=1)
+    parser.add_argument("--model", default="Qwen/Qwen3-VL-8B-Instruct")
+    parser.add_argument("--no-prefetch", action="store_true", help="关闭图片预取")
+    parser.add_argument("--mock-url", default=None, help="使用已运行的模拟服务（不在进程内启动）")
+    parser.add_argument("--json", default=None, help="将结果另存为 JSON 文件")
+    parser.add_argument("--verbose", action="store_true", help="显示后端日志")
+    mock_vision_server.add_arguments(parser)
+    cli_args = parser.parse_args()
+
+    result = run(cli_args)
+    print_report(result)
+    if cli_args.json:
+        with open(cli_args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,239 @@
+"""
+反推结果缓存模块 - 以图片内容哈希 + 裁剪参数 + 提示词 + 模型为键，持久化保存 Vision API 返回的描述
+相同图片重复反推（重跑批量、重新加载缓存、重复导入文件夹）时直接返回缓存结果，不再请求 API
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from path_utils import API_CACHE_DIR
+
+
+# 默认缓存参数（可通过 apikey.json 中的 "caption_cache" 字段覆盖）
+DEFAULT_CACHE_SETTINGS = {
+    "enabled": True,          # 是否启用反推结果缓存
+    "max_entries": 5000,      # 最多保留的条目数，超出后按最近最少使用淘汰
+}
+
+# 写入后延迟落盘的秒数，批量任务中多次写入合并为一次保存
+FLUSH_DELAY = 2.0
+# 文件哈希记忆的最大条目数
+HASH_MEMO_LIMIT = 10000
+
+
+def hash_file(image_path, chunk_size=1024 * 1024):
+    """计算文件内容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CaptionCache:
+    """反推结果缓存（LRU，JSON 文件持久化）"""
+
+    def __init__(self, cache_file, max_entries=None):
+        self.cache_file = cache_file
+        self.enabled = DEFAULT_CACHE_SETTINGS['enabled']
+        self.max_entries = max_entries or DEFAULT_CACHE_SETTINGS['max_entries']
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # (路径, 大小, 修改时间) -> 内容哈希，避免同一文件重复读取计算
+        self._hash_memo = {}
+        self._loaded = False
+        self._dirty = False
+        self._flush_timer = None
+
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def configure(self, cache_settings=None):
+        """
+        更新缓存配置
+
+        Args:
+            cache_settings: dict，支持 enabled / max_entries
+        """
+        settings = dict(DEFAULT_CACHE_SETTINGS)
+        for key, value in (cache_settings or {}).items():
+            if key in settings:
+                settings[key] = value
+        with self._lock:
+            self.enabled = bool(settings['enabled'])
+            try:
+                self.max_entries = max(1, int(settings['max_entries']))
+            except (TypeError, ValueError):
+                self.max_entries = DEFAULT_CACHE_SETTINGS['max_entries']
+            self._load_locked()
+            if self._evict_locked():
+                self._schedule_flush_locked()
+
+    def _load_locked(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # 文件中按最近使用顺序保存（旧 -> 新）
+            for item in data.get('entries', []):
+                if isinstance(item, dict) and item.get('key') and isinstance(item.get('text'), str):
+                    self._entries[item['key']] = {"text": item['text'], "time": item.get('time', 0)}
+            print(f"[反推缓存] 已加载 {len(self._entries)} 条缓存")
+        except (OSError, ValueError) as e:
+            print(f"[反推缓存] 缓存文件读取失败，将重新创建: {e}")
+            self._entries.clear()
+
+    def _evict_locked(self):
+        evicted = 0
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def _file_hash(self, image_path):
+        stat = os.stat(image_path)
+        memo_key = (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+        file_hash = self._hash_memo.get(memo_key)
+        if file_hash is None:
+            file_hash = hash_file(image_path)
+            if len(self._hash_memo) >= HASH_MEMO_LIMIT:
+                self._hash_memo.clear()
+            self._hash_memo[memo_key] = file_hash
+        return file_hash
+
+    def make_key(self, image_path, crop_params, system_prompt, user_prompt, model):
+        """
+        计算缓存键
+
+        Returns:
+            str: 缓存键；缓存未启用或图片无法读取时返回 None
+        """
+        if not self.enabled or not image_path:
+            return None
+        try:
+            file_hash = self._file_hash(image_path)
+        except OSError:
+            return None
+        material = json.dumps({
+            "image": file_hash,
+            "crop_params": crop_params or None,
+            "system_prompt": system_prompt or "",
+            "user_prompt": user_prompt or "",
+            "model": model or "",
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key, bypass=False):
+        """
+        查询缓存
+
+        Args:
+            key: make_key 返回的缓存键
+            bypass: 为 True 时跳过缓存（强制重新请求 API，结果仍会写回缓存）
+
+        Returns:
+            str: 缓存的描述文本，未命中时返回 None
+        """
+        if key is None:
+            return None
+        with self._lock:
+            if bypass:
+                self.bypassed += 1
+                return None
+            self._load_locked()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry['text']
+
+    def contains(self, key):
+        """判断缓存中是否有该键（不计入命中统计，不调整淘汰顺序）"""
+        if key is None:
+            return False
+        with self._lock:
+            self._load_locked()
+            return key in self._entries
+
+    def put(self, key, text):
+        """写入缓存（延迟落盘）"""
+        if key is None or not isinstance(text, str) or not text:
+            return
+        with self._lock:
+            self._load_locked()
+            self._entries[key] = {"text": text, "time": time.time()}
+            self._entries.move_to_end(key)
+            self._evict_locked()
+            self._schedule_flush_locked()
+
+    def _schedule_flush_locked(self):
+        self._dirty = True
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(FLUSH_DELAY, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        """将缓存写入磁盘（先写临时文件再替换，避免中途退出损坏缓存文件）"""
+        with self._lock:
+            self._flush_timer = None
+            if not self._dirty:
+                return
+            self._dirty = False
+            entries = [{"key": k, "text": v['text'], "time": v['time']} for k, v in self._entries.items()]
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            tmp_file = self.cache_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({"version": 1, "entries": entries}, f, ensure_ascii=False)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            print(f"[反推缓存] 保存缓存失败: {e}")
+
+    def clear(self):
+        """清空缓存和统计"""
+        with self._lock:
+            self._loaded = True
+            self._entries.clear()
+            self._hash_memo.clear()
+            self.hits = 0
+            self.misses = 0
+            self.bypassed = 0
+            self._schedule_flush_locked()
+
+    def stats(self):
+        """返回缓存统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_caption_cache():
+    """获取全局反推结果缓存实例"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CaptionCache(os.path.join(API_CACHE_DIR, 'caption_cache.json'))
+        return _cache
@@ -0,0 +1,190 @@
+"""
+HTTP 连接池模块 - 每个渠道共享一个保持长连接的 requests.Session
+新建连接（TCP + TLS）的耗时按线程记录，供请求指标区分建连时间和服务端响应时间
+"""
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import poolmanager
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+# 默认连接池参数（可通过 apikey.json 中的 "http" 字段覆盖）
+DEFAULT_HTTP_SETTINGS = {
+    "pool_size": 16,          # 每个渠道保持的最大连接数
+    "connect_timeout": 10,    # 建立连接超时（秒）
+    "read_timeout": None,     # 读取超时（秒），None 表示使用各调用方自己的超时
+}
+
+_settings = dict(DEFAULT_HTTP_SETTINGS)
+_sessions = {}
+_lock = threading.Lock()
+# 当前线程最近一次请求中新建连接的累计耗时（复用长连接时为 0）
+_connect_local = threading.local()
+
+
+def reset_connect_time():
+    """发送请求前调用，清零当前线程的建连耗时"""
+    _connect_local.elapsed = 0.0
+
+
+def last_connect_time():
+    """当前线程自上次 reset_connect_time 以来新建连接的耗时（秒）"""
+    return getattr(_connect_local, 'elapsed', 0.0)
+
+
+def _record_connect(elapsed):
+    _connect_local.elapsed = last_connect_time() + elapsed
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start_time = time.monotonic()
+        try:
+            return super().connect()
+        finally:
+            _record_connect(time.monotonic() - start_time)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start_time = time.monotonic()
+        try:
+            return super().connect()
+        finally:
+            _record_connect(time.monotonic() - start_time)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+_TIMED_POOL_CLASSES = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    """新建连接时记录耗时的 HTTPAdapter（SOCKS 代理使用自己的连接类，不记录）"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _TIMED_POOL_CLASSES
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if manager.pool_classes_by_scheme is poolmanager.pool_classes_by_scheme:
+            manager.pool_classes_by_scheme = _TIMED_POOL_CLASSES
+        return manager
+
+
+def configure(http_settings=None):
+    """
+    更新连接池配置，连接池大小变化时替换所有会话
+
+    旧会话不主动关闭：正在进行的批量请求可能仍持有它们，
+    调用结束后旧会话不再被引用，由垃圾回收释放连接
+
+    Args:
+        http_settings: dict，支持 pool_size / connect_timeout / read_timeout
+    """
+    global _settings
+    new_settings = dict(DEFAULT_HTTP_SETTINGS)
+    for key, value in (http_settings or {}).items():
+        if key in new_settings:
+            new_settings[key] = value
+
+    with _lock:
+        rebuild = new_settings.get('pool_size') != _settings.get('pool_size')
+        _settings = new_settings
+        if rebuild:
+            _sessions.clear()
+
+
+def _create_session(pool_size):
+    session = requests.Session()
+    adapter = _TimedHTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+def get_pool_size():
+    """当前配置的每渠道连接数"""
+    try:
+        return max(1, int(_settings.get('pool_size') or DEFAULT_HTTP_SETTINGS['pool_size']))
+    except (TypeError, ValueError):
+        return DEFAULT_HTTP_SETTINGS['pool_size']
+
+
+def get_session(key):
+    """
+    获取（必要时创建）指定渠道的共享会话
+
+    Args:
+        key: 渠道标识
+
+    Returns:
+        requests.Session
+    """
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _create_session(get_pool_size())
+            _sessions[key] = session
+        return session
+
+
+def get_timeout(read_timeout):
+    """
+    组合 (连接超时, 读取超时)
+
+    Args:
+        read_timeout: 调用方期望的读取超时
+
+    Returns:
+        tuple: requests 使用的 timeout 参数
+    """
+    connect_timeout = _settings.get('connect_timeout') or DEFAULT_HTTP_SETTINGS['connect_timeout']
+    configured_read = _settings.get('read_timeout')
+    return (connect_timeout, configured_read or read_timeout)
+
+
+def warmup(key, base_url, api_key=None):
+    """
+    后台预热：提前建立到渠道的 TCP + TLS 连接，后续请求直接复用
+
+    Args:
+        key: 渠道标识
+        base_url: API 基础 URL
+        api_key: API 密钥（可选，用于请求 /models）
+    """
+    if not base_url:
+        return
+
+    def _run():
+        session = get_session(key)
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        url = f"{base_url.rstrip('/')}/models"
+        start_time = time.time()
+        try:
+            resp = session.get(url, headers=headers, timeout=get_timeout(10))
+            resp.close()
+            print(f"[连接预热] {key} 已建立连接 | 状态码: {resp.status_code} | 耗时: {time.time() - start_time:.2f}s")
+        except requests.exceptions.RequestException as e:
+            print(f"[连接预热] {key} 预热失败: {str(e)[:100]}")
+
+    threading.Thread(target=_run, daemon=True).start()
+
+
+def close_all():
+    """关闭所有会话"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,65 @@
+"""
+图片解码模块 - 按目标尺寸降分辨率解码
+JPEG 使用 DCT 缩放（draft 模式）直接解码出 1/2、1/4、1/8 尺寸；其他格式解码后用 Image.reduce
+按整数倍快速缩小，再交给调用方做最终的 LANCZOS 缩放，降低大图解码的 CPU 和内存占用
+"""
+from PIL import Image
+
+
+# 降分辨率解码后至少保留目标尺寸的倍数，保证最终 LANCZOS 缩放的质量（与 Image.thumbnail 的 reducing_gap 一致）
+REDUCING_GAP = 2.0
+# Image.reduce 不支持或缩小后失真的模式（调色板 / 二值图）
+_NO_REDUCE_MODES = ('1', 'P')
+
+
+def fit_size(width, height, max_width, max_height):
+    """等比缩小到 max_width x max_height 以内的尺寸（不放大）"""
+    scale = min(1.0, max_width / width, max_height / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def open_for_size(image_path, target_size, box=None):
+    """
+    打开图片并以接近目标尺寸的分辨率解码
+
+    Args:
+        image_path: 图片路径
+        target_size: (width, height)，调用方最终需要的尺寸
+        box: 裁剪区域 (left, top, right, bottom)，原图像素坐标（可选）
+
+    Returns:
+        PIL.Image: 已裁剪到 box 的图片，尺寸不小于 target_size（原图不够大时为原始分辨率），
+        调用方需要再缩放到 target_size
+    """
+    img = Image.open(image_path)
+    original_width, original_height = img.size
+    if box is None:
+        box = (0, 0, original_width, original_height)
+    box_width, box_height = box[2] - box[0], box[3] - box[1]
+    target_width, target_height = max(1, target_size[0]), max(1, target_size[1])
+
+    # 可缩小的倍数（保留 REDUCING_GAP 倍余量）
+    factor = min(box_width / target_width, box_height / target_height) / REDUCING_GAP
+
+    if factor >= 2 and img.format == 'JPEG':
+        # draft 选择不小于请求尺寸的最大 DCT 缩放比例，解码前生效
+        img.draft(None, (int(original_width / factor), int(original_height / factor)))
+        scale_x = img.width / original_width
+        scale_y = img.height / original_height
+        if scale_x < 1 or scale_y < 1:
+            box = (int(box[0] * scale_x), int(box[1] * scale_y),
+                   max(int(box[0] * scale_x) + 1, int(box[2] * scale_x)),
+                   max(int(box[1] * scale_y) + 1, int(box[3] * scale_y)))
+            box_width, box_height = box[2] - box[0], box[3] - box[1]
+            factor = min(box_width / target_width, box_height / target_height) / REDUCING_GAP
+
+    if factor >= 2 and img.mode not in _NO_REDUCE_MODES:
+        try:
+            # reduce 同时完成裁剪和整数倍缩小（按块取平均，比 LANCZOS 快得多）
+            return img.reduce(int(factor), box=box)
+        except ValueError:
+            pass
+
+    if box != (0, 0, img.width, img.height):
+        return img.crop(box)
+    return img
@@ -0,0 +1,304 @@
+"""
+近似重复检测模块 - 为图片计算 64 位差值哈希（dHash），按汉明距离查找近似重复的图片
+哈希在导入时由已降分辨率解码的缩略图计算；查询使用多索引哈希（把哈希分成 max_distance + 1 段，
+距离不超过 max_distance 的两个哈希至少有一段完全相同），只比较同段相同的候选，10 万张图片的聚类在数秒内完成
+批量反推时近似重复的图片可复用代表图片的结果（或跳过），导出时可只保留每组的代表图片
+"""
+import threading
+from PIL import Image
+from image_decoder import open_for_size, fit_size
+
+
+# 默认参数（可通过 apikey.json 中的 "dedup" 字段覆盖）
+DEFAULT_DEDUP_SETTINGS = {
+    "max_distance": 4,          # 视为近似重复的最大汉明距离（64 位哈希，0 表示只匹配哈希完全相同的图片）
+    "batch_mode": "off",        # 批量反推时的处理方式：off 不处理 / reuse 复用代表图片的结果 / skip 跳过
+}
+
+BATCH_MODES = ('off', 'reuse', 'skip')
+
+# 单张图片哈希的位数
+HASH_BITS = 64
+# 距离上限（分段数不超过位数，且每段至少 4 位，否则候选过多）
+MAX_DISTANCE_LIMIT = 15
+# 计算哈希时解码的尺寸（dHash 只需要 9x8 灰度图）
+HASH_DECODE_SIZE = (64, 64)
+
+_settings = dict(DEFAULT_DEDUP_SETTINGS)
+_settings_lock = threading.Lock()
+
+
+def _clamp_distance(value, default):
+    try:
+        return min(MAX_DISTANCE_LIMIT, max(0, int(value)))
+    except (TypeError, ValueError):
+        return default
+
+
+def configure(dedup_settings=None):
+    """
+    更新配置
+
+    Args:
+        dedup_settings: dict，支持 max_distance / batch_mode
+    """
+    settings = dict(DEFAULT_DEDUP_SETTINGS)
+    for key, value in (dedup_settings or {}).items():
+        if key in settings:
+            settings[key] = value
+    settings['max_distance'] = _clamp_distance(settings['max_distance'], DEFAULT_DEDUP_SETTINGS['max_distance'])
+    if settings['batch_mode'] not in BATCH_MODES:
+        settings['batch_mode'] = DEFAULT_DEDUP_SETTINGS['batch_mode']
+    with _settings_lock:
+        _settings.update(settings)
+
+
+def get_settings():
+    with _settings_lock:
+        return dict(_settings)
+
+
+def resolve_distance(value=None):
+    """请求中的 max_distance（无效或未提供时使用配置值）"""
+    default = get_settings()['max_distance']
+    return default if value in (None, '') else _clamp_distance(value, default)
+
+
+def dhash(img):
+    """
+    计算图片的 64 位差值哈希：缩小为 9x8 灰度图，比较每行相邻像素的明暗
+
+    Args:
+        img: PIL.Image（建议传入已缩小的图片，例如缩略图）
+
+    Returns:
+        int: 64 位哈希
+    """
+    small = img.convert('L').resize((9, 8), Image.Resampling.BOX)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(8):
+        offset = row * 9
+        for col in range(8):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hash_image_file(image_path):
+    """
+    从图片文件计算 dHash（按小尺寸降分辨率解码），失败时返回 None
+    用于导入时未计算哈希的图片（例如任务恢复时重新加载的图片）
+    """
+    try:
+        with Image.open(image_path) as header:
+            size = fit_size(header.width, header.height, *HASH_DECODE_SIZE)
+        with open_for_size(image_path, size) as img:
+            return dhash(img)
+    except Exception as e:
+        print(f"[近似重复] 计算哈希失败 {image_path}: {e}")
+        return None
+
+
+def to_hex(value, bits=HASH_BITS):
+    return format(value, f'0{bits // 4}x')
+
+
+def from_hex(text):
+    """解析十六进制哈希，无效时返回 None"""
+    try:
+        return int(text, 16) if text else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _split_chunks(bits, count):
+    """把 bits 位平均分成 count 段，返回 [(右移位数, 掩码), ...]"""
+    chunks = []
+    start = 0
+    for idx in range(count):
+        width = bits // count + (1 if idx < bits % count else 0)
+        chunks.append((start, (1 << width) - 1))
+        start += width
+    return chunks
+
+
+class DuplicateIndex:
+    """
+    近似重复索引（多索引哈希）
+
+    同一哈希的多个条目合并存储；每段哈希值对应一张 {段值: {哈希, ...}} 表，
+    查询时只与至少一段相同的哈希计算汉明距离
+    """
+
+    def __init__(self, max_distance=None, bits=HASH_BITS):
+        self.bits = bits
+        self.max_distance = min(bits - 1, max(0, max_distance if max_distance is not None
+                                              else DEFAULT_DEDUP_SETTINGS['max_distance']))
+        self._chunks = _split_chunks(bits, self.max_distance + 1)
+        self._tables = [{} for _ in self._chunks]
+        # 哈希 -> {条目ID: None}（保持加入顺序）
+        self._members = {}
+        # 条目ID -> 哈希
+        self._hashes = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._hashes)
+
+    def add(self, item_id, value):
+        """加入条目（已存在时更新其哈希）"""
+        with self._lock:
+            if self._hashes.get(item_id) == value:
+                return
+            self.remove(item_id)
+            self._hashes[item_id] = value
+            members = self._members.get(value)
+            if members is None:
+                members = self._members[value] = {}
+                for (shift, mask), table in zip(self._chunks, self._tables):
+                    table.setdefault((value >> shift) & mask, set()).add(value)
+            members[item_id] = None
+
+    def remove(self, item_id):
+        with self._lock:
+            value = self._hashes.pop(item_id, None)
+            if value is None:
+                return
+            members = self._members[value]
+            members.pop(item_id, None)
+            if members:
+                return
+            del self._members[value]
+            for (shift, mask), table in zip(self._chunks, self._tables):
+                key = (value >> shift) & mask
+                bucket = table[key]
+                bucket.discard(value)
+                if not bucket:
+                    del table[key]
+
+    def sync(self, hashes):
+        """
+        与当前条目对齐：加入新条目、更新哈希变化的条目、移除已不存在的条目
+
+        Args:
+            hashes: {条目ID: 哈希}
+        """
+        with self._lock:
+            for item_id in [item_id for item_id in self._hashes if item_id not in hashes]:
+                self.remove(item_id)
+            for item_id, value in hashes.items():
+                self.add(item_id, value)
+
+    def _neighbors(self, value, max_distance):
+        """与 value 距离不超过 max_distance 的哈希（不含 value 本身）"""
+        found = set()
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            for other in table.get((value >> shift) & mask, ()):
+                if other != value and other not in found and (value ^ other).bit_count() <= max_distance:
+                    found.add(other)
+        return found
+
+    def find(self, value, max_distance=None):
+        """
+        查找与哈希 value 近似重复的条目
+
+        Returns:
+            list: [(条目ID, 距离), ...]，按距离排序
+        """
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        with self._lock:
+            matches = [(item_id, 0) for item_id in self._members.get(value, ())]
+            for other in self._neighbors(value, max_distance):
+                distance = (value ^ other).bit_count()
+                matches.extend((item_id, distance) for item_id in self._members[other])
+        matches.sort(key=lambda match: match[1])
+        return matches
+
+    def clusters(self, max_distance=None):
+        """
+        近似重复分组（距离不超过 max_distance 的条目连通成一组）
+
+        Returns:
+            list: [[条目ID, ...], ...]，只包含两个及以上条目的分组；组内按加入顺序排列（第一个为代表），
+                  分组按条目数从多到少排列
+        """
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        with self._lock:
+            # 以哈希为节点做并查集
+            parent = {}
+
+            def find_root(value):
+                root = value
+                while parent.get(root, root) != root:
+                    root = parent[root]
+                while value != root:
+                    parent[value], value = root, parent.get(value, value)
+                return root
+
+            # 距离不超过 max_distance 的两个哈希必然落在某张表的同一个桶里，只需比较桶内的哈希
+            for table in self._tables:
+                for bucket in table.values():
+                    if len(bucket) < 2:
+                        continue
+                    values = list(bucket)
+                    for pos, value in enumerate(values):
+                        for other in values[pos + 1:]:
+                            if (value ^ other).bit_count() <= max_distance:
+                                root_a, root_b = find_root(value), find_root(other)
+                                if root_a != root_b:
+                                    parent[root_b] = root_a
+
+            groups = {}
+            for item_id, value in self._hashes.items():
+                groups.setdefault(find_root(value), []).append(item_id)
+        result = [group for group in groups.values() if len(group) > 1]
+        result.sort(key=len, reverse=True)
+        return result
+
+
+def plan_duplicates(entries, max_distance=None, bits=HASH_BITS):
+    """
+    把一批条目按近似重复分组，每组保留第一个条目作为代表
+
+    Args:
+        entries: [(条目ID, 哈希), ...]，哈希为 None 的条目不参与分组
+        max_distance: 最大汉明距离（默认使用配置值）
+        bits: 哈希位数
+
+    Returns:
+        tuple: (representatives, followers)，representatives 为保留的条目ID列表（保持原顺序），
+               followers 为 {代表ID: [重复条目ID, ...]}
+    """
+    if max_distance is None:
+        max_distance = get_settings()['max_distance']
+    index = DuplicateIndex(max_distance, bits)
+    for item_id, value in entries:
+        if value is not None:
+            index.add(item_id, value)
+    followers = {}
+    duplicate_ids = set()
+    for group in index.clusters():
+        followers[group[0]] = group[1:]
+        duplicate_ids.update(group[1:])
+    representatives = [item_id for item_id, _ in entries if item_id not in duplicate_ids]
+    return representatives, followers
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_duplicate_index(kind, max_distance, bits=HASH_BITS):
+    """
+    获取全局近似重复索引（每种条目一个，例如 'images' / 'pairs'），查询的距离上限变化时重建
+
+    Returns:
+        DuplicateIndex
+    """
+    with _indexes_lock:
+        index = _indexes.get(kind)
+        if index is None or index.max_distance != max_distance or index.bits != bits:
+            index = _indexes[kind] = DuplicateIndex(max_distance, bits)
+        return index
+
@@ -0,0 +1,159 @@
+"""
+图片编码模块 - 按请求体字节预算自适应选择编码格式（JPEG / WebP）与质量
+"""
+import io
+import time
+import threading
+from PIL import Image, features
+
+
+# 默认编码参数（可通过 apikey.json 中的 "image_encoding" 字段覆盖）
+DEFAULT_ENCODING_SETTINGS = {
+    "max_kb": 256,                  # 单张图片编码后的字节预算（KB），0 表示不限制（固定 JPEG 最高质量）
+    "formats": ["jpeg", "webp"],    # 候选格式，按顺序尝试
+    "min_quality": 50,              # 质量搜索下限
+    "max_quality": 95,              # 质量搜索上限（同时是不限预算时的固定质量）
+}
+
+# 最低质量仍超出预算时，按此比例缩小尺寸后重新搜索
+DOWNSCALE_FACTOR = 0.75
+MAX_DOWNSCALE_STEPS = 3
+# 质量二分搜索的最大编码次数（每种格式）
+MAX_SEARCH_STEPS = 4
+
+WEBP_AVAILABLE = features.check('webp')
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+_settings = dict(DEFAULT_ENCODING_SETTINGS)
+_lock = threading.Lock()
+
+
+def configure(encoding_settings=None):
+    """
+    更新编码配置
+
+    Args:
+        encoding_settings: dict，支持 max_kb / formats / min_quality / max_quality
+    """
+    global _settings
+    settings = dict(DEFAULT_ENCODING_SETTINGS)
+    for key, value in (encoding_settings or {}).items():
+        if key in settings:
+            settings[key] = value
+    with _lock:
+        _settings = settings
+
+
+def get_settings():
+    """当前编码配置（用于缓存键，配置变化后旧的编码结果自动失效）"""
+    with _lock:
+        return dict(_settings)
+
+
+def _formats(settings):
+    formats = []
+    for name in settings.get('formats') or ['jpeg']:
+        name = str(name).upper()
+        if name == 'JPG':
+            name = 'JPEG'
+        if name == 'WEBP' and not WEBP_AVAILABLE:
+            continue
+        if name in _MIME_TYPES and name not in formats:
+            formats.append(name)
+    return formats or ['JPEG']
+
+
+def _encode(img, fmt, quality):
+    buffered = io.BytesIO()
+    if fmt == 'WEBP':
+        img.save(buffered, format='WEBP', quality=quality, method=4)
+    else:
+        img.save(buffered, format='JPEG', quality=quality)
+    return buffered.getvalue()
+
+
+def _search_quality(img, fmt, max_bytes, min_q, max_q):
+    """
+    二分搜索不超过预算的最高质量
+
+    Returns:
+        tuple: (data, quality, fits)；搜索范围内都超出预算时返回最小的编码结果，fits 为 False
+    """
+    data = _encode(img, fmt, max_q)
+    if len(data) <= max_bytes:
+        return data, max_q, True
+
+    best = None
+    smallest = (data, max_q)
+    low, high = min_q, max_q - 1
+    for _ in range(MAX_SEARCH_STEPS):
+        if low > high:
+            break
+        quality = (low + high) // 2
+        data = _encode(img, fmt, quality)
+        if len(data) <= max_bytes:
+            best = (data, quality)
+            low = quality + 1
+        else:
+            if len(data) < len(smallest[0]):
+                smallest = (data, quality)
+            high = quality - 1
+    if best is not None:
+        return best[0], best[1], True
+    return smallest[0], smallest[1], False
+
+
+def encode_image(img):
+    """
+    按字节预算编码图片（img 需为 RGB 模式）
+
+    在候选格式中选择不超过预算的最高质量；所有格式在最低质量下仍超预算时，
+    逐步缩小尺寸后重试，最终仍超出时返回最小的结果
+
+    Returns:
+        dict: {'data', 'format', 'quality', 'width', 'height', 'encode_elapsed'}
+    """
+    start_time = time.time()
+    settings = get_settings()
+    max_q = int(settings.get('max_quality') or 95)
+    min_q = min(max_q, int(settings.get('min_quality') or 50))
+    max_bytes = int(float(settings.get('max_kb') or 0) * 1024)
+    formats = _formats(settings)
+
+    if max_bytes <= 0:
+        data = _encode(img, formats[0], max_q)
+        return {"data": data, "format": formats[0], "quality": max_q,
+                "width": img.width, "height": img.height, "encode_elapsed": time.time() - start_time}
+
+    fallback = None
+    for _ in range(MAX_DOWNSCALE_STEPS + 1):
+        best = None
+        for fmt in formats:
+            data, quality, fits = _search_quality(img, fmt, max_bytes, min_q, max_q)
+            if fits:
+                # 首选格式在最高质量下即满足预算时，不再尝试其他格式
+                if quality == max_q and best is None:
+                    best = (data, fmt, quality)
+                    break
+                if best is None or quality > best[2] or (quality == best[2] and len(data) < len(best[0])):
+                    best = (data, fmt, quality)
+            elif fallback is None or len(data) < len(fallback[0]):
+                fallback = (data, fmt, quality, img.width, img.height)
+        if best is not None:
+            data, fmt, quality = best
+            return {"data": data, "format": fmt, "quality": quality,
+                    "width": img.width, "height": img.height, "encode_elapsed": time.time() - start_time}
+        new_size = (max(1, int(img.width * DOWNSCALE_FACTOR)), max(1, int(img.height * DOWNSCALE_FACTOR)))
+        img = img.resize(new_size, Image.Resampling.BILINEAR)
+
+    data, fmt, quality, width, height = fallback
+    return {"data": data, "format": fmt, "quality": quality,
+            "width": width, "height": height, "encode_elapsed": time.time() - start_time}
+
+
+def mime_type(data):
+    """根据文件头判断编码格式对应的 MIME 类型"""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return _MIME_TYPES['WEBP']
+    return _MIME_TYPES['JPEG']
@@ -6,6 +6,8 @@ import io
 import base64
 import zipfile
 from PIL import Image
+from image_dedup import to_hex
+from thumbnail_cache import get_thumbnail_cache, render_thumbnail, to_data_uri
 from datetime import datetime
 
 
@@ -13,7 +15,7 @@ class ImageProcessor:
     """图片处理器"""
     
     @staticmethod
-    def create_thumbnail(image_path, size=(1024, 1024)):
+    def create_thumbnail(image_path, size=(1024, 1024), with_hash=False):
         """
         生成缩略图并返回 Base64 编码
         保持 PNG 透明通道
@@ -21,50 +23,22 @@ class ImageProcessor:
         Args:
             image_path: 图片路径
             size: 缩略图尺寸（提高到1024x1024以保证清晰度）
+            with_hash: 同时用缩略图计算近似重复检测的 dHash（不再单独解码原图）
         
         Returns:
-            str: Base64 编码的缩略图
+            str: Base64 编码的缩略图；with_hash 为 True 时返回 (缩略图, 十六进制 dHash)
         """
         try:
-            img = Image.open(image_path)
-            original_mode = img.mode
-            
-            # 检查是否有透明通道
-            has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
-            
-            if has_alpha:
-                # 保持透明通道，转换为 RGBA
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                elif img.mode == 'LA':
-                    img = img.convert('RGBA')
-                
-                # 生成缩略图（使用LANCZOS高质量重采样）
-                img.thumbnail(size, Image.Resampling.LANCZOS)
-                
-                # 保存为 PNG 以保持透明
-                buffered = io.BytesIO()
-                img.save(buffered, format="PNG")
-                img_str = base64.b64encode(buffered.getvalue()).decode()
-                return f"data:image/png;base64,{img_str}"
-            else:
-                # 无透明通道，转换为 RGB 保存为 JPEG
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                # 生成缩略图（使用LANCZOS高质量重采样）
-                img.thumbnail(size, Image.Resampling.LANCZOS)
-                
-                # 保存为 JPEG
-                buffered = io.BytesIO()
-                img.save(buffered, format="JPEG", quality=95)
-                img_str = base64.b64encode(buffered.getvalue()).decode()
-                return f"data:image/jpeg;base64,{img_str}"
+            data, mimetype, image_hash = render_thumbnail(image_path, size)
+            thumbnail = to_data_uri(data, mimetype)
+            if with_hash:
+                return thumbnail, to_hex(image_hash)
+            return thumbnail
         except Exception as e:
             print(f"❌ Error creating thumbnail for {image_path}: {e}")
             import traceback
             traceback.print_exc()
-            return None
+            return (None, None) if with_hash else None
     
     @staticmethod
     def crop_image(image_path, crop_x, crop_y, crop_width, crop_height, target_width, target_height):
@@ -463,19 +437,22 @@ class ImageProcessor:
             return False
     
     @staticmethod
-    def load_image_with_txt(image_path):
+    def load_image_with_txt(image_path, with_thumbnail=True):
         """
         加载图片并检查同名 txt 文件
         
         Args:
             image_path: 图片路径
+            with_thumbnail: 是否立即生成缩略图（False 时 thumbnail / dhash 为 None，
+                            并标记 thumbnail_pending，由后台缩略图任务补全）
         
         Returns:
             dict: 图片信息
         """
         try:
-            img = Image.open(image_path)
-            width, height = img.size
+            # 只读取文件头获取尺寸，像素在生成缩略图时按需解码
+            with Image.open(image_path) as img:
+                width, height = img.size
             
             # 检查同名 txt
             txt_path = os.path.splitext(image_path)[0] + ".txt"
@@ -487,10 +464,12 @@ class ImageProcessor:
                     text_content = f.read()
                 status = "success"
             
-            # 生成缩略图
-            thumbnail = ImageProcessor.create_thumbnail(image_path)
+            # 缩略图写入磁盘缓存，图片信息中只保存其地址（同时计算近似重复检测的哈希）
+            thumbnail, image_hash = None, None
+            if with_thumbnail:
+                thumbnail, image_hash = get_thumbnail_cache().thumbnail(image_path, with_hash=True)
             
-            return {
+            info = {
                 "path": image_path,
                 "name": os.path.basename(image_path),
                 "width": width,
@@ -498,8 +477,12 @@ class ImageProcessor:
                 "text": text_content,
                 "status": status,
                 "thumbnail": thumbnail,
+                "dhash": image_hash,
                 "selected": False
             }
+            if not with_thumbnail:
+                info["thumbnail_pending"] = True
+            return info
         except Exception as e:
             print(f"Error loading image {image_path}: {e}")
             return None
@@ -0,0 +1,221 @@
+"""
+批量任务持久化模块 - 以 SQLite（WAL 模式）保存批量反推任务与每个条目的状态和结果
+程序崩溃或关闭后，重新启动时可以恢复未完成的任务，已完成的条目不再请求 API
+需要 sqlite3；不可用时 SQLITE_AVAILABLE 为 False，任务只保存在内存中
+"""
+import os
+import json
+import time
+import threading
+from path_utils import JOBS_DIR
+
+try:
+    import sqlite3
+    SQLITE_AVAILABLE = True
+except ImportError:
+    sqlite3 = None
+    SQLITE_AVAILABLE = False
+
+
+# 默认参数（可通过 apikey.json 中的 "job_store" 字段覆盖）
+DEFAULT_JOB_STORE_SETTINGS = {
+    "enabled": True,        # 是否持久化批量任务
+    "auto_resume": True,    # 启动时是否自动恢复未完成的任务
+    "keep_jobs": 50,        # 保留的已结束任务数量，超出后删除最早的任务
+}
+
+# 条目状态
+ITEM_PENDING = 'pending'
+ITEM_IN_FLIGHT = 'in_flight'
+ITEM_DONE = 'done'
+ITEM_FAILED = 'failed'
+ITEM_SKIPPED = 'skipped'    # 与批量中的其他图片近似重复，按 dedup=skip 跳过（不请求 API）
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    task_id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_items (
+    task_id TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    image_path TEXT,
+    crop_params TEXT,
+    result TEXT,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (task_id, item_id)
+);
+CREATE INDEX IF NOT EXISTS idx_job_items_state ON job_items (task_id, state);
+"""
+
+
+class JobStore:
+    """批量任务存储（单连接 + 锁，每次状态变化立即提交）"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.enabled = SQLITE_AVAILABLE and DEFAULT_JOB_STORE_SETTINGS['enabled']
+        self.auto_resume = DEFAULT_JOB_STORE_SETTINGS['auto_resume']
+        self.keep_jobs = DEFAULT_JOB_STORE_SETTINGS['keep_jobs']
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def configure(self, store_settings=None):
+        """
+        更新配置
+
+        Args:
+            store_settings: dict，支持 enabled / auto_resume / keep_jobs
+        """
+        settings = dict(DEFAULT_JOB_STORE_SETTINGS)
+        for key, value in (store_settings or {}).items():
+            if key in settings:
+                settings[key] = value
+        if settings['enabled'] and not SQLITE_AVAILABLE:
+            print("[任务存储] 当前环境缺少 sqlite3，批量任务不会持久化")
+        with self._lock:
+            self.enabled = SQLITE_AVAILABLE and bool(settings['enabled'])
+            self.auto_resume = bool(settings['auto_resume'])
+            try:
+                self.keep_jobs = max(0, int(settings['keep_jobs']))
+            except (TypeError, ValueError):
+                self.keep_jobs = DEFAULT_JOB_STORE_SETTINGS['keep_jobs']
+
+    def _connect_locked(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL 模式下 NORMAL 仍能保证崩溃后数据库一致，只可能丢失最后几次提交
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, fn):
+        """在锁内执行写操作并提交；数据库错误只记录日志，不影响批量任务本身"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                conn = self._connect_locked()
+                with conn:
+                    return fn(conn)
+            except sqlite3.Error as e:
+                print(f"[任务存储] 数据库操作失败: {e}")
+                return None
+
+    def create_job(self, task_id, job_type, items, params):
+        """
+        记录新任务
+
+        Args:
+            task_id: 任务ID
+            job_type: 任务类型（如 'images'）
+            items: [(item_id, image_path, crop_params), ...]，按处理顺序
+            params: 恢复任务所需的参数（提示词、模型、渠道、并发等，不包含 API Key）
+        """
+        now = time.time()
+
+        def _create(conn):
+            conn.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, 'processing', ?, ?, ?)",
+                         (task_id, job_type, json.dumps(params, ensure_ascii=False), now, now))
+            conn.executemany(
+                "INSERT OR REPLACE INTO job_items VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?)",
+                [(task_id, item_id, seq, ITEM_PENDING, image_path,
+                  json.dumps(crop_params, ensure_ascii=False) if crop_params else None, now)
+                 for seq, (item_id, image_path, crop_params) in enumerate(items)]
+            )
+        self._execute(_create)
+
+    def set_item_state(self, task_id, item_id, state, result=None, error=None):
+        """更新条目状态（完成时同时写入结果）"""
+        def _update(conn):
+            conn.execute("UPDATE job_items SET state = ?, result = ?, error = ?, updated = ? "
+                         "WHERE task_id = ? AND item_id = ?",
+                         (state, result, str(error)[:500] if error is not None else None, time.time(),
+                          task_id, item_id))
+        self._execute(_update)
+
+    def set_items_state(self, task_id, item_ids, state):
+        """批量更新多个条目的状态（一次提交）"""
+        item_ids = list(item_ids)
+        if not item_ids:
+            return
+
+        def _update(conn):
+            now = time.time()
+            conn.executemany("UPDATE job_items SET state = ?, updated = ? WHERE task_id = ? AND item_id = ?",
+                             [(state, now, task_id, item_id) for item_id in item_ids])
+        self._execute(_update)
+
+    def finish_job(self, task_id, status):
+        """任务结束（completed / cancelled / interrupted），并清理超出保留数量的旧任务"""
+        def _finish(conn):
+            conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE task_id = ?", (status, time.time(), task_id))
+            stale = [row[0] for row in conn.execute(
+                "SELECT task_id FROM jobs WHERE status != 'processing' ORDER BY updated DESC LIMIT -1 OFFSET ?",
+                (self.keep_jobs,))]
+            for stale_id in stale:
+                conn.execute("DELETE FROM job_items WHERE task_id = ?", (stale_id,))
+                conn.execute("DELETE FROM jobs WHERE task_id = ?", (stale_id,))
+        self._execute(_finish)
+
+    def unfinished_jobs(self):
+        """
+        读取未结束的任务（上次运行中断的任务）
+
+        Returns:
+            list: [{'task_id', 'type', 'params', 'items': [{'item_id', 'state', 'image_path',
+                   'crop_params', 'result'}, ...]}, ...]
+        """
+        def _load(conn):
+            jobs = []
+            for task_id, job_type, params in conn.execute(
+                    "SELECT task_id, type, params FROM jobs WHERE status = 'processing' ORDER BY created"):
+                items = [{
+                    "item_id": item_id,
+                    "state": state,
+                    "image_path": image_path,
+                    "crop_params": json.loads(crop_params) if crop_params else None,
+                    "result": result,
+                } for item_id, state, image_path, crop_params, result in conn.execute(
+                    "SELECT item_id, state, image_path, crop_params, result FROM job_items "
+                    "WHERE task_id = ? ORDER BY seq", (task_id,))]
+                jobs.append({"task_id": task_id, "type": job_type, "params": json.loads(params), "items": items})
+            return jobs
+        return self._execute(_load) or []
+
+    def list_jobs(self, limit=20):
+        """最近的任务及各状态条目数"""
+        def _list(conn):
+            jobs = []
+            for task_id, job_type, status, created, updated in conn.execute(
+                    "SELECT task_id, type, status, created, updated FROM jobs ORDER BY created DESC LIMIT ?",
+                    (limit,)):
+                counts = dict(conn.execute(
+                    "SELECT state, COUNT(*) FROM job_items WHERE task_id = ? GROUP BY state", (task_id,)))
+                jobs.append({"task_id": task_id, "type": job_type, "status": status,
+                             "created": created, "updated": updated, "items": counts})
+            return jobs
+        return self._execute(_list) or []
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_job_store():
+    """获取全局批量任务存储实例"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = JobStore(os.path.join(JOBS_DIR, 'jobs.db'))
+        return _store
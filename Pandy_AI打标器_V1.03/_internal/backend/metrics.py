@@ -0,0 +1,266 @@
+"""
+请求指标模块 - 汇总图片预处理与 API 请求各阶段的耗时直方图、请求结果计数和批量吞吐
+以 Prometheus 文本格式输出（/api/metrics），用于按实测数据调整并发、打包数和细节档位
+"""
+import time
+import threading
+from collections import deque
+
+
+# 耗时直方图的桶上界（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+# 计算分位数时每组标签保留的最近样本数
+SAMPLE_WINDOW = 2000
+
+# 实时吞吐 / 错误率的统计窗口（秒）
+THROUGHPUT_WINDOW = 60
+ERROR_WINDOW = 300
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """按标签分组的耗时直方图（sample_window > 0 时同时保留最近样本，用于计算精确分位数）"""
+
+    def __init__(self, name, help_text, labelnames, buckets=BUCKETS, sample_window=0):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.sample_window = sample_window
+        self._lock = threading.Lock()
+        # 标签值 -> [各桶计数, 总和, 次数]
+        self._series = {}
+        # 标签值 -> 最近样本
+        self._samples = {}
+
+    def observe(self, value, *labelvalues):
+        value = max(0.0, float(value))
+        key = tuple(str(v or '') for v in labelvalues)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+            if self.sample_window:
+                samples = self._samples.get(key)
+                if samples is None:
+                    samples = self._samples[key] = deque(maxlen=self.sample_window)
+                samples.append(value)
+
+    def percentiles(self, match=None, quantiles=(0.5, 0.95, 0.99)):
+        """
+        最近样本的分位数
+
+        Args:
+            match: {标签名: 值}，只统计标签匹配的样本（可选）
+            quantiles: 需要计算的分位数
+
+        Returns:
+            dict: {'count', 'p50', 'p95', 'p99', ...}；没有样本时各分位数为 None
+        """
+        match = match or {}
+        with self._lock:
+            values = []
+            for key, samples in self._samples.items():
+                labels = dict(zip(self.labelnames, key))
+                if all(labels.get(name) == str(value) for name, value in match.items()):
+                    values.extend(samples)
+        ordered = sorted(values)
+        result = {"count": len(ordered)}
+        for q in quantiles:
+            result[f"p{int(round(q * 100))}"] = (
+                round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3) if ordered else None)
+        return result
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key in sorted(series):
+            counts, total, count = series[key]
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(round(total, 6))}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Counter:
+    """按标签分组的累计计数"""
+
+    def __init__(self, name, help_text, labelnames):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        key = tuple(str(v or '') for v in labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for key in sorted(values):
+            lines.append(f"{self.name}{_format_labels(list(zip(self.labelnames, key)))} {_format_value(values[key])}")
+        return lines
+
+
+class RecentEvents:
+    """滑动窗口内的事件（用于实时吞吐和错误率）"""
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._events = deque()
+
+    def add(self, key, ok=True):
+        now = time.monotonic()
+        with self._lock:
+            self._events.append((now, key, ok))
+            self._trim(now)
+
+    def _trim(self, now):
+        while self._events and self._events[0][0] < now - self.window:
+            self._events.popleft()
+
+    def counts(self):
+        """返回 {key: (总数, 失败数)}"""
+        with self._lock:
+            self._trim(time.monotonic())
+            result = {}
+            for _, key, ok in self._events:
+                total, failed = result.get(key, (0, 0))
+                result[key] = (total + 1, failed + (0 if ok else 1))
+            return result
+
+
+IMAGE_STAGE_SECONDS = Histogram(
+    'pandy_image_stage_seconds', '图片预处理各阶段耗时（decode: 解码/裁剪/缩放, encode: 按字节预算编码）',
+    ('stage', 'model'))
+REQUEST_STAGE_SECONDS = Histogram(
+    'pandy_request_stage_seconds',
+    'API 请求各阶段耗时（queue_wait: 等待限流许可, connect: 建立连接, ttfb: 发出请求到收到响应头, total: 含预处理的整次调用）',
+    ('stage', 'provider', 'model'), sample_window=SAMPLE_WINDOW)
+REQUESTS_TOTAL = Counter(
+    'pandy_requests_total', 'API 请求数（outcome: ok / HTTP 状态码 / timeout / connection_error）',
+    ('provider', 'model', 'outcome'))
+BATCH_ITEMS_TOTAL = Counter('pandy_batch_items_total', '批量任务处理完成的条目数', ('result',))
+
+_recent_requests = RecentEvents(ERROR_WINDOW)
+_recent_items = RecentEvents(THROUGHPUT_WINDOW)
+
+# 抓取时调用的额外指标来源：fn() -> [(name, type, help, [(labels_dict, value), ...]), ...]
+_collectors = []
+
+
+def observe_image_stage(stage, model, seconds):
+    """记录图片预处理阶段耗时"""
+    IMAGE_STAGE_SECONDS.observe(seconds, stage, model)
+
+
+def observe_request_stage(stage, provider, model, seconds):
+    """记录 API 请求阶段耗时"""
+    REQUEST_STAGE_SECONDS.observe(seconds, stage, provider, model)
+
+
+def request_stage_percentiles(stage, provider=None):
+    """API 请求某阶段最近样本的分位数（可按渠道过滤）"""
+    match = {"stage": stage}
+    if provider:
+        match["provider"] = provider
+    return REQUEST_STAGE_SECONDS.percentiles(match)
+
+
+def outcome_label(status_code):
+    """HTTP 状态码对应的请求结果标签"""
+    return 'ok' if status_code == 200 else str(status_code)
+
+
+def count_request(provider, model, outcome):
+    """记录一次 API 请求的结果"""
+    REQUESTS_TOTAL.inc(provider, model, outcome)
+    _recent_requests.add(provider, outcome == 'ok')
+
+
+def count_batch_item(result):
+    """记录批量任务完成一个条目（result: completed / failed）"""
+    BATCH_ITEMS_TOTAL.inc(result)
+    _recent_items.add(result)
+
+
+def register_collector(fn):
+    """登记抓取时调用的额外指标来源（如任务状态、限流器状态）"""
+    if fn not in _collectors:
+        _collectors.append(fn)
+
+
+def _gauge_lines(name, metric_type, help_text, samples):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_format_labels(sorted((labels or {}).items()))} {_format_value(value)}")
+    return lines
+
+
+def _window_families():
+    items = _recent_items.counts()
+    processed = sum(total for total, _ in items.values())
+    requests_by_provider = _recent_requests.counts()
+    return [
+        ('pandy_batch_items_per_minute', 'gauge', f'最近 {THROUGHPUT_WINDOW} 秒的批量处理速度（条目/分钟）',
+         [({}, round(processed * 60 / THROUGHPUT_WINDOW, 2))]),
+        ('pandy_request_error_ratio', 'gauge', f'最近 {ERROR_WINDOW} 秒各渠道失败请求的比例',
+         [({'provider': provider}, round(failed / total, 4))
+          for provider, (total, failed) in sorted(requests_by_provider.items())]),
+    ]
+
+
+def render():
+    """
+    生成 Prometheus 文本格式的全部指标
+
+    Returns:
+        str: text/plain; version=0.0.4
+    """
+    lines = []
+    for metric in (IMAGE_STAGE_SECONDS, REQUEST_STAGE_SECONDS, REQUESTS_TOTAL, BATCH_ITEMS_TOTAL):
+        lines.extend(metric.render())
+    families = _window_families()
+    for collector in list(_collectors):
+        try:
+            families.extend(collector())
+        except Exception as e:
+            print(f"[指标] 采集失败: {str(e)[:100]}")
+    for name, metric_type, help_text, samples in families:
+        lines.extend(_gauge_lines(name, metric_type, help_text, samples))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,296 @@
+"""
+模拟 Vision 服务模块 - 本地 OpenAI 兼容的 /chat/completions 服务，用于离线测试批量反推的吞吐
+支持可配置的响应延迟分布、429 / 5xx 注入（附带 Retry-After）、并发上限、流式响应、多图打包请求和批量翻译请求，
+不消耗真实渠道的额度。可单独运行：python mock_vision_server.py --port 8808
+"""
+import re
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# 默认模拟参数
+DEFAULT_MOCK_SETTINGS = {
+    "latency": "lognormal",     # 延迟分布：fixed / uniform / lognormal
+    "latency_median": 1.0,      # fixed / lognormal 的中位延迟（秒）
+    "latency_sigma": 0.4,       # lognormal 的 sigma
+    "latency_min": 0.2,         # uniform 的延迟下限（秒）
+    "latency_max": 2.0,         # uniform 的延迟上限（秒）
+    "per_image_latency": 0.3,   # 打包请求中每多一张图片增加的延迟（秒）
+    "rate_429": 0.0,            # 随机返回 429 的比例
+    "rate_5xx": 0.0,            # 随机返回 500 / 502 / 503 的比例
+    "retry_after": 1.0,         # 429 / 503 响应的 Retry-After 秒数（0 表示不返回）
+    "max_concurrency": 0,       # 同时处理的请求上限，超出时返回 429（0 表示不限制）
+    "stream_chunks": 8,         # 流式响应的分块数
+    "image_tokens": 256,        # 每张图片计入 usage 的 token 数
+    "seed": None,               # 随机种子（便于复现）
+}
+
+_TAGS = ("1girl", "solo", "looking at viewer", "smile", "outdoors", "sky", "cloud", "tree", "long hair",
+         "short hair", "blue eyes", "dress", "standing", "upper body", "day", "grass", "flower", "building")
+
+
+class MockState:
+    """模拟服务的配置与统计"""
+
+    def __init__(self, settings=None):
+        self.settings = dict(DEFAULT_MOCK_SETTINGS)
+        for key, value in (settings or {}).items():
+            if key in self.settings and value is not None:
+                self.settings[key] = value
+        self.random = random.Random(self.settings['seed'])
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.counts = {"requests": 0, "ok": 0, "injected_429": 0, "injected_5xx": 0, "rejected_429": 0,
+                       "streamed": 0, "images": 0}
+
+    def sample_latency(self, images):
+        s = self.settings
+        with self.lock:
+            if s['latency'] == 'fixed':
+                latency = s['latency_median']
+            elif s['latency'] == 'uniform':
+                latency = self.random.uniform(s['latency_min'], s['latency_max'])
+            else:
+                latency = self.random.lognormvariate(math.log(max(1e-3, s['latency_median'])), s['latency_sigma'])
+        return latency + s['per_image_latency'] * max(0, images - 1)
+
+    def choose_fault(self):
+        """返回注入的错误状态码（不注入时为 None）"""
+        with self.lock:
+            roll = self.random.random()
+            if roll < self.settings['rate_429']:
+                self.counts['injected_429'] += 1
+                return 429
+            if roll < self.settings['rate_429'] + self.settings['rate_5xx']:
+                self.counts['injected_5xx'] += 1
+                return self.random.choice((500, 502, 503))
+        return None
+
+    def enter(self):
+        """登记一个在途请求，超过并发上限时返回 False"""
+        with self.lock:
+            self.counts['requests'] += 1
+            limit = self.settings['max_concurrency']
+            if limit and self.in_flight >= limit:
+                self.counts['rejected_429'] += 1
+                return False
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts, in_flight=self.in_flight, peak_in_flight=self.peak_in_flight)
+
+
+def _count_images(payload):
+    images = 0
+    for message in payload.get('messages') or []:
+        content = message.get('content')
+        if isinstance(content, list):
+            images += sum(1 for part in content if isinstance(part, dict) and part.get('type') == 'image_url')
+    return images
+
+
+def _count_segments(payload):
+    """批量翻译请求中 <<<编号>>> 标记的段数"""
+    messages = payload.get('messages') or []
+    content = messages[-1].get('content') if messages else ''
+    return len(re.findall(r'<<<\s*\d+\s*>>>', content)) if isinstance(content, str) else 0
+
+
+def _caption(rng, idx):
+    return ", ".join(rng.sample(_TAGS, 6)) + f", mock image {idx}"
+
+
+def _make_handler(state):
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status, body, headers=None):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_error(self, status, message):
+            headers = {}
+            if status in (429, 503) and state.settings['retry_after']:
+                headers["Retry-After"] = f"{state.settings['retry_after']:g}"
+            self._send_json(status, {"error": {"message": message, "code": status}}, headers)
+
+        def do_GET(self):
+            if self.path.rstrip('/').endswith('/models'):
+                self._send_json(200, {"data": [{"id": "mock-vision", "object": "model"}]})
+            elif self.path.rstrip('/').endswith('/stats'):
+                self._send_json(200, state.snapshot())
+            else:
+                self._send_error(404, "not found")
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                payload = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                self._send_error(400, "invalid json")
+                return
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._send_error(404, "not found")
+                return
+            if not state.enter():
+                self._send_error(429, "mock concurrency limit exceeded")
+                return
+            try:
+                self._complete(payload)
+            finally:
+                state.leave()
+
+        def _complete(self, payload):
+            images = _count_images(payload)
+            latency = state.sample_latency(max(1, images))
+            fault = state.choose_fault()
+            if fault is not None:
+                # 错误响应也要经过一部分延迟，模拟服务端排队后拒绝
+                time.sleep(latency * 0.2)
+                self._send_error(fault, f"mock injected error {fault}")
+                return
+
+            with state.lock:
+                texts = [_caption(state.random, idx) for idx in range(1, max(1, images) + 1)]
+                state.counts['ok'] += 1
+                state.counts['images'] += images
+            segments = _count_segments(payload)
+            if segments:
+                # 批量翻译请求按 <<<编号>>> 分段输出
+                content = "\n".join(f"<<<{idx}>>>\n模拟译文 {idx}。/" for idx in range(1, segments + 1))
+            elif images > 1:
+                # 打包请求按 [[编号]] 分段输出
+                content = "\n".join(f"[[{idx}]] {text}" for idx, text in enumerate(texts, start=1))
+            else:
+                content = texts[0]
+            image_tokens = images * state.settings['image_tokens']
+            completion_tokens = max(1, len(content) // 4)
+            usage = {"prompt_tokens": image_tokens + 50, "completion_tokens": completion_tokens,
+                     "total_tokens": image_tokens + 50 + completion_tokens,
+                     "prompt_tokens_details": {"image_tokens": image_tokens}}
+            model = payload.get('model') or 'mock-vision'
+
+            if not payload.get('stream'):
+                time.sleep(latency)
+                self._send_json(200, {"id": "mock", "object": "chat.completion", "model": model,
+                                      "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                                   "finish_reason": "stop"}],
+                                      "usage": usage})
+                return
+
+            with state.lock:
+                state.counts['streamed'] += 1
+            chunks = max(1, int(state.settings['stream_chunks']))
+            # 首字节约占总延迟的 40%，其余时间均匀输出分块
+            time.sleep(latency * 0.4)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            step = math.ceil(len(content) / chunks)
+            for start in range(0, len(content), step):
+                chunk = {"choices": [{"index": 0, "delta": {"content": content[start:start + step]}}], "model": model}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(latency * 0.6 / chunks)
+            self.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+    return MockHandler
+
+
+class MockVisionServer:
+    """在后台线程中运行的模拟 Vision 服务"""
+
+    def __init__(self, host='127.0.0.1', port=0, settings=None):
+        self.state = MockState(settings)
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self.state))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """启动服务并返回 base_url"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mock-vision-server', daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def serve_forever(self):
+        """在当前线程中运行服务（Ctrl+C 结束）"""
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        """请求数、注入的错误数、并发峰值等统计"""
+        return self.state.snapshot()
+
+
+def add_arguments(parser):
+    """向命令行解析器添加模拟参数（基准测试脚本共用）"""
+    group = parser.add_argument_group("模拟服务参数")
+    group.add_argument("--latency", choices=("fixed", "uniform", "lognormal"), default=DEFAULT_MOCK_SETTINGS['latency'])
+    group.add_argument("--latency-median", type=float, default=DEFAULT_MOCK_SETTINGS['latency_median'])
+    group.add_argument("--latency-sigma", type=float, default=DEFAULT_MOCK_SETTINGS['latency_sigma'])
+    group.add_argument("--latency-min", type=float, default=DEFAULT_MOCK_SETTINGS['latency_min'])
+    group.add_argument("--latency-max", type=float, default=DEFAULT_MOCK_SETTINGS['latency_max'])
+    group.add_argument("--per-image-latency", type=float, default=DEFAULT_MOCK_SETTINGS['per_image_latency'])
+    group.add_argument("--rate-429", type=float, default=DEFAULT_MOCK_SETTINGS['rate_429'])
+    group.add_argument("--rate-5xx", type=float, default=DEFAULT_MOCK_SETTINGS['rate_5xx'])
+    group.add_argument("--retry-after", type=float, default=DEFAULT_MOCK_SETTINGS['retry_after'])
+    group.add_argument("--max-concurrency", type=int, default=DEFAULT_MOCK_SETTINGS['max_concurrency'])
+    group.add_argument("--stream-chunks", type=int, default=DEFAULT_MOCK_SETTINGS['stream_chunks'])
+    group.add_argument("--seed", type=int, default=None)
+    return parser
+
+
+def settings_from_args(args):
+    """从解析结果中取出模拟参数"""
+    return {key: getattr(args, key) for key in DEFAULT_MOCK_SETTINGS if hasattr(args, key)}
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="本地模拟 OpenAI 兼容 Vision 服务")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8808)
+    add_arguments(arg_parser)
+    cli_args = arg_parser.parse_args()
+    server = MockVisionServer(cli_args.host, cli_args.port, settings_from_args(cli_args))
+    print(f"[模拟服务] 已启动: {server.base_url} | 参数: {server.state.settings}")
+    server.serve_forever()
+    print(f"[模拟服务] 已停止 | 统计: {server.stats()}")
@@ -52,6 +52,15 @@ TRAINING_DATA_DIR = os.path.join(BASE_PATH, 'training_datas')
 TRAINING_EDIT_TMP_DIR = os.path.join(BASE_PATH, 'training_edit_tmp')
 TRAINING_PROMPT_TMP_DIR = os.path.join(BASE_PATH, 'training_prompt_tmp')
 
+# API 结果缓存目录（反推结果缓存等，放在 exe 同级目录）
+API_CACHE_DIR = os.path.join(BASE_PATH, 'api_cache')
+
+# 批量任务持久化目录（未完成的批量反推任务，放在 exe 同级目录）
+JOBS_DIR = os.path.join(BASE_PATH, 'jobs')
+
+# 用量账本目录（按天记录各渠道的 token 用量，放在 exe 同级目录）
+USAGE_DIR = os.path.join(BASE_PATH, 'usage')
+
 
 def ensure_user_dirs():
     """确保用户数据目录存在"""
@@ -60,6 +69,9 @@ def ensure_user_dirs():
         TRAINING_DATA_DIR,
         TRAINING_EDIT_TMP_DIR,
         TRAINING_PROMPT_TMP_DIR,
+        API_CACHE_DIR,
+        JOBS_DIR,
+        USAGE_DIR,
         os.path.join(TRAINING_DATA_DIR, 'input_datas_image'),
         os.path.join(TRAINING_EDIT_TMP_DIR, '__temp_cache__'),
     ]
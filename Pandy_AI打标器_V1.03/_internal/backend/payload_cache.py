@@ -0,0 +1,231 @@
+"""
+请求图片缓存模块 - 将预处理（裁剪/缩放/去透明/编码）后的图片字节保存到磁盘
+重试和重复反推时直接读取缓存，跳过原图解码；按磁盘预算做最近最少使用淘汰
+"""
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from path_utils import API_CACHE_DIR
+
+
+# 默认缓存参数（可通过 apikey.json 中的 "payload_cache" 字段覆盖）
+DEFAULT_PAYLOAD_CACHE_SETTINGS = {
+    "enabled": True,      # 是否启用请求图片缓存
+    "max_mb": 512,        # 磁盘占用上限（MB），超出后按最近最少使用淘汰
+}
+
+# 预处理逻辑变化时递增，使旧缓存自动失效
+PAYLOAD_VERSION = 2
+PAYLOAD_SUFFIX = '.img'
+# 旧版本缓存文件后缀（只保存 JPEG），扫描时清理
+LEGACY_SUFFIXES = ('.jpg',)
+
+
+class PayloadCache:
+    """预处理图片的磁盘缓存（LRU，按总字节数限制）"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.enabled = DEFAULT_PAYLOAD_CACHE_SETTINGS['enabled']
+        self.max_bytes = DEFAULT_PAYLOAD_CACHE_SETTINGS['max_mb'] * 1024 * 1024
+
+        self._lock = threading.Lock()
+        # 缓存键 -> 文件大小，按最近使用顺序排列（旧 -> 新）
+        self._index = OrderedDict()
+        self._total_bytes = 0
+        self._scanned = False
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def configure(self, cache_settings=None):
+        """
+        更新缓存配置
+
+        Args:
+            cache_settings: dict，支持 enabled / max_mb
+        """
+        settings = dict(DEFAULT_PAYLOAD_CACHE_SETTINGS)
+        for key, value in (cache_settings or {}).items():
+            if key in settings:
+                settings[key] = value
+        with self._lock:
+            self.enabled = bool(settings['enabled'])
+            try:
+                self.max_bytes = max(1, int(float(settings['max_mb']) * 1024 * 1024))
+            except (TypeError, ValueError):
+                self.max_bytes = DEFAULT_PAYLOAD_CACHE_SETTINGS['max_mb'] * 1024 * 1024
+            self._scan_locked()
+            self._evict_locked()
+
+    def _scan_locked(self):
+        """首次使用时扫描缓存目录，按文件修改时间恢复 LRU 顺序"""
+        if self._scanned:
+            return
+        self._scanned = True
+        if not os.path.isdir(self.cache_dir):
+            return
+        files = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(LEGACY_SUFFIXES):
+                try:
+                    os.remove(os.path.join(self.cache_dir, filename))
+                except OSError:
+                    pass
+                continue
+            if not filename.endswith(PAYLOAD_SUFFIX):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, filename))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, filename[:-len(PAYLOAD_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(files):
+            self._index[key] = size
+            self._total_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + PAYLOAD_SUFFIX)
+
+    def _evict_locked(self):
+        while self._total_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            self.evicted += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def make_key(self, image_path, crop_params=None, variant=None):
+        """
+        计算缓存键（文件路径 + 大小 + 修改时间 + 裁剪参数 + 编码配置）
+
+        Args:
+            image_path: 图片文件路径
+            crop_params: 裁剪参数（可选）
+            variant: 影响编码结果的其他参数（如编码配置，可选）
+
+        Returns:
+            str: 缓存键；缓存未启用或文件不存在时返回 None
+        """
+        if not self.enabled:
+            return None
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        material = json.dumps({
+            "path": os.path.abspath(image_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "crop_params": crop_params or None,
+            "variant": variant,
+            "version": PAYLOAD_VERSION,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        读取缓存的图片字节
+
+        Returns:
+            bytes: 未命中时返回 None
+        """
+        if key is None:
+            return None
+        with self._lock:
+            self._scan_locked()
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # 更新修改时间，重启后仍能恢复最近使用顺序
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                size = self._index.pop(key, None)
+                if size is not None:
+                    self._total_bytes -= size
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """写入缓存（先写临时文件再替换，避免读取到写了一半的文件）"""
+        if key is None or not data:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[图片缓存] 写入失败: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._scan_locked()
+            old_size = self._index.pop(key, None)
+            if old_size is not None:
+                self._total_bytes -= old_size
+            self._index[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict_locked()
+
+    def clear(self):
+        """清空缓存文件和统计"""
+        with self._lock:
+            self._scan_locked()
+            for key in list(self._index):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._index.clear()
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evicted = 0
+
+    def stats(self):
+        """返回缓存统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._index),
+                "size_mb": round(self._total_bytes / (1024 * 1024), 2),
+                "max_mb": round(self.max_bytes / (1024 * 1024), 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_payload_cache():
+    """获取全局请求图片缓存实例"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PayloadCache(os.path.join(API_CACHE_DIR, 'payloads'))
+        return _cache
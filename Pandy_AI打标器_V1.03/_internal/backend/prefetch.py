@@ -0,0 +1,211 @@
+"""
+图片预取模块 - 批量反推时在后台线程池中提前预处理后续图片
+请求在途时 CPU 解码/编码下一批图片，工作线程取用时直接得到 data URL；
+预取窗口限制同时保存的预处理结果数量，任务取消时停止预取
+"""
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# 默认预取参数（可通过 apikey.json 中的 "prefetch" 字段覆盖）
+DEFAULT_PREFETCH_SETTINGS = {
+    "enabled": True,    # 是否启用预取
+    "workers": 2,       # 预处理线程数
+    "window": 4,        # 已开始处理的条目之后最多预取的条目数
+}
+
+_settings = dict(DEFAULT_PREFETCH_SETTINGS)
+_active = []
+_active_lock = threading.Lock()
+
+
+def configure(prefetch_settings=None):
+    """
+    更新预取配置（对之后开始的批量任务生效）
+
+    Args:
+        prefetch_settings: dict，支持 enabled / workers / window
+    """
+    global _settings
+    settings = dict(DEFAULT_PREFETCH_SETTINGS)
+    for key, value in (prefetch_settings or {}).items():
+        if key in settings:
+            settings[key] = value
+    try:
+        settings['workers'] = max(1, int(settings['workers']))
+        settings['window'] = max(0, int(settings['window']))
+    except (TypeError, ValueError):
+        settings['workers'] = DEFAULT_PREFETCH_SETTINGS['workers']
+        settings['window'] = DEFAULT_PREFETCH_SETTINGS['window']
+    _settings = settings
+
+
+def make_key(image_path, crop_params, model):
+    """预取结果的匹配键（图片路径 + 裁剪参数 + 模型）"""
+    return (os.path.abspath(image_path), json.dumps(crop_params or None, sort_keys=True), model or '')
+
+
+class PayloadPrefetcher:
+    """单个批量任务的预取器"""
+
+    def __init__(self, task, item_ids, resolve, prepare, model, lag=1, skip=None):
+        """
+        Args:
+            task: processing_tasks 中的任务字典（读取 cancel_requested）
+            item_ids: 批量任务的条目ID列表（按处理顺序）
+            resolve: resolve(item_id) -> (image_path, crop_params)，条目不存在时返回 None
+            prepare: prepare(image_path, crop_params, model) -> dict，实际执行预处理的函数
+            model: 请求使用的模型
+            lag: 允许落后于最新开始条目的数量（并发数 x 打包数），超出后未取用的结果被丢弃
+            skip: skip(image_path, crop_params) 返回 True 时不预处理（如反推结果已缓存），在预取线程中调用
+        """
+        self.task = task
+        self.item_ids = list(item_ids)
+        self.resolve = resolve
+        self.prepare = prepare
+        self.model = model
+        self.skip = skip
+        self.window = _settings['window']
+        self.lag = max(1, int(lag or 1)) + self.window
+
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=_settings['workers'], thread_name_prefix='prefetch')
+        # 匹配键 -> (条目序号, Future)
+        self._entries = {}
+        self._cursor = 0
+        self._next = 0
+        self._closed = False
+
+        self.prefetched = 0
+        self.hits = 0
+        self.dropped = 0
+        self.wait_time = 0.0
+
+    def _cancelled(self):
+        return self._closed or self.task.get('cancel_requested')
+
+    def _prepare(self, image_path, crop_params):
+        if self._cancelled():
+            return None
+        if self.skip is not None and self.skip(image_path, crop_params):
+            return None
+        return self.prepare(image_path, crop_params, self.model)
+
+    def advance(self, idx):
+        """
+        工作线程开始处理第 idx 个条目（从 1 开始）时调用：滑动预取窗口，丢弃过期的预取结果
+        """
+        with self._lock:
+            if self._cancelled():
+                return
+            self._cursor = max(self._cursor, idx)
+            # 已落后太多的条目不会再被取用（跳过、缓存命中或已内联处理），释放内存
+            stale = [key for key, (pos, _) in self._entries.items() if pos <= self._cursor - self.lag]
+            for key in stale:
+                _, future = self._entries.pop(key)
+                future.cancel()
+                self.dropped += 1
+
+            self._next = max(self._next, self._cursor)
+            while self._next < min(len(self.item_ids), self._cursor + self.window):
+                pos = self._next + 1
+                self._next += 1
+                source = self.resolve(self.item_ids[pos - 1])
+                if not source:
+                    continue
+                image_path, crop_params = source
+                key = make_key(image_path, crop_params, self.model)
+                if key in self._entries:
+                    continue
+                self._entries[key] = (pos, self._pool.submit(self._prepare, image_path, crop_params))
+                self.prefetched += 1
+
+    def take(self, key):
+        """
+        取出预取结果（预处理尚未完成时等待）
+
+        Returns:
+            dict: 预处理结果；没有预取或预取失败时返回 None
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        start_time = time.time()
+        try:
+            prepared = entry[1].result()
+        except Exception as e:
+            print(f"[图片预取] 预取失败，改为直接处理: {str(e)[:100]}")
+            return None
+        with self._lock:
+            self.wait_time += time.time() - start_time
+            if prepared is not None:
+                self.hits += 1
+        return prepared
+
+    def close(self):
+        """停止预取并丢弃未取用的结果"""
+        with self._lock:
+            self._closed = True
+            self.dropped += len(self._entries)
+            self._entries.clear()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        """返回预取统计（预取数 / 命中数 / 丢弃数 / 取用时的累计等待秒数）"""
+        with self._lock:
+            return {
+                "prefetched": self.prefetched,
+                "hits": self.hits,
+                "dropped": self.dropped,
+                "wait_time": round(self.wait_time, 2),
+            }
+
+
+def start(task, item_ids, resolve, prepare, model, lag=1, skip=None):
+    """
+    为批量任务创建并登记预取器，立即开始预取窗口内的第一批条目（参数同 PayloadPrefetcher）
+
+    Returns:
+        PayloadPrefetcher: 预取未启用或窗口为 0 时返回 None
+    """
+    if not _settings['enabled'] or _settings['window'] <= 0:
+        return None
+    prefetcher = PayloadPrefetcher(task, item_ids, resolve, prepare, model, lag, skip)
+    with _active_lock:
+        _active.append(prefetcher)
+    prefetcher.advance(0)
+    return prefetcher
+
+
+def stop(prefetcher):
+    """结束预取器并返回统计"""
+    if prefetcher is None:
+        return None
+    with _active_lock:
+        if prefetcher in _active:
+            _active.remove(prefetcher)
+    prefetcher.close()
+    return prefetcher.stats()
+
+
+def take(image_path, crop_params, model):
+    """
+    从正在运行的预取器中取出匹配的预处理结果
+
+    Returns:
+        dict: 预处理结果；没有匹配的预取结果时返回 None
+    """
+    with _active_lock:
+        prefetchers = list(_active)
+    if not prefetchers:
+        return None
+    key = make_key(image_path, crop_params, model)
+    for prefetcher in prefetchers:
+        prepared = prefetcher.take(key)
+        if prepared is not None:
+            return prepared
+    return None
@@ -0,0 +1,338 @@
+"""
+渠道路由模块 - 多渠道故障转移 + 对冲请求（hedged request）
+主渠道失败时按顺序切换到备用渠道；开启对冲后，主渠道超过 p95 耗时仍未返回时
+向下一个渠道发送重复请求，取先返回的结果
+"""
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# 默认故障转移参数（可通过 apikey.json 中的 "failover" 字段覆盖）
+DEFAULT_FAILOVER_SETTINGS = {
+    "enabled": False,           # 是否启用多渠道故障转移
+    "providers": [],            # 备用渠道顺序（为空时使用所有已配置 API Key 的渠道）
+    "hedge": False,             # 是否启用对冲请求
+    "hedge_percentile": 0.95,   # 对冲等待时间取主渠道耗时的该分位数
+    "hedge_min_delay": 3.0,     # 对冲等待时间下限（秒）
+    "hedge_max_delay": 60.0,    # 对冲等待时间上限（秒）
+}
+
+# 连续失败达到该次数后，在冷却时间内将渠道移到链尾
+UNHEALTHY_FAILURES = 3
+UNHEALTHY_COOLDOWN = 60.0
+# 统计耗时分位数的样本窗口
+LATENCY_WINDOW = 50
+# 最近结果窗口（用于计算近期失败率）
+OUTCOME_WINDOW = 20
+# 样本数不足时不做对冲（没有可靠的 p95）
+MIN_HEDGE_SAMPLES = 5
+
+
+class ProviderStats:
+    """单个渠道的调用结果统计"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.outcomes = deque(maxlen=OUTCOME_WINDOW)
+        self.success = 0
+        self.failures = 0
+        self.hedged = 0
+        self.consecutive_failures = 0
+        self.last_failure = 0.0
+
+    def record(self, ok, latency):
+        self.outcomes.append(bool(ok))
+        if ok:
+            self.success += 1
+            self.consecutive_failures = 0
+            self.latencies.append(latency)
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_failure = time.monotonic()
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(p * len(ordered)))
+        return ordered[index]
+
+    def failure_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def is_healthy(self):
+        if self.consecutive_failures < UNHEALTHY_FAILURES:
+            return True
+        return time.monotonic() - self.last_failure > UNHEALTHY_COOLDOWN
+
+    def snapshot(self):
+        p50 = self.percentile(0.5)
+        p95 = self.percentile(0.95)
+        return {
+            "provider": self.name,
+            "healthy": self.is_healthy(),
+            "success": self.success,
+            "failures": self.failures,
+            "hedged": self.hedged,
+            "consecutive_failures": self.consecutive_failures,
+            "recent_failure_rate": round(self.failure_rate(), 3),
+            "latency_p50": round(p50, 2) if p50 is not None else None,
+            "latency_p95": round(p95, 2) if p95 is not None else None,
+        }
+
+
+class ProviderRouter:
+    """按渠道健康状况排序调用链，执行故障转移与对冲请求"""
+
+    def __init__(self, hedge_workers=32):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._settings = dict(DEFAULT_FAILOVER_SETTINGS)
+        # 对冲模式下请求在此线程池中执行，调用线程只负责等待先返回的结果
+        self._executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix='hedge')
+
+    def configure(self, failover_settings=None):
+        """
+        更新故障转移配置
+
+        Args:
+            failover_settings: dict，支持 DEFAULT_FAILOVER_SETTINGS 中的字段
+        """
+        settings = dict(DEFAULT_FAILOVER_SETTINGS)
+        for key, value in (failover_settings or {}).items():
+            if key in settings:
+                settings[key] = value
+        with self._lock:
+            self._settings = settings
+
+    @property
+    def enabled(self):
+        return bool(self._settings.get('enabled'))
+
+    @property
+    def hedge_enabled(self):
+        return bool(self._settings.get('hedge'))
+
+    def _get_stats(self, provider):
+        with self._lock:
+            stats = self._stats.get(provider)
+            if stats is None:
+                stats = ProviderStats(provider)
+                self._stats[provider] = stats
+            return stats
+
+    def build_chain(self, apikey_config, model):
+        """
+        根据 apikey.json 构建调用链（当前渠道在前，其后为备用渠道）
+
+        备用渠道使用 providers.<渠道>.failover_model 指定的模型，未指定时沿用当前模型
+
+        Args:
+            apikey_config: API Key 配置
+            model: 当前渠道使用的模型
+
+        Returns:
+            list: [{'provider', 'api_key', 'base_url', 'model'}, ...]
+        """
+        providers = apikey_config.get('providers') or {}
+        current = apikey_config.get('current_provider')
+        order = [current] + [p for p in (self._settings.get('providers') or list(providers)) if p != current]
+
+        chain = []
+        for provider in order:
+            cfg = providers.get(provider) or {}
+            if not cfg.get('api_key') or not cfg.get('base_url'):
+                continue
+            chain.append({
+                "provider": provider,
+                "api_key": cfg['api_key'],
+                "base_url": cfg['base_url'],
+                "model": model if provider == current else (cfg.get('failover_model') or model),
+            })
+        return chain
+
+    def order_chain(self, chain):
+        """按健康状况重新排序：不健康或近期失败率过半的渠道后移，其余保持配置顺序"""
+        def sort_key(item):
+            stats = self._get_stats(item[1]['provider'])
+            return (not stats.is_healthy(), stats.failure_rate() > 0.5, item[0])
+        return [entry for _, entry in sorted(enumerate(chain), key=sort_key)]
+
+    def hedge_delay(self, provider):
+        """
+        计算对冲等待时间（主渠道耗时的 p95，限制在上下限之间）
+
+        Returns:
+            float: 等待秒数；未开启对冲或样本不足时返回 None
+        """
+        if not self.hedge_enabled:
+            return None
+        stats = self._get_stats(provider)
+        if len(stats.latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        delay = stats.percentile(float(self._settings.get('hedge_percentile') or 0.95))
+        return min(float(self._settings['hedge_max_delay']), max(float(self._settings['hedge_min_delay']), delay))
+
+    def record(self, provider, ok, latency):
+        """记录一次调用结果"""
+        stats = self._get_stats(provider)
+        with self._lock:
+            stats.record(ok, latency)
+
+    def _timed_call(self, entry, fn):
+        start_time = time.time()
+        try:
+            result = fn(entry)
+        except Exception:
+            self.record(entry['provider'], False, time.time() - start_time)
+            raise
+        self.record(entry['provider'], True, time.time() - start_time)
+        return result
+
+    def call(self, chain, fn):
+        """
+        按调用链执行 fn(entry)，失败时切换到下一个渠道；开启对冲时超过 p95 未返回则并发请求下一个渠道
+
+        Args:
+            chain: build_chain 返回的调用链
+            fn: fn(entry) -> result，entry 为调用链中的渠道信息
+
+        Returns:
+            先成功返回的结果；所有渠道都失败时抛出最后一个异常
+        """
+        ordered = self.order_chain(chain)
+        if not ordered:
+            raise Exception("没有可用的 API 渠道，请先配置 API Key")
+
+        if not self.hedge_enabled:
+            last_error = None
+            for idx, entry in enumerate(ordered):
+                try:
+                    return self._timed_call(entry, fn)
+                except Exception as e:
+                    last_error = e
+                    if idx + 1 < len(ordered):
+                        print(f"[故障转移] {entry['provider']} 失败: {str(e)[:100]} | 切换到 {ordered[idx + 1]['provider']}")
+            raise last_error
+
+        pending = {}
+        next_idx = 0
+        last_error = None
+
+        def launch():
+            nonlocal next_idx
+            entry = ordered[next_idx]
+            next_idx += 1
+            # 在调用方的上下文中执行，保持请求优先级
+            pending[self._executor.submit(contextvars.copy_context().run, self._timed_call, entry, fn)] = entry
+            return entry
+
+        running = launch()
+        while pending:
+            timeout = None
+            if len(pending) == 1 and next_idx < len(ordered):
+                timeout = self.hedge_delay(running['provider'])
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 主渠道超过 p95 耗时仍未返回，向下一个渠道发送对冲请求
+                self._get_stats(running['provider']).hedged += 1
+                print(f"[对冲请求] {running['provider']} 超过 {timeout:.1f}s 未返回 | 同时请求 {ordered[next_idx]['provider']}")
+                running = launch()
+                continue
+            for future in done:
+                entry = pending.pop(future)
+                try:
+                    # 未完成的请求在后台继续执行，结果丢弃
+                    return future.result()
+                except Exception as e:
+                    last_error = e
+                    if not pending and next_idx < len(ordered):
+                        print(f"[故障转移] {entry['provider']} 失败: {str(e)[:100]} | 切换到 {ordered[next_idx]['provider']}")
+                        running = launch()
+        raise last_error
+
+    async def _atimed_call(self, entry, coro_fn):
+        start_time = time.time()
+        try:
+            result = await coro_fn(entry)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.record(entry['provider'], False, time.time() - start_time)
+            raise
+        self.record(entry['provider'], True, time.time() - start_time)
+        return result
+
+    async def acall(self, chain, coro_fn):
+        """call 的异步版本（coro_fn(entry) 为协程函数），对冲落后的请求会被取消"""
+        ordered = self.order_chain(chain)
+        if not ordered:
+            raise Exception("没有可用的 API 渠道，请先配置 API Key")
+
+        pending = {}
+        next_idx = 0
+        last_error = None
+
+        def launch():
+            nonlocal next_idx
+            entry = ordered[next_idx]
+            next_idx += 1
+            pending[asyncio.ensure_future(self._atimed_call(entry, coro_fn))] = entry
+            return entry
+
+        running = launch()
+        try:
+            while pending:
+                timeout = None
+                if len(pending) == 1 and next_idx < len(ordered):
+                    timeout = self.hedge_delay(running['provider'])
+                done, _ = await asyncio.wait(list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self._get_stats(running['provider']).hedged += 1
+                    print(f"[对冲请求] {running['provider']} 超过 {timeout:.1f}s 未返回 | 同时请求 {ordered[next_idx]['provider']}")
+                    running = launch()
+                    continue
+                for task in done:
+                    entry = pending.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        last_error = e
+                        if not pending and next_idx < len(ordered):
+                            print(f"[故障转移] {entry['provider']} 失败: {str(e)[:100]} | 切换到 {ordered[next_idx]['provider']}")
+                            running = launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        """返回各渠道统计"""
+        with self._lock:
+            stats = list(self._stats.values())
+            settings = dict(self._settings)
+        return {
+            "settings": settings,
+            "providers": [s.snapshot() for s in stats],
+        }
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_provider_router():
+    """获取全局渠道路由实例"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ProviderRouter()
+        return _router
@@ -0,0 +1,246 @@
+"""
+渠道限流模块 - 令牌桶 + AIMD（加性增/乘性减）自适应并发控制
+"""
+import time
+import threading
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(value):
+    """
+    解析 Retry-After 响应头
+
+    Args:
+        value: 秒数或 HTTP 日期字符串
+
+    Returns:
+        float: 需要等待的秒数，无法解析时返回 None
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    单个渠道的自适应限流器
+
+    - 令牌桶限制请求速率（rate 个/秒，桶容量 burst）
+    - 并发窗口 limit 按 AIMD 调整：成功时加性增长，429/503 时乘性减小
+    - 429/503 响应携带 Retry-After 时，在指定时间内暂停发放令牌
+    - 按优先级放行：有更高优先级（数值更小）的请求在排队时，低优先级请求不获取许可
+    """
+
+    # 429 降速后在此时间内不再重复降速，避免同一波在途请求的 429 叠加把窗口压到底
+    DECREASE_COOLDOWN = 1.0
+    # 未携带 Retry-After 的 429 默认暂停时间
+    DEFAULT_BACKOFF = 2.0
+    # 触发降速的状态码（Retry-After 只在这些响应上生效）
+    BACKOFF_STATUS_CODES = (429, 503)
+
+    def __init__(self, name, max_concurrency=4, max_rps=4.0,
+                 min_rps=0.2, increase_step=1.0, decrease_factor=0.5):
+        self.name = name
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_rps = max(min_rps, float(max_rps))
+        self.min_rps = min_rps
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+
+        self._cond = threading.Condition()
+        # 从一半的上限起步，随成功请求逐步爬升
+        self._limit = max(1.0, self.max_concurrency / 2)
+        self._rps = max(self.min_rps, self.max_rps / 2)
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._in_flight = 0
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        # 优先级 -> 正在排队的请求数
+        self._waiting = {}
+
+        self.total_success = 0
+        self.total_throttled = 0
+        self.total_errors = 0
+
+    def configure(self, max_concurrency=None, max_rps=None):
+        """更新上限（批量任务启动时根据配置调用）"""
+        with self._cond:
+            if max_concurrency is not None:
+                self.max_concurrency = max(1, int(max_concurrency))
+                self._limit = min(self._limit, float(self.max_concurrency))
+            if max_rps is not None:
+                self.max_rps = max(self.min_rps, float(max_rps))
+                self._rps = min(self._rps, self.max_rps)
+            self._cond.notify_all()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        if elapsed > 0:
+            burst = max(1.0, self._limit)
+            self._tokens = min(burst, self._tokens + elapsed * self._rps)
+            self._last_refill = now
+
+    def enter_queue(self, priority=0):
+        """登记一个排队中的请求（排队期间更低优先级的请求让出许可）"""
+        with self._cond:
+            self._waiting[priority] = self._waiting.get(priority, 0) + 1
+
+    def leave_queue(self, priority=0):
+        """取消排队登记"""
+        with self._cond:
+            self._waiting[priority] = max(0, self._waiting.get(priority, 0) - 1)
+            self._cond.notify_all()
+
+    def try_acquire(self, priority=0):
+        """
+        尝试获取一个请求许可（不阻塞）
+
+        Args:
+            priority: 请求优先级（数值越小越优先）
+
+        Returns:
+            float: 0 表示已获取；否则为建议等待的秒数
+        """
+        with self._cond:
+            if any(count for level, count in self._waiting.items() if level < priority):
+                return 0.05
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self._in_flight >= int(self._limit):
+                return 0.05
+            self._refill(now)
+            if self._tokens < 1.0:
+                return (1.0 - self._tokens) / self._rps
+            self._tokens -= 1.0
+            self._in_flight += 1
+            return 0
+
+    def acquire(self, timeout=None, priority=0):
+        """
+        阻塞直到获取请求许可
+
+        Args:
+            timeout: 最长等待秒数（None 表示一直等待）
+            priority: 请求优先级（数值越小越优先）
+
+        Returns:
+            bool: 是否成功获取
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        wait_time = self.try_acquire(priority)
+        if wait_time == 0:
+            return True
+        self.enter_queue(priority)
+        try:
+            while True:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait_time = min(wait_time, remaining)
+                with self._cond:
+                    self._cond.wait(wait_time)
+                wait_time = self.try_acquire(priority)
+                if wait_time == 0:
+                    return True
+        finally:
+            self.leave_queue(priority)
+
+    def release(self, status_code=None, retry_after=None):
+        """
+        释放许可并根据请求结果调整窗口
+
+        Args:
+            status_code: HTTP 状态码（网络异常时为 None）
+            retry_after: Retry-After 秒数（可选）
+        """
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            now = time.monotonic()
+
+            if status_code in self.BACKOFF_STATUS_CODES:
+                self.total_throttled += 1
+                pause = retry_after if retry_after is not None else self.DEFAULT_BACKOFF
+                self._blocked_until = max(self._blocked_until, now + pause)
+                if now - self._last_decrease >= self.DECREASE_COOLDOWN:
+                    self._limit = max(1.0, self._limit * self.decrease_factor)
+                    self._rps = max(self.min_rps, self._rps * self.decrease_factor)
+                    self._last_decrease = now
+                    print(f"[限流] {self.name} 触发限流 | 并发窗口: {self._limit:.1f} | 速率: {self._rps:.2f}/s | 暂停: {pause:.1f}s")
+            elif status_code is not None and status_code < 400:
+                self.total_success += 1
+                # 加性增长：每个窗口的请求全部成功后窗口 +increase_step
+                self._limit = min(float(self.max_concurrency), self._limit + self.increase_step / max(1.0, self._limit))
+                self._rps = min(self.max_rps, self._rps + 0.25 * self.increase_step)
+            else:
+                self.total_errors += 1
+
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """返回当前限流状态"""
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "provider": self.name,
+                "concurrency_limit": round(self._limit, 2),
+                "max_concurrency": self.max_concurrency,
+                "rate_per_second": round(self._rps, 3),
+                "max_rate_per_second": self.max_rps,
+                "in_flight": self._in_flight,
+                "paused_seconds": round(max(0.0, self._blocked_until - now), 2),
+                "waiting": {str(level): count for level, count in self._waiting.items() if count},
+                "success": self.total_success,
+                "throttled": self.total_throttled,
+                "errors": self.total_errors,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider, max_concurrency=None, max_rps=None):
+    """
+    获取渠道限流器，不存在时按给定上限创建
+
+    已存在的限流器不会被这里的参数修改，需调整上限请使用 configure_rate_limiter
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            kwargs = {}
+            if max_concurrency is not None:
+                kwargs['max_concurrency'] = max_concurrency
+            if max_rps is not None:
+                kwargs['max_rps'] = max_rps
+            limiter = AdaptiveRateLimiter(provider, **kwargs)
+            _limiters[provider] = limiter
+        return limiter
+
+
+def configure_rate_limiter(provider, max_concurrency=None, max_rps=None):
+    """获取渠道限流器并更新其上限"""
+    limiter = get_rate_limiter(provider, max_concurrency=max_concurrency, max_rps=max_rps)
+    limiter.configure(max_concurrency=max_concurrency, max_rps=max_rps)
+    return limiter
+
+
+def get_all_limiter_stats():
+    """返回所有渠道限流器的状态"""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return [limiter.snapshot() for limiter in limiters]
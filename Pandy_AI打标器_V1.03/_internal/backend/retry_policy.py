@@ -0,0 +1,204 @@
+"""
+重试策略模块 - 按错误类别决定批量请求失败后是否重试以及等待多久
+错误分为限流、超时、服务端错误、连接错误、客户端错误（不可重试）和其他错误；
+各类别可分别配置重试次数，等待时间为指数退避 + 全抖动，服务端返回 Retry-After 时不早于该时间重试，
+单个条目（含全部重试）超过截止时间后不再重试
+"""
+import time
+import random
+import threading
+from api_handler import APIError, APITimeoutError, APIConnectionError
+
+
+# 错误类别
+CATEGORY_RATE_LIMIT = 'rate_limit'
+CATEGORY_TIMEOUT = 'timeout'
+CATEGORY_SERVER = 'server_error'
+CATEGORY_CONNECTION = 'connection'
+CATEGORY_CLIENT = 'client_error'
+CATEGORY_OTHER = 'other'
+CATEGORIES = (CATEGORY_RATE_LIMIT, CATEGORY_TIMEOUT, CATEGORY_SERVER, CATEGORY_CONNECTION,
+              CATEGORY_CLIENT, CATEGORY_OTHER)
+
+CATEGORY_NAMES = {
+    CATEGORY_RATE_LIMIT: "限流",
+    CATEGORY_TIMEOUT: "超时",
+    CATEGORY_SERVER: "服务端错误",
+    CATEGORY_CONNECTION: "连接错误",
+    CATEGORY_CLIENT: "客户端错误",
+    CATEGORY_OTHER: "其他错误",
+}
+
+# 默认重试参数（可通过 apikey.json 中的 "retry_policy" 字段覆盖）
+# 第 n 次重试前等待 random(0, min(max_delay, base_delay * 2^(n-1))) 秒
+DEFAULT_RETRY_SETTINGS = {
+    "deadline": 600,    # 单个条目（含全部重试）的截止秒数，超过后不再重试（0 表示不限制）
+    CATEGORY_RATE_LIMIT: {"retries": 4, "base_delay": 2.0, "max_delay": 60.0},
+    CATEGORY_TIMEOUT: {"retries": 2, "base_delay": 2.0, "max_delay": 30.0},
+    CATEGORY_SERVER: {"retries": 3, "base_delay": 2.0, "max_delay": 30.0},
+    CATEGORY_CONNECTION: {"retries": 3, "base_delay": 1.0, "max_delay": 20.0},
+    CATEGORY_CLIENT: {"retries": 0, "base_delay": 0.0, "max_delay": 0.0},
+    # 响应无法解析等未归类的错误，与旧版一致只重试一次
+    CATEGORY_OTHER: {"retries": 1, "base_delay": 2.0, "max_delay": 2.0},
+}
+
+_settings = {key: (dict(value) if isinstance(value, dict) else value) for key, value in DEFAULT_RETRY_SETTINGS.items()}
+_lock = threading.Lock()
+
+
+def configure(retry_settings=None):
+    """
+    更新重试配置（对之后发生的重试生效）
+
+    Args:
+        retry_settings: dict，支持 deadline 以及各类别的 {retries, base_delay, max_delay}
+    """
+    global _settings
+    retry_settings = retry_settings or {}
+    settings = {}
+    try:
+        settings['deadline'] = max(0.0, float(retry_settings.get('deadline', DEFAULT_RETRY_SETTINGS['deadline']) or 0))
+    except (TypeError, ValueError):
+        settings['deadline'] = DEFAULT_RETRY_SETTINGS['deadline']
+    for category in CATEGORIES:
+        rule = dict(DEFAULT_RETRY_SETTINGS[category])
+        for key, value in (retry_settings.get(category) or {}).items():
+            if key in rule:
+                rule[key] = value
+        try:
+            rule['retries'] = max(0, int(rule['retries']))
+            rule['base_delay'] = max(0.0, float(rule['base_delay']))
+            rule['max_delay'] = max(rule['base_delay'], float(rule['max_delay']))
+        except (TypeError, ValueError):
+            print(f"[重试策略] {category} 配置无效，使用默认值")
+            rule = dict(DEFAULT_RETRY_SETTINGS[category])
+        settings[category] = rule
+    with _lock:
+        _settings = settings
+
+
+def get_settings():
+    """当前重试配置"""
+    with _lock:
+        return {key: (dict(value) if isinstance(value, dict) else value) for key, value in _settings.items()}
+
+
+def classify(error):
+    """
+    判断错误类别
+
+    Returns:
+        str: CATEGORIES 之一
+    """
+    if isinstance(error, APITimeoutError):
+        return CATEGORY_TIMEOUT
+    if isinstance(error, APIConnectionError):
+        return CATEGORY_CONNECTION
+    if isinstance(error, APIError) and error.status_code:
+        status = error.status_code
+        if status == 429:
+            return CATEGORY_RATE_LIMIT
+        if status == 408:
+            return CATEGORY_TIMEOUT
+        if status >= 500:
+            return CATEGORY_SERVER
+        if status >= 400:
+            return CATEGORY_CLIENT
+    return CATEGORY_OTHER
+
+
+def backoff_delay(rule, attempt):
+    """第 attempt 次重试（从 1 开始）前的等待秒数：指数退避 + 全抖动"""
+    ceiling = min(rule['max_delay'], rule['base_delay'] * (2 ** (attempt - 1)))
+    return random.uniform(0, ceiling)
+
+
+class RetryStats:
+    """各类别的重试与放弃次数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._retries = {category: 0 for category in CATEGORIES}
+        self._gave_up = {category: 0 for category in CATEGORIES}
+        self._recovered = 0
+
+    def record(self, category, retried):
+        with self._lock:
+            if retried:
+                self._retries[category] += 1
+            else:
+                self._gave_up[category] += 1
+
+    def record_recovered(self):
+        with self._lock:
+            self._recovered += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "retries": dict(self._retries),
+                "gave_up": dict(self._gave_up),
+                "recovered": self._recovered,
+            }
+
+
+_stats = RetryStats()
+
+
+def get_stats():
+    """返回各类别的重试统计（重试次数 / 放弃次数 / 重试后成功的条目数）"""
+    return _stats.snapshot()
+
+
+class RetryState:
+    """单个条目的重试状态（各类别已重试次数与截止时间）"""
+
+    def __init__(self, label):
+        self.label = label
+        self.settings = get_settings()
+        self.start_time = time.monotonic()
+        self.attempts = {category: 0 for category in CATEGORIES}
+
+    @property
+    def retried(self):
+        return any(self.attempts.values())
+
+    def next_delay(self, error):
+        """
+        判断失败后是否重试
+
+        Returns:
+            float: 重试前等待的秒数；None 表示不再重试
+        """
+        category = classify(error)
+        rule = self.settings[category]
+        name = CATEGORY_NAMES[category]
+        attempt = self.attempts[category]
+        if attempt >= rule['retries']:
+            _stats.record(category, False)
+            if rule['retries']:
+                print(f"[重试] {self.label} {name}，已重试 {attempt} 次，放弃")
+            return None
+
+        attempt += 1
+        delay = backoff_delay(rule, attempt)
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after:
+            # 服务端明确要求的等待时间优先（加少量抖动，避免同时醒来的请求再次撞上限流）
+            delay = max(delay, retry_after + random.uniform(0, min(1.0, retry_after * 0.1)))
+
+        deadline = self.settings['deadline']
+        if deadline and time.monotonic() - self.start_time + delay > deadline:
+            _stats.record(category, False)
+            print(f"[重试] {self.label} {name}，超过截止时间 {deadline:.0f}s，放弃")
+            return None
+
+        self.attempts[category] = attempt
+        _stats.record(category, True)
+        print(f"[重试] {self.label} {name}，{delay:.1f}s 后重试 ({attempt}/{rule['retries']})...")
+        return delay
+
+    def succeeded(self):
+        """条目成功时调用（统计重试后恢复的条目）"""
+        if self.retried:
+            _stats.record_recovered()
@@ -0,0 +1,95 @@
+"""
+请求调度模块 - 为渠道请求区分优先级（交互 / 批量 / 后台）并统计排队时间
+优先级通过 contextvars 随调用上下文传递（线程和协程均适用），渠道限流器按优先级放行：
+有高优先级请求在排队时，低优先级请求让出许可，单图反推、翻译、对话不再被批量任务挤占
+"""
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+
+# 优先级（数值越小越优先）
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BATCH = 'batch'
+PRIORITY_BACKGROUND = 'background'
+PRIORITY_LEVELS = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1, PRIORITY_BACKGROUND: 2}
+
+# 统计排队时间分位数的样本窗口
+WAIT_WINDOW = 200
+
+# 未设置时按交互请求处理（用户在界面上直接触发的请求）
+_priority = contextvars.ContextVar('request_priority', default=PRIORITY_INTERACTIVE)
+
+
+def current_priority():
+    """当前上下文的请求优先级名称"""
+    return _priority.get()
+
+
+def current_level():
+    """当前上下文的请求优先级数值"""
+    return PRIORITY_LEVELS.get(_priority.get(), 0)
+
+
+def set_priority(name):
+    """设置当前上下文（线程或协程）的请求优先级，返回用于恢复的 token"""
+    if name not in PRIORITY_LEVELS:
+        raise ValueError(f"未知的请求优先级: {name}")
+    return _priority.set(name)
+
+
+@contextmanager
+def priority(name):
+    """在 with 块内使用指定的请求优先级"""
+    token = set_priority(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class WaitStats:
+    """各优先级的排队时间统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waits = {name: deque(maxlen=WAIT_WINDOW) for name in PRIORITY_LEVELS}
+        self._counts = {name: 0 for name in PRIORITY_LEVELS}
+        self._totals = {name: 0.0 for name in PRIORITY_LEVELS}
+
+    def record(self, name, wait_time):
+        with self._lock:
+            self._waits[name].append(wait_time)
+            self._counts[name] += 1
+            self._totals[name] += wait_time
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for name, waits in self._waits.items():
+                ordered = sorted(waits)
+                count = self._counts[name]
+                result[name] = {
+                    "requests": count,
+                    "avg_wait": round(self._totals[name] / count, 3) if count else 0.0,
+                    "p50_wait": round(ordered[len(ordered) // 2], 3) if ordered else None,
+                    "p95_wait": round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 3) if ordered else None,
+                    "max_wait": round(ordered[-1], 3) if ordered else None,
+                }
+            return result
+
+
+_stats = WaitStats()
+
+
+def record_wait(provider, wait_time, name=None):
+    """记录一次请求的排队时间并输出日志"""
+    name = name or current_priority()
+    _stats.record(name, wait_time)
+    print(f"[请求调度] {provider} | 优先级: {name} | 排队: {wait_time:.2f}s")
+
+
+def get_stats():
+    """返回各优先级的排队时间统计"""
+    return _stats.snapshot()
@@ -0,0 +1,265 @@
+"""
+任务事件模块 - 批量任务的进度和单个条目的完成结果在发生时推送给订阅者
+/api/tasks/<task_id>/events 以 Server-Sent Events 转发，前端逐行更新，不再每秒轮询任务状态和刷新整个列表
+每个任务的事件按序号记入事件日志（进度只保留最新一条），断线重连或 /api/tasks/<task_id>?since=序号 只取增量
+"""
+import queue
+import threading
+from collections import deque
+
+
+# 默认参数（可通过 apikey.json 中的 "task_registry" 字段覆盖）
+DEFAULT_EVENT_SETTINGS = {
+    "event_log_size": 2000,     # 每个任务的事件日志最多保留的条目事件数
+}
+
+# 每个订阅者最多缓存的事件数，超出时丢弃缓存并通知客户端重新同步
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# 进度事件中包含的任务字段
+PROGRESS_FIELDS = ("status", "type", "total", "completed", "failed", "cached", "current_index", "current_id",
+                   "current_name", "workers", "in_flight", "resumed", "duplicates")
+
+# 任务结束时的状态
+FINISHED_STATUSES = ('completed', 'cancelled')
+
+EVENT_PROGRESS = 'progress'
+EVENT_ITEM = 'item'
+EVENT_RESYNC = 'resync'
+
+
+def progress_snapshot(task):
+    """任务字典中与进度有关的字段"""
+    return {key: task[key] for key in PROGRESS_FIELDS if key in task}
+
+
+class Subscription:
+    """一个客户端连接的事件队列"""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, seq, event, data):
+        try:
+            self.queue.put_nowait((seq, event, data))
+        except queue.Full:
+            # 客户端处理过慢：丢弃积压的事件，只保留一条重新同步通知
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put_nowait((seq, EVENT_RESYNC, {}))
+
+    def get(self, timeout):
+        """取出下一条事件 (序号, 事件名, 数据)，超时返回 None"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventLog:
+    """单个任务的事件日志：条目事件按序号保留最近 size 条，进度事件只保留最新一条"""
+
+    def __init__(self, size):
+        self.seq = 0
+        self._items = deque(maxlen=size)
+        self._progress = None
+        # 已被挤出日志的最大序号，早于它的增量查询无法补全
+        self._dropped_seq = 0
+
+    def append(self, event, data):
+        self.seq += 1
+        if event == EVENT_PROGRESS:
+            self._progress = (self.seq, event, data)
+        else:
+            if len(self._items) == self._items.maxlen:
+                self._dropped_seq = self._items[0][0]
+            self._items.append((self.seq, event, data))
+        return self.seq
+
+    def since(self, seq):
+        """
+        序号大于 seq 的事件
+
+        Returns:
+            tuple: (events, truncated)，events 为 [(序号, 事件名, 数据), ...]；
+                   truncated 为 True 表示部分事件已被挤出日志，客户端需要重新拉取完整状态
+        """
+        events = [item for item in self._items if item[0] > seq]
+        if self._progress is not None and self._progress[0] > seq:
+            events.append(self._progress)
+            events.sort(key=lambda item: item[0])
+        return events, seq < self._dropped_seq
+
+
+class TaskEventBus:
+    """按任务ID分发事件的发布 / 订阅中心，同时记录各任务的事件日志"""
+
+    def __init__(self):
+        self.log_size = DEFAULT_EVENT_SETTINGS['event_log_size']
+        self._lock = threading.Lock()
+        # task_id -> {Subscription, ...}
+        self._subscribers = {}
+        # task_id -> EventLog
+        self._logs = {}
+
+    def configure(self, event_settings=None):
+        """
+        更新配置（对之后新建的事件日志生效）
+
+        Args:
+            event_settings: dict，支持 event_log_size
+        """
+        size = (event_settings or {}).get('event_log_size', DEFAULT_EVENT_SETTINGS['event_log_size'])
+        try:
+            size = max(1, int(size))
+        except (TypeError, ValueError):
+            size = DEFAULT_EVENT_SETTINGS['event_log_size']
+        with self._lock:
+            self.log_size = size
+
+    def subscribe(self, task_id, since=None):
+        """
+        订阅任务事件
+
+        Args:
+            task_id: 任务ID
+            since: 断线重连时最后收到的事件序号（可选），同时返回此后的事件
+
+        Returns:
+            tuple: (subscription, backlog, truncated)，backlog 与之后推送的事件之间不重复也不遗漏
+        """
+        subscription = Subscription(task_id)
+        with self._lock:
+            self._subscribers.setdefault(task_id, set()).add(subscription)
+            backlog, truncated = [], False
+            if since is not None:
+                log = self._logs.get(task_id)
+                if log is not None:
+                    backlog, truncated = log.since(since)
+                else:
+                    truncated = since > 0
+        return subscription, backlog, truncated
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.task_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.task_id]
+
+    def publish(self, task_id, event, data):
+        # 在锁内记录并分发，保证各订阅者收到的事件按序号排列
+        with self._lock:
+            log = self._logs.get(task_id)
+            if log is None:
+                log = self._logs[task_id] = EventLog(self.log_size)
+            seq = log.append(event, data)
+            for subscription in self._subscribers.get(task_id) or ():
+                subscription.put(seq, event, data)
+        return seq
+
+    def events_since(self, task_id, since):
+        """
+        查询任务序号大于 since 的事件
+
+        Returns:
+            tuple: (events, latest_seq, truncated)
+        """
+        with self._lock:
+            log = self._logs.get(task_id)
+            if log is None:
+                return [], 0, since > 0
+            events, truncated = log.since(since)
+            return events, log.seq, truncated
+
+    def latest_seq(self, task_id):
+        with self._lock:
+            log = self._logs.get(task_id)
+            return log.seq if log is not None else 0
+
+    def discard(self, task_id):
+        """丢弃任务的事件日志（任务被淘汰时调用）"""
+        with self._lock:
+            self._logs.pop(task_id, None)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+_bus = TaskEventBus()
+
+
+def configure(event_settings=None):
+    """更新事件日志配置"""
+    _bus.configure(event_settings)
+
+
+def subscribe(task_id, since=None):
+    """订阅任务事件，返回 (Subscription, 补发的事件, 是否有事件已丢失)（用完后调用 unsubscribe）"""
+    return _bus.subscribe(task_id, since)
+
+
+def unsubscribe(subscription):
+    """取消订阅"""
+    _bus.unsubscribe(subscription)
+
+
+def subscriber_count():
+    """当前的订阅连接数"""
+    return _bus.subscriber_count()
+
+
+def events_since(task_id, since):
+    """查询任务序号大于 since 的事件，返回 (events, latest_seq, truncated)"""
+    return _bus.events_since(task_id, since)
+
+
+def latest_seq(task_id):
+    """任务最新的事件序号（没有事件时为 0）"""
+    return _bus.latest_seq(task_id)
+
+
+def discard(task_id):
+    """丢弃任务的事件日志"""
+    _bus.discard(task_id)
+
+
+def publish_progress(task, snapshot=None):
+    """
+    推送任务进度
+
+    Args:
+        task: processing_tasks 中的任务字典（需要包含 'id'）
+        snapshot: 已在任务锁内取得的进度快照（可选）
+    """
+    task_id = task.get('id')
+    if task_id:
+        _bus.publish(task_id, EVENT_PROGRESS, snapshot or progress_snapshot(task))
+
+
+def publish_item(task, item_id, status, text=None, error=None, fields=None):
+    """
+    推送单个条目的处理结果
+
+    Args:
+        task: 任务字典
+        item_id: 条目ID（图片 / 图片组ID）
+        status: 'success' / 'error'
+        text: 成功时的结果文本
+        error: 失败原因
+        fields: 附加到事件中的其他字段（可选，例如缩略图地址）
+    """
+    task_id = task.get('id')
+    if not task_id:
+        return
+    data = {"id": item_id, "status": status}
+    if text is not None:
+        data["text"] = text
+    if error is not None:
+        data["error"] = str(error)
+    if fields:
+        data.update(fields)
+    _bus.publish(task_id, EVENT_ITEM, data)
@@ -0,0 +1,159 @@
+"""
+任务注册表模块 - 保存 processing_tasks 中的批量任务，已结束的任务按存活时间和数量上限（最近最少访问）淘汰
+长时间运行时内存占用保持稳定；淘汰任务时一并释放其事件日志和翻译结果等附属数据
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+# 默认参数（可通过 apikey.json 中的 "task_registry" 字段覆盖）
+DEFAULT_TASK_SETTINGS = {
+    "finished_ttl": 1800,   # 已结束的任务保留秒数（0 表示不按时间淘汰）
+    "max_finished": 50,     # 最多保留的已结束任务数，超出后淘汰最久未访问的任务
+    "max_background": 20,   # 最多保留的已结束后台任务数（task['background'] 为真，如缩略图生成），不占用 max_finished 名额
+}
+
+# 视为已结束的任务状态
+FINISHED_STATUSES = ('completed', 'cancelled')
+
+
+class TaskRegistry:
+    """
+    批量任务注册表（按任务ID存取任务字典，用法与普通字典相同）
+
+    正在运行的任务不会被淘汰；已结束的任务超过 finished_ttl 秒或数量超过 max_finished 时淘汰
+    """
+
+    def __init__(self):
+        self.finished_ttl = DEFAULT_TASK_SETTINGS['finished_ttl']
+        self.max_finished = DEFAULT_TASK_SETTINGS['max_finished']
+        self.max_background = DEFAULT_TASK_SETTINGS['max_background']
+        self._lock = threading.RLock()
+        # task_id -> 任务字典，按最近访问排序（最近访问的在末尾）
+        self._tasks = OrderedDict()
+        # task_id -> 首次发现任务已结束的时间
+        self._finished_at = {}
+        self._evict_callbacks = []
+        self.evicted = 0
+
+    def configure(self, task_settings=None):
+        """
+        更新配置
+
+        Args:
+            task_settings: dict，支持 finished_ttl / max_finished / max_background
+        """
+        settings = dict(DEFAULT_TASK_SETTINGS)
+        for key, value in (task_settings or {}).items():
+            if key in settings:
+                settings[key] = value
+        with self._lock:
+            try:
+                self.finished_ttl = max(0.0, float(settings['finished_ttl']))
+            except (TypeError, ValueError):
+                self.finished_ttl = DEFAULT_TASK_SETTINGS['finished_ttl']
+            try:
+                self.max_finished = max(1, int(settings['max_finished']))
+            except (TypeError, ValueError):
+                self.max_finished = DEFAULT_TASK_SETTINGS['max_finished']
+            try:
+                self.max_background = max(1, int(settings['max_background']))
+            except (TypeError, ValueError):
+                self.max_background = DEFAULT_TASK_SETTINGS['max_background']
+        self.sweep()
+
+    def on_evict(self, callback):
+        """登记任务被淘汰时的回调 callback(task_id)，用于释放附属数据"""
+        if callback not in self._evict_callbacks:
+            self._evict_callbacks.append(callback)
+
+    def __setitem__(self, task_id, task):
+        with self._lock:
+            self._tasks[task_id] = task
+            self._tasks.move_to_end(task_id)
+            self._finished_at.pop(task_id, None)
+        self.sweep()
+
+    def __getitem__(self, task_id):
+        with self._lock:
+            task = self._tasks[task_id]
+            self._tasks.move_to_end(task_id)
+            return task
+
+    def __contains__(self, task_id):
+        with self._lock:
+            return task_id in self._tasks
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tasks)
+
+    def get(self, task_id, default=None):
+        with self._lock:
+            if task_id not in self._tasks:
+                return default
+            return self[task_id]
+
+    def values(self):
+        """全部任务（先执行一次淘汰）"""
+        self.sweep()
+        with self._lock:
+            return list(self._tasks.values())
+
+    def items(self):
+        self.sweep()
+        with self._lock:
+            return list(self._tasks.items())
+
+    def sweep(self):
+        """
+        淘汰超时和超出数量上限的已结束任务
+
+        Returns:
+            list: 被淘汰的任务ID
+        """
+        now = time.monotonic()
+        with self._lock:
+            # 批量任务与后台任务分别按各自的数量上限淘汰
+            finished = {False: [], True: []}
+            for task_id, task in self._tasks.items():
+                if task.get('status') in FINISHED_STATUSES:
+                    self._finished_at.setdefault(task_id, now)
+                    finished[bool(task.get('background'))].append(task_id)
+            evicted = []
+            for background, task_ids in finished.items():
+                # task_ids 按最近访问排序，超出数量上限时从最久未访问的开始淘汰
+                limit = self.max_background if background else self.max_finished
+                overflow = max(0, len(task_ids) - limit)
+                evicted += task_ids[:overflow]
+                if self.finished_ttl:
+                    evicted += [task_id for task_id in task_ids[overflow:]
+                                if now - self._finished_at[task_id] > self.finished_ttl]
+            for task_id in evicted:
+                del self._tasks[task_id]
+                del self._finished_at[task_id]
+            self.evicted += len(evicted)
+
+        for task_id in evicted:
+            for callback in list(self._evict_callbacks):
+                try:
+                    callback(task_id)
+                except Exception as e:
+                    print(f"[任务注册表] 释放任务 {task_id[:8]} 的数据失败: {e}")
+        return evicted
+
+    def stats(self):
+        """返回任务数统计（先执行一次淘汰）"""
+        self.sweep()
+        with self._lock:
+            finished = sum(1 for task in self._tasks.values() if task.get('status') in FINISHED_STATUSES)
+            return {
+                "tasks": len(self._tasks),
+                "running": len(self._tasks) - finished,
+                "finished": finished,
+                "evicted": self.evicted,
+                "finished_ttl": self.finished_ttl,
+                "max_finished": self.max_finished,
+                "max_background": self.max_background,
+            }
@@ -0,0 +1,407 @@
+"""
+缩略图缓存模块 - 缩略图按 (文件路径, 大小, 修改时间, 缩略图尺寸) 保存到磁盘，通过 /api/thumbnails/<缓存键> 提供
+图片列表中只保存缩略图地址，不再在内存和每次 /api/images、/api/pairs 响应中携带 Base64；
+原图修改后缓存键随之变化，浏览器可长期缓存同一地址。按磁盘预算做最近最少使用淘汰，被淘汰的缩略图在下次请求时重新生成
+导入图片时只登记尺寸和文本，缩略图由后台线程池（workers 个线程）生成，生成一张推送一张
+"""
+import io
+import os
+import json
+import base64
+import hashlib
+import binascii
+import threading
+from collections import OrderedDict
+from PIL import Image
+from image_decoder import open_for_size, fit_size
+from image_dedup import dhash, to_hex, hash_image_file
+from path_utils import API_CACHE_DIR
+
+
+# 默认缓存参数（可通过 apikey.json 中的 "thumbnail_cache" 字段覆盖）
+DEFAULT_THUMBNAIL_SETTINGS = {
+    "enabled": True,      # 是否启用缩略图缓存（关闭时缩略图以 Base64 保存在图片列表中）
+    "max_mb": 2048,       # 磁盘占用上限（MB），超出后按最近最少使用淘汰
+    "workers": 4,         # 导入后在后台生成缩略图的线程数
+    "max_sources": 20000, # 最多登记的重新生成函数数，超出后丢弃最久未使用的（对应缩略图被淘汰后不再重新生成）
+}
+
+# 缩略图尺寸（提高到1024x1024以保证清晰度）
+THUMBNAIL_SIZE = (1024, 1024)
+# 缩略图生成逻辑变化时递增，使旧缓存自动失效
+THUMBNAIL_VERSION = 1
+THUMBNAIL_SUFFIX = '.thumb'
+# 缩略图地址（缓存键为 SHA-256 十六进制）
+THUMBNAIL_URL = '/api/thumbnails/{key}'
+
+_PNG_SIGNATURE = b'\x89PNG'
+
+
+def render_thumbnail(image_path, size=THUMBNAIL_SIZE):
+    """
+    生成缩略图（保持 PNG 透明通道，无透明通道时保存为 JPEG）
+
+    Args:
+        image_path: 图片路径
+        size: 缩略图尺寸
+
+    Returns:
+        tuple: (图片字节, MIME 类型, dHash)
+    """
+    # 按缩略图尺寸降分辨率解码（JPEG 直接解码 1/2~1/8 尺寸），避免完整解码大图
+    with Image.open(image_path) as header:
+        thumb_size = fit_size(header.width, header.height, size[0], size[1])
+    img = open_for_size(image_path, thumb_size)
+
+    # 检查是否有透明通道
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    buffered = io.BytesIO()
+    if has_alpha:
+        # 保持透明通道，转换为 RGBA 后保存为 PNG
+        if img.mode in ('P', 'LA'):
+            img = img.convert('RGBA')
+        img.thumbnail(size, Image.Resampling.LANCZOS)
+        img.save(buffered, format="PNG")
+        mimetype = "image/png"
+    else:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail(size, Image.Resampling.LANCZOS)
+        img.save(buffered, format="JPEG", quality=95)
+        mimetype = "image/jpeg"
+    return buffered.getvalue(), mimetype, dhash(img)
+
+
+def to_data_uri(data, mimetype):
+    return f"data:{mimetype};base64,{base64.b64encode(data).decode()}"
+
+
+def parse_data_uri(data_uri):
+    """解析 Base64 data URI，返回 (图片字节, MIME 类型)，格式不正确时返回 None"""
+    if not isinstance(data_uri, str) or not data_uri.startswith('data:'):
+        return None
+    header, _, payload = data_uri.partition(',')
+    try:
+        return base64.b64decode(payload), header[5:].split(';')[0] or 'image/jpeg'
+    except (ValueError, binascii.Error):
+        return None
+
+
+def _sniff_mimetype(data):
+    return "image/png" if data[:4] == _PNG_SIGNATURE else "image/jpeg"
+
+
+class ThumbnailCache:
+    """缩略图的磁盘缓存（LRU，按总字节数限制）"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.enabled = DEFAULT_THUMBNAIL_SETTINGS['enabled']
+        self.max_bytes = DEFAULT_THUMBNAIL_SETTINGS['max_mb'] * 1024 * 1024
+        self.workers = DEFAULT_THUMBNAIL_SETTINGS['workers']
+        self.max_sources = DEFAULT_THUMBNAIL_SETTINGS['max_sources']
+
+        self._lock = threading.Lock()
+        # 缓存键 -> 文件大小，按最近使用顺序排列（旧 -> 新）
+        self._index = OrderedDict()
+        self._total_bytes = 0
+        self._scanned = False
+        # 缓存键 -> 重新生成函数 regenerate() -> (图片字节, MIME 类型)，缓存文件被淘汰后按需重新生成
+        # 按最近使用顺序排列（旧 -> 新），最多 max_sources 个
+        self._sources = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.regenerated = 0
+
+    def configure(self, cache_settings=None):
+        """
+        更新缓存配置
+
+        Args:
+            cache_settings: dict，支持 enabled / max_mb / workers / max_sources
+        """
+        settings = dict(DEFAULT_THUMBNAIL_SETTINGS)
+        for key, value in (cache_settings or {}).items():
+            if key in settings:
+                settings[key] = value
+        with self._lock:
+            self.enabled = bool(settings['enabled'])
+            try:
+                self.max_bytes = max(1, int(float(settings['max_mb']) * 1024 * 1024))
+            except (TypeError, ValueError):
+                self.max_bytes = DEFAULT_THUMBNAIL_SETTINGS['max_mb'] * 1024 * 1024
+            try:
+                self.workers = max(1, int(settings['workers']))
+            except (TypeError, ValueError):
+                self.workers = DEFAULT_THUMBNAIL_SETTINGS['workers']
+            try:
+                self.max_sources = max(1, int(settings['max_sources']))
+            except (TypeError, ValueError):
+                self.max_sources = DEFAULT_THUMBNAIL_SETTINGS['max_sources']
+            self._scan_locked()
+            self._evict_locked()
+            self._trim_sources_locked()
+
+    def _scan_locked(self):
+        """首次使用时扫描缓存目录，按文件修改时间恢复 LRU 顺序"""
+        if self._scanned:
+            return
+        self._scanned = True
+        if not os.path.isdir(self.cache_dir):
+            return
+        files = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(THUMBNAIL_SUFFIX):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, filename))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, filename[:-len(THUMBNAIL_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(files):
+            self._index[key] = size
+            self._total_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + THUMBNAIL_SUFFIX)
+
+    def _evict_locked(self):
+        while self._total_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            self.evicted += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _register_source_locked(self, key, regenerate):
+        self._sources[key] = regenerate
+        self._sources.move_to_end(key)
+        self._trim_sources_locked()
+
+    def _trim_sources_locked(self):
+        while len(self._sources) > self.max_sources:
+            # 只遗忘生成方式，缓存文件仍在时照常读取
+            self._sources.popitem(last=False)
+
+    @staticmethod
+    def make_key(image_path, size=THUMBNAIL_SIZE, variant=None):
+        """
+        计算缓存键（文件路径 + 大小 + 修改时间 + 缩略图尺寸 + 变体参数）
+
+        Args:
+            image_path: 图片文件路径
+            size: 缩略图尺寸
+            variant: 影响缩略图内容的其他参数（如裁剪参数，可选）
+
+        Returns:
+            str: 缓存键；文件不存在时返回 None
+        """
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        material = json.dumps({
+            "path": os.path.abspath(image_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "thumbnail_size": list(size),
+            "variant": variant,
+            "version": THUMBNAIL_VERSION,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def url(key):
+        return THUMBNAIL_URL.format(key=key)
+
+    def _contains(self, key):
+        with self._lock:
+            self._scan_locked()
+            return key in self._index
+
+    def _put(self, key, data):
+        """写入缓存（先写临时文件再替换，避免读取到写了一半的文件）"""
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[缩略图缓存] 写入失败: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        with self._lock:
+            self._scan_locked()
+            old_size = self._index.pop(key, None)
+            if old_size is not None:
+                self._total_bytes -= old_size
+            self._index[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict_locked()
+        return True
+
+    def thumbnail(self, image_path, size=THUMBNAIL_SIZE, with_hash=False):
+        """
+        获取图片的缩略图地址（未缓存时生成并写入缓存）
+
+        Args:
+            image_path: 图片路径
+            size: 缩略图尺寸
+            with_hash: 同时返回近似重复检测的 dHash（十六进制）
+
+        Returns:
+            str: 缩略图地址（缓存未启用时为 Base64 data URI）；with_hash 为 True 时返回 (缩略图, dHash)；
+                 失败时缩略图和 dHash 为 None
+        """
+        try:
+            key = self.make_key(image_path, size) if self.enabled else None
+            if key is not None:
+                with self._lock:
+                    self._register_source_locked(key, lambda: render_thumbnail(image_path, size)[:2])
+                if self._contains(key):
+                    with self._lock:
+                        self.hits += 1
+                    if not with_hash:
+                        return self.url(key)
+                    # 缓存命中时从缓存的缩略图计算哈希（小图降分辨率解码，不读取原图）
+                    value = hash_image_file(self._path(key))
+                    if value is not None:
+                        return self.url(key), to_hex(value)
+
+            data, mimetype, value = render_thumbnail(image_path, size)
+            if key is not None:
+                with self._lock:
+                    self.misses += 1
+                if self._put(key, data):
+                    thumbnail = self.url(key)
+                else:
+                    thumbnail = to_data_uri(data, mimetype)
+            else:
+                thumbnail = to_data_uri(data, mimetype)
+            return (thumbnail, to_hex(value)) if with_hash else thumbnail
+        except Exception as e:
+            print(f"❌ Error creating thumbnail for {image_path}: {e}")
+            return (None, None) if with_hash else None
+
+    def store_data_uri(self, data_uri, image_path, variant, regenerate=None):
+        """
+        把已生成的 Base64 缩略图（例如裁剪预览）写入缓存
+
+        Args:
+            data_uri: Base64 data URI
+            image_path: 原图路径（参与缓存键计算）
+            variant: 区分同一原图不同缩略图的参数（如裁剪参数）
+            regenerate: 缓存被淘汰后重新生成 data URI 的函数（可选）
+
+        Returns:
+            str: 缩略图地址；缓存未启用或写入失败时原样返回 data_uri
+        """
+        parsed = parse_data_uri(data_uri)
+        key = self.make_key(image_path, variant=variant) if self.enabled and parsed else None
+        if key is None or not self._put(key, parsed[0]):
+            return data_uri
+        if regenerate is not None:
+            with self._lock:
+                self._register_source_locked(key, lambda: parse_data_uri(regenerate()))
+        return self.url(key)
+
+    def read(self, key):
+        """
+        读取缓存的缩略图；缓存文件已被淘汰时按登记的生成函数重新生成
+
+        Returns:
+            tuple: (图片字节, MIME 类型)，未知的缓存键或生成失败时返回 None
+        """
+        path = self._path(key)
+        if self._contains(key):
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                # 更新修改时间，重启后仍能恢复最近使用顺序
+                os.utime(path, None)
+                with self._lock:
+                    self._index.move_to_end(key)
+                    if key in self._sources:
+                        self._sources.move_to_end(key)
+                return data, _sniff_mimetype(data)
+            except (OSError, KeyError):
+                with self._lock:
+                    size = self._index.pop(key, None)
+                    if size is not None:
+                        self._total_bytes -= size
+
+        with self._lock:
+            regenerate = self._sources.get(key)
+            if regenerate is not None:
+                self._sources.move_to_end(key)
+        if regenerate is None:
+            return None
+        try:
+            result = regenerate()
+        except Exception as e:
+            print(f"[缩略图缓存] 重新生成失败: {e}")
+            return None
+        if not result:
+            return None
+        with self._lock:
+            self.regenerated += 1
+        self._put(key, result[0])
+        return result
+
+    def clear(self):
+        """清空缓存文件、登记的重新生成函数和统计（之后按新导入的图片重新登记）"""
+        with self._lock:
+            self._scan_locked()
+            for key in list(self._index):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._index.clear()
+            self._sources.clear()
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evicted = 0
+            self.regenerated = 0
+
+    def stats(self):
+        """返回缓存统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._index),
+                "size_mb": round(self._total_bytes / (1024 * 1024), 2),
+                "max_mb": round(self.max_bytes / (1024 * 1024), 2),
+                "workers": self.workers,
+                "sources": len(self._sources),
+                "max_sources": self.max_sources,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+                "regenerated": self.regenerated,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_thumbnail_cache():
+    """获取全局缩略图缓存实例"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ThumbnailCache(os.path.join(API_CACHE_DIR, 'thumbnails'))
+        return _cache
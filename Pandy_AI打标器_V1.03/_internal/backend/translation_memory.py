@@ -0,0 +1,219 @@
+"""
+翻译记忆模块 - 以 (原文哈希, 目标语言, 模型) 为键持久化保存译文
+批量翻译和单条翻译先查询翻译记忆，未修改过的标签重复翻译时直接返回，不再请求 API
+需要 sqlite3；不可用时 SQLITE_AVAILABLE 为 False，翻译记忆不生效
+"""
+import os
+import time
+import hashlib
+import threading
+from path_utils import API_CACHE_DIR
+
+try:
+    import sqlite3
+    SQLITE_AVAILABLE = True
+except ImportError:
+    sqlite3 = None
+    SQLITE_AVAILABLE = False
+
+
+# 默认参数（可通过 apikey.json 中的 "translation_memory" 字段覆盖）
+DEFAULT_MEMORY_SETTINGS = {
+    "enabled": True,            # 是否启用翻译记忆
+    "max_entries": 100000,      # 最多保留的条目数，超出后按最近使用时间淘汰
+}
+
+# SQLite 单条语句的参数上限较低，批量查询时分段执行
+QUERY_CHUNK = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS memory (
+    text_hash TEXT NOT NULL,
+    target_lang TEXT NOT NULL,
+    model TEXT NOT NULL,
+    translated TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (text_hash, target_lang, model)
+);
+CREATE INDEX IF NOT EXISTS idx_memory_last_used ON memory (last_used);
+"""
+
+
+def hash_text(text):
+    """原文的 SHA-256（去掉首尾空白后计算）"""
+    return hashlib.sha256((text or '').strip().encode('utf-8')).hexdigest()
+
+
+class TranslationMemory:
+    """翻译记忆（SQLite 持久化）"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.enabled = SQLITE_AVAILABLE and DEFAULT_MEMORY_SETTINGS['enabled']
+        self.max_entries = DEFAULT_MEMORY_SETTINGS['max_entries']
+        self._lock = threading.Lock()
+        self._conn = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, memory_settings=None):
+        """
+        更新配置
+
+        Args:
+            memory_settings: dict，支持 enabled / max_entries
+        """
+        settings = dict(DEFAULT_MEMORY_SETTINGS)
+        for key, value in (memory_settings or {}).items():
+            if key in settings:
+                settings[key] = value
+        if settings['enabled'] and not SQLITE_AVAILABLE:
+            print("[翻译记忆] 当前环境缺少 sqlite3，翻译记忆不可用")
+        with self._lock:
+            self.enabled = SQLITE_AVAILABLE and bool(settings['enabled'])
+            try:
+                self.max_entries = max(1, int(settings['max_entries']))
+            except (TypeError, ValueError):
+                self.max_entries = DEFAULT_MEMORY_SETTINGS['max_entries']
+
+    def _connect_locked(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, texts, target_lang, model):
+        """
+        批量查询译文
+
+        Args:
+            texts: 原文列表
+            target_lang: 目标语言（'en' / 'zh'，None 表示自动检测）
+            model: 翻译模型
+
+        Returns:
+            dict: {原文: 译文}，只包含命中的原文
+        """
+        texts = [text for text in dict.fromkeys(texts) if text and text.strip()]
+        if not texts:
+            return {}
+        hashes = {}
+        for text in texts:
+            hashes.setdefault(hash_text(text), []).append(text)
+        keys = list(hashes)
+        found = {}
+        with self._lock:
+            if not self.enabled:
+                return {}
+            try:
+                conn = self._connect_locked()
+                for start in range(0, len(keys), QUERY_CHUNK):
+                    chunk = keys[start:start + QUERY_CHUNK]
+                    rows = conn.execute(
+                        f"SELECT text_hash, translated FROM memory WHERE target_lang = ? AND model = ? "
+                        f"AND text_hash IN ({', '.join('?' * len(chunk))})",
+                        [target_lang or 'auto', model or ''] + chunk
+                    ).fetchall()
+                    found.update(rows)
+                if found:
+                    with conn:
+                        conn.executemany(
+                            "UPDATE memory SET last_used = ? WHERE text_hash = ? AND target_lang = ? AND model = ?",
+                            [(time.time(), text_hash, target_lang or 'auto', model or '') for text_hash in found]
+                        )
+            except sqlite3.Error as e:
+                print(f"[翻译记忆] 读取失败: {e}")
+                return {}
+            result = {text: found[text_hash] for text_hash, group in hashes.items() if text_hash in found
+                      for text in group}
+            self.hits += len(result)
+            self.misses += len(texts) - len(result)
+        return result
+
+    def get(self, text, target_lang, model):
+        """查询单条译文，未命中时返回 None"""
+        return self.get_many([text], target_lang, model).get(text)
+
+    def put_many(self, translations, target_lang, model):
+        """
+        批量保存译文
+
+        Args:
+            translations: {原文: 译文}
+            target_lang: 目标语言
+            model: 翻译模型
+        """
+        rows = [(hash_text(text), target_lang or 'auto', model or '', translated, time.time())
+                for text, translated in translations.items() if text and text.strip() and translated]
+        if not rows:
+            return
+        with self._lock:
+            if not self.enabled:
+                return
+            try:
+                conn = self._connect_locked()
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO memory VALUES (?, ?, ?, ?, ?)", rows)
+                    overflow = conn.execute("SELECT COUNT(*) FROM memory").fetchone()[0] - self.max_entries
+                    if overflow > 0:
+                        conn.execute(
+                            "DELETE FROM memory WHERE rowid IN "
+                            "(SELECT rowid FROM memory ORDER BY last_used LIMIT ?)", (overflow,)
+                        )
+            except sqlite3.Error as e:
+                print(f"[翻译记忆] 写入失败: {e}")
+
+    def put(self, text, translated, target_lang, model):
+        """保存单条译文"""
+        self.put_many({text: translated}, target_lang, model)
+
+    def clear(self):
+        """清空翻译记忆和统计"""
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            if not self.enabled:
+                return
+            try:
+                conn = self._connect_locked()
+                with conn:
+                    conn.execute("DELETE FROM memory")
+            except sqlite3.Error as e:
+                print(f"[翻译记忆] 清空失败: {e}")
+
+    def stats(self):
+        """返回翻译记忆统计"""
+        with self._lock:
+            entries = 0
+            if self.enabled:
+                try:
+                    entries = self._connect_locked().execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+                except sqlite3.Error as e:
+                    print(f"[翻译记忆] 读取失败: {e}")
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_memory = None
+_memory_lock = threading.Lock()
+
+
+def get_translation_memory():
+    """获取全局翻译记忆实例"""
+    global _memory
+    with _memory_lock:
+        if _memory is None:
+            _memory = TranslationMemory(os.path.join(API_CACHE_DIR, 'translation_memory.db'))
+        return _memory
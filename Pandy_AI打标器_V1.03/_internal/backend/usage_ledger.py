@@ -0,0 +1,281 @@
+"""
+用量账本模块 - 记录每次 API 调用返回的 usage（输入 / 输出 / 图片 token）
+按批量任务汇总到 processing_tasks，按天 + 渠道 + 模型持久化到 SQLite，并统计实时 token/秒 与 图片/分钟
+需要 sqlite3；不可用时 SQLITE_AVAILABLE 为 False，用量只在内存中统计
+"""
+import os
+import time
+import atexit
+import threading
+import contextvars
+from collections import deque
+from datetime import date
+from path_utils import USAGE_DIR
+
+try:
+    import sqlite3
+    SQLITE_AVAILABLE = True
+except ImportError:
+    sqlite3 = None
+    SQLITE_AVAILABLE = False
+
+
+# 默认参数（可通过 apikey.json 中的 "usage_ledger" 字段覆盖）
+DEFAULT_USAGE_SETTINGS = {
+    "enabled": True,        # 是否持久化用量账本
+    "keep_days": 365,       # 账本保留天数（0 表示不清理）
+}
+
+# 内存中累计的用量写入数据库的间隔秒数（程序退出时也会写入）
+FLUSH_INTERVAL = 10
+# 实时吞吐的统计窗口（秒）
+RATE_WINDOW = 60
+
+USAGE_FIELDS = ("requests", "images", "prompt_tokens", "completion_tokens", "image_tokens", "total_tokens")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    day TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    model TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    images INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    image_tokens INTEGER NOT NULL,
+    total_tokens INTEGER NOT NULL,
+    PRIMARY KEY (day, provider, model, kind)
+);
+"""
+
+# 当前调用所属的批量任务（processing_tasks 中的任务字典），由批量执行引擎设置
+_current_task = contextvars.ContextVar('usage_task', default=None)
+_task_lock = threading.Lock()
+
+
+def set_task(task):
+    """设置当前上下文（线程或协程）的用量归属任务，并初始化任务的用量汇总"""
+    with _task_lock:
+        if 'usage' not in task:
+            task['usage'] = dict({field: 0 for field in USAGE_FIELDS}, started=time.time(),
+                                 tokens_per_second=0.0, images_per_minute=0.0)
+    return _current_task.set(task)
+
+
+def parse_usage(usage):
+    """
+    统一各渠道 usage 字段的格式
+
+    Returns:
+        dict: {prompt_tokens, completion_tokens, image_tokens, total_tokens}；没有 usage 时返回 None
+    """
+    if not isinstance(usage, dict):
+        return None
+
+    def _int(value):
+        try:
+            return max(0, int(value or 0))
+        except (TypeError, ValueError):
+            return 0
+
+    prompt = _int(usage.get('prompt_tokens', usage.get('input_tokens')))
+    completion = _int(usage.get('completion_tokens', usage.get('output_tokens')))
+    details = usage.get('prompt_tokens_details') or usage.get('input_tokens_details') or {}
+    image = _int(details.get('image_tokens') if isinstance(details, dict) else 0) or _int(usage.get('image_tokens'))
+    total = _int(usage.get('total_tokens')) or prompt + completion
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "image_tokens": image, "total_tokens": total}
+
+
+class UsageLedger:
+    """用量账本（内存累计 + 定期写入 SQLite）"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.enabled = SQLITE_AVAILABLE and DEFAULT_USAGE_SETTINGS['enabled']
+        self.keep_days = DEFAULT_USAGE_SETTINGS['keep_days']
+        self._lock = threading.Lock()
+        self._conn = None
+        # (day, provider, model, kind) -> {field: value}，尚未写入数据库的部分
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        # 启动以来的累计用量（按渠道）
+        self._session = {}
+        # 最近 RATE_WINDOW 秒的 (时间, token 数, 图片数)
+        self._recent = deque()
+
+    def configure(self, usage_settings=None):
+        """
+        更新配置
+
+        Args:
+            usage_settings: dict，支持 enabled / keep_days
+        """
+        settings = dict(DEFAULT_USAGE_SETTINGS)
+        for key, value in (usage_settings or {}).items():
+            if key in settings:
+                settings[key] = value
+        if settings['enabled'] and not SQLITE_AVAILABLE:
+            print("[用量账本] 当前环境缺少 sqlite3，用量只在内存中统计")
+        with self._lock:
+            self.enabled = SQLITE_AVAILABLE and bool(settings['enabled'])
+            try:
+                self.keep_days = max(0, int(settings['keep_days']))
+            except (TypeError, ValueError):
+                self.keep_days = DEFAULT_USAGE_SETTINGS['keep_days']
+
+    def record(self, provider, model, usage, kind, images=0):
+        """
+        记录一次 API 调用的用量
+
+        Args:
+            provider: 渠道标识
+            model: 模型名
+            usage: 响应中的 usage 字段（缺失时只统计请求数和图片数）
+            kind: 调用类型（vision / translate / analyze / chat）
+            images: 本次请求包含的图片数
+
+        Returns:
+            dict: parse_usage 的结果（没有 usage 时为全 0）
+        """
+        parsed = parse_usage(usage) or {"prompt_tokens": 0, "completion_tokens": 0, "image_tokens": 0, "total_tokens": 0}
+        delta = dict(parsed, requests=1, images=images)
+        now = time.monotonic()
+        key = (date.today().isoformat(), provider or '', model or '', kind)
+
+        with self._lock:
+            for bucket in (self._pending.setdefault(key, dict.fromkeys(USAGE_FIELDS, 0)),
+                           self._session.setdefault(provider or '', dict.fromkeys(USAGE_FIELDS, 0))):
+                for field in USAGE_FIELDS:
+                    bucket[field] += delta[field]
+            self._recent.append((now, parsed['total_tokens'], images))
+            self._trim_locked(now)
+            flush_due = now - self._last_flush >= FLUSH_INTERVAL
+
+        task = _current_task.get()
+        if task is not None:
+            self._add_to_task(task, delta)
+        if flush_due:
+            self.flush()
+        return parsed
+
+    @staticmethod
+    def _add_to_task(task, delta):
+        with _task_lock:
+            usage = task.get('usage')
+            if usage is None:
+                return
+            for field in USAGE_FIELDS:
+                usage[field] += delta[field]
+            elapsed = max(1e-6, time.time() - usage['started'])
+            usage['tokens_per_second'] = round(usage['total_tokens'] / elapsed, 2)
+            usage['images_per_minute'] = round(usage['images'] * 60 / elapsed, 2)
+
+    def _trim_locked(self, now):
+        while self._recent and self._recent[0][0] < now - RATE_WINDOW:
+            self._recent.popleft()
+
+    def _connect_locked(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def flush(self):
+        """将内存中累计的用量写入数据库"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            if not pending or not self.enabled:
+                return
+            try:
+                conn = self._connect_locked()
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (day, provider, model, kind) DO UPDATE SET "
+                        + ", ".join(f"{field} = {field} + excluded.{field}" for field in USAGE_FIELDS),
+                        [key + tuple(values[field] for field in USAGE_FIELDS) for key, values in pending.items()]
+                    )
+                    if self.keep_days:
+                        cutoff = date.fromordinal(date.today().toordinal() - self.keep_days).isoformat()
+                        conn.execute("DELETE FROM usage WHERE day < ?", (cutoff,))
+            except sqlite3.Error as e:
+                print(f"[用量账本] 写入失败: {e}")
+
+    def query(self, days=30):
+        """
+        读取最近 days 天的账本（按天 + 渠道 + 模型 + 调用类型）
+
+        Returns:
+            list: [{'day', 'provider', 'model', 'kind', 'requests', 'images', 'prompt_tokens', ...}, ...]
+        """
+        self.flush()
+        with self._lock:
+            if not self.enabled:
+                return []
+            since = date.fromordinal(date.today().toordinal() - max(0, int(days)) + 1).isoformat()
+            try:
+                conn = self._connect_locked()
+                rows = conn.execute(
+                    "SELECT * FROM usage WHERE day >= ? ORDER BY day DESC, provider, model, kind", (since,)
+                ).fetchall()
+            except sqlite3.Error as e:
+                print(f"[用量账本] 读取失败: {e}")
+                return []
+        columns = ("day", "provider", "model", "kind") + USAGE_FIELDS
+        return [dict(zip(columns, row)) for row in rows]
+
+    def live(self):
+        """
+        启动以来各渠道的累计用量与最近 RATE_WINDOW 秒的实时吞吐
+
+        Returns:
+            dict: {'session': {provider: {...}}, 'tokens_per_second', 'images_per_minute'}
+        """
+        with self._lock:
+            self._trim_locked(time.monotonic())
+            tokens = sum(item[1] for item in self._recent)
+            images = sum(item[2] for item in self._recent)
+            return {
+                "session": {provider: dict(values) for provider, values in self._session.items()},
+                "tokens_per_second": round(tokens / RATE_WINDOW, 2),
+                "images_per_minute": round(images * 60 / RATE_WINDOW, 2),
+            }
+
+    def metric_families(self):
+        """供 /api/metrics 输出的用量指标"""
+        live = self.live()
+        families = [
+            ('pandy_tokens_per_second', 'gauge', f'最近 {RATE_WINDOW} 秒的 token 吞吐（token/秒）',
+             [({}, live['tokens_per_second'])]),
+            ('pandy_images_per_minute', 'gauge', f'最近 {RATE_WINDOW} 秒请求的图片数（张/分钟）',
+             [({}, live['images_per_minute'])]),
+        ]
+        for field in ("prompt_tokens", "completion_tokens", "image_tokens"):
+            families.append((f'pandy_{field}_total', 'counter', f'启动以来各渠道的 {field} 累计值',
+                             [({'provider': provider}, values[field]) for provider, values in sorted(live['session'].items())]))
+        return families
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger():
+    """获取全局用量账本实例"""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger(os.path.join(USAGE_DIR, 'usage.db'))
+            atexit.register(_ledger.flush)
+        return _ledger
+
+
+def record(provider, model, usage, kind, images=0):
+    """记录一次 API 调用的用量（参数同 UsageLedger.record）"""
+    return get_usage_ledger().record(provider, model, usage, kind, images)
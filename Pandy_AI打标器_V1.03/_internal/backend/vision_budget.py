@@ -0,0 +1,183 @@
+"""
+视觉输入预算模块 - 按模型的视觉 token 计费规则选择图片输入尺寸，并估算每张图片的视觉 token
+Qwen-VL 系列按像素块计 token，GPT-4o 系列按 512px 分块计 token；
+在满足细节档位的前提下选择最小的输入尺寸，减少视觉 token、请求耗时和费用
+"""
+import math
+import threading
+
+
+# 默认预算参数（可通过 apikey.json 中的 "vision_budget" 字段覆盖）
+DEFAULT_BUDGET_SETTINGS = {
+    "detail": "high",       # 细节档位：low / medium / high
+    "max_tokens": None,     # 单张图片视觉 token 上限（仅按像素块计费的模型生效，为空时按档位）
+}
+
+DETAIL_LEVELS = ("low", "medium", "high")
+
+# 按像素块计费模型的档位：长边上限 + 视觉 token 上限（high 的长边与旧版 1024 上限一致）
+PATCH_LEVELS = {
+    "low": {"max_side": 512, "max_tokens": 256},
+    "medium": {"max_side": 768, "max_tokens": 576},
+    "high": {"max_side": 1024, "max_tokens": 1024},
+}
+# 按分块计费模型的档位：长边/短边上限（low 为 1 块，medium 不超过 2 块，high 不超过 4 块）
+TILE_LEVELS = {
+    "low": {"max_side": 512, "max_short": 512},
+    "medium": {"max_side": 1024, "max_short": 512},
+    "high": {"max_side": 1024, "max_short": 1024},
+}
+
+# 各模型系列的视觉 token 规则，按 match 中的关键字匹配模型名（先匹配先生效）
+# - patch：每个视觉 token 对应 patch x patch 像素
+# - tile：按 tile 像素分块，token = base_tokens + tile_tokens * 块数
+# - side：未知模型，只按档位限制长边，token 按 28px 像素块近似估算
+MODEL_PROFILES = [
+    {"name": "qwen3-vl", "match": ("qwen3-vl",), "mode": "patch", "patch": 32,
+     "min_tokens": 4, "max_tokens": 16384, "levels": PATCH_LEVELS},
+    {"name": "qwen2.5-vl", "match": ("qwen2.5-vl", "qwen2-vl", "qvq"), "mode": "patch", "patch": 28,
+     "min_tokens": 4, "max_tokens": 16384, "levels": PATCH_LEVELS},
+    {"name": "gpt-4o-mini", "match": ("gpt-4o-mini",), "mode": "tile", "tile": 512,
+     "base_tokens": 2833, "tile_tokens": 5667, "levels": TILE_LEVELS},
+    {"name": "gpt-4o", "match": ("gpt-4o", "chatgpt-4o", "gpt-4-turbo", "gpt-4.1"), "mode": "tile", "tile": 512,
+     "base_tokens": 85, "tile_tokens": 170, "levels": TILE_LEVELS},
+]
+
+DEFAULT_PROFILE = {"name": "default", "match": (), "mode": "side", "patch": 28,
+                   "levels": {"low": {"max_side": 512}, "medium": {"max_side": 768}, "high": {"max_side": 1024}}}
+
+_settings = dict(DEFAULT_BUDGET_SETTINGS)
+_lock = threading.Lock()
+
+
+def configure(budget_settings=None):
+    """
+    更新预算配置
+
+    Args:
+        budget_settings: dict，支持 detail / max_tokens
+    """
+    global _settings
+    settings = dict(DEFAULT_BUDGET_SETTINGS)
+    for key, value in (budget_settings or {}).items():
+        if key in settings:
+            settings[key] = value
+    if settings['detail'] not in DETAIL_LEVELS:
+        print(f"[视觉预算] 未知的细节档位: {settings['detail']}，使用 {DEFAULT_BUDGET_SETTINGS['detail']}")
+        settings['detail'] = DEFAULT_BUDGET_SETTINGS['detail']
+    try:
+        settings['max_tokens'] = int(settings['max_tokens']) if settings['max_tokens'] else None
+    except (TypeError, ValueError):
+        settings['max_tokens'] = None
+    with _lock:
+        _settings = settings
+
+
+def get_settings():
+    """当前预算配置"""
+    with _lock:
+        return dict(_settings)
+
+
+def get_profile(model):
+    """按模型名匹配 token 规则，未知模型返回 DEFAULT_PROFILE"""
+    name = (model or '').lower()
+    for profile in MODEL_PROFILES:
+        if any(key in name for key in profile['match']):
+            return profile
+    return DEFAULT_PROFILE
+
+
+def _token_limit(profile, settings):
+    limit = profile['levels'][settings['detail']]['max_tokens']
+    if settings['max_tokens']:
+        limit = min(limit, settings['max_tokens'])
+    return max(profile['min_tokens'], min(profile['max_tokens'], limit))
+
+
+def _fit(width, height, max_long, max_short):
+    """等比缩小到长边/短边上限以内（不放大）"""
+    scale = min(1.0, max_long / max(width, height), max_short / min(width, height))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def target_size(model, width, height):
+    """
+    计算图片送入模型前的目标尺寸（只缩小不放大）
+
+    Args:
+        model: 模型名
+        width, height: 裁剪后的图片尺寸
+
+    Returns:
+        tuple: (width, height)
+    """
+    if width <= 0 or height <= 0:
+        return width, height
+    profile = get_profile(model)
+    settings = get_settings()
+    level = profile['levels'][settings['detail']]
+
+    if profile['mode'] == 'side':
+        return _fit(width, height, level['max_side'], level['max_side'])
+
+    if profile['mode'] == 'tile':
+        return _fit(width, height, level['max_side'], level['max_short'])
+
+    # 按像素块计费：先按长边和 token 上限等比缩小，再向下取整到 patch 的整数倍，
+    # 避免服务端向上取整多计一行/一列 token
+    patch = profile['patch']
+    max_pixels = _token_limit(profile, settings) * patch * patch
+    scale = min(1.0, level['max_side'] / max(width, height), math.sqrt(max_pixels / (width * height)))
+    new_width = max(patch, int(width * scale) // patch * patch)
+    new_height = max(patch, int(height * scale) // patch * patch)
+    if new_width >= width and new_height >= height:
+        # 小于一个 patch 的图片保持原样，由服务端补齐
+        return width, height
+    return new_width, new_height
+
+
+def estimate_tokens(model, width, height):
+    """
+    估算一张图片的视觉 token 数（按 target_size 缩放后的尺寸计算）
+
+    Returns:
+        int: 视觉 token 估算值
+    """
+    width, height = target_size(model, width, height)
+    if width <= 0 or height <= 0:
+        return 0
+    profile = get_profile(model)
+    if profile['mode'] == 'tile':
+        # 服务端分块前还会把图片缩放到 2048 以内、短边 768 以内
+        width, height = _fit(width, height, 2048, 768)
+        tiles = math.ceil(width / profile['tile']) * math.ceil(height / profile['tile'])
+        return profile['base_tokens'] + profile['tile_tokens'] * tiles
+    # 按像素块计费的模型（以及未知模型的近似估算）
+    patch = profile['patch']
+    return max(1, round(width / patch)) * max(1, round(height / patch))
+
+
+def cache_variant(model):
+    """影响预处理结果的预算参数（用于请求图片缓存键）"""
+    settings = get_settings()
+    return {"profile": get_profile(model)['name'], "detail": settings['detail'], "max_tokens": settings['max_tokens']}
+
+
+def describe():
+    """返回当前配置与各模型系列的预算表"""
+    settings = get_settings()
+    profiles = []
+    for profile in MODEL_PROFILES + [DEFAULT_PROFILE]:
+        item = {"name": profile['name'], "match": list(profile['match']), "mode": profile['mode'],
+                "levels": profile['levels']}
+        if profile['mode'] == 'patch':
+            item['patch'] = profile['patch']
+            item['token_limit'] = _token_limit(profile, settings)
+            item['max_pixels'] = item['token_limit'] * profile['patch'] ** 2
+        elif profile['mode'] == 'tile':
+            item['tile'] = profile['tile']
+            item['base_tokens'] = profile['base_tokens']
+            item['tile_tokens'] = profile['tile_tokens']
+        profiles.append(item)
+    return {"settings": settings, "profiles": profiles}
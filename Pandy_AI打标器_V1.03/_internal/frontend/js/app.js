@@ -42,6 +42,7 @@ function taggerApp() {
         progress: 0,
         taskStatus: {},
         currentTaskId: null,
+        watchedThumbnailTasks: [],  // 已订阅的后台缩略图任务ID
         lastFailedIds: [],  // 上次失败的图片/组ID
         lastFailedType: '',  // 上次失败的类型: 'images' 或 'pairs'
         isImporting: false,
@@ -156,6 +157,7 @@ function taggerApp() {
         imageExportFormat: 'png',      // 单图导出格式
         imageExportOutputType: 'zip',  // 单图导出类型
         imageExportPath: '',           // 单图导出路径
+        imageExportSkipDuplicates: false,  // 单图导出时跳过近似重复的图片
         exportImageFormat: 'png',
         exportOutputDir: '',
         exportFileName: '',
@@ -248,6 +250,7 @@ function taggerApp() {
         chatMessages: [],
         chatInput: '',
         isChatLoading: false,
+        isChatStreaming: false,  // 已开始接收流式回复
         chatModel: 'Qwen/Qwen2.5-7B-Instruct',
         chatSessions: [],
         currentChatSessionId: null,
@@ -1336,6 +1339,82 @@ function taggerApp() {
             return result;
         },
 
+        // 流式请求（Server-Sent Events），onDelta 接收文本增量，返回 done / error 事件的数据
+        async streamCall(endpoint, data, onDelta) {
+            const response = await fetch(`/api/${endpoint}`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ ...(data || {}), stream: true })
+            });
+
+            const contentType = response.headers.get('Content-Type') || '';
+            let result = null;
+            if (!contentType.includes('text/event-stream') || !response.body) {
+                // 参数校验失败等情况仍返回普通 JSON
+                try {
+                    const text = await response.text();
+                    result = text ? JSON.parse(text) : null;
+                } catch (e) {
+                    result = null;
+                }
+            } else {
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder('utf-8');
+                let buffer = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+
+                    let sep;
+                    while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                        const block = buffer.slice(0, sep);
+                        buffer = buffer.slice(sep + 2);
+
+                        let event = 'message';
+                        let payload = '';
+                        for (const line of block.split('\n')) {
+                            if (line.startsWith('event:')) {
+                                event = line.slice(6).trim();
+                            } else if (line.startsWith('data:')) {
+                                payload += line.slice(5).trim();
+                            }
+                        }
+                        if (!payload) continue;
+
+                        // 与非流式分支一致：无法解析的数据块直接跳过，缺少结束事件时按异常结束提示
+                        let parsed;
+                        try {
+                            parsed = JSON.parse(payload);
+                        } catch (e) {
+                            console.warn('忽略无法解析的流式数据块:', payload);
+                            continue;
+                        }
+                        if (event === 'done' || event === 'error') {
+                            result = parsed;
+                        } else if (parsed.delta && onDelta) {
+                            onDelta(parsed.delta);
+                        }
+                    }
+                }
+            }
+
+            if (!result || typeof result !== 'object') {
+                result = {
+                    success: false,
+                    message: `流式响应异常结束: /api/${endpoint} (HTTP ${response.status})`
+                };
+            }
+
+            if (!result.success && result.message) {
+                this.showNotification(result.message, 'error');
+            }
+
+            return result;
+        },
+
         // 加载配置
         async loadConfig() {
             const result = await this.apiCall('config');
@@ -1689,6 +1768,8 @@ function taggerApp() {
                 
                 // 更新图片列表
                 this.images = result.images;
+                // 仍在后台生成的缩略图（页面刷新或启动时恢复任务）继续逐张显示
+                (result.thumbnail_task_ids || []).forEach(taskId => this.watchThumbnails(taskId, 'images'));
                 
                 // 恢复 chineseText
                 this.images.forEach(img => {
@@ -1712,6 +1793,7 @@ function taggerApp() {
                 
                 // 更新图片对列表
                 this.pairs = result.pairs;
+                (result.thumbnail_task_ids || []).forEach(taskId => this.watchThumbnails(taskId, 'pairs'));
                 
                 // 恢复 chineseText
                 this.pairs.forEach(pair => {
@@ -2083,6 +2165,7 @@ function taggerApp() {
                 
                 if (result.success) {
                     this.images = result.images;
+                    this.watchThumbnails(result.thumbnail_task_id, 'images');
                     // 直接加载，无需二次确认
                 } else {
                     alert('导入失败: ' + (result.message || '未知错误'));
@@ -2129,6 +2212,7 @@ function taggerApp() {
                         const result = await this.apiCall('select-folder', 'POST', { path });
                         if (result.success) {
                             this.images = result.images;
+                            this.watchThumbnails(result.thumbnail_task_id, 'images');
                             this.showNotification(`已添加 ${result.added} 张图片`, 'success');
                         }
                     }
@@ -2140,6 +2224,7 @@ function taggerApp() {
                         const folderResult = await this.apiCall('select-folder', 'POST', { path: result.path });
                         if (folderResult.success) {
                             this.images = folderResult.images;
+                            this.watchThumbnails(folderResult.thumbnail_task_id, 'images');
                             this.showNotification(`已添加 ${folderResult.added} 张图片`, 'success');
                         }
                     }
@@ -2154,6 +2239,7 @@ function taggerApp() {
             const result = await this.apiCall('images/add', 'POST', { paths });
             if (result.success) {
                 this.images = result.images;
+                this.watchThumbnails(result.thumbnail_task_id, 'images');
                 this.showNotification(`已添加 ${result.added} 张图片`, 'success');
             }
         },
@@ -2245,6 +2331,7 @@ function taggerApp() {
                 
                 if (importResult.success) {
                     this.pairs = importResult.pairs;
+                    this.watchThumbnails(importResult.thumbnail_task_id, 'pairs');
                     this.showNotification(`已导入 ${importResult.added} 组匹配图片`, 'success');
                 } else {
                     this.showNotification(importResult.message, 'warning');
@@ -2351,6 +2438,20 @@ function taggerApp() {
             this.images.forEach(img => img.selected = !allSelected);
         },
 
+        // 选中近似重复的图片（每组第一张为保留的代表图片，不选中）
+        async selectDuplicateImages() {
+            const result = await this.apiCall('images/duplicates', 'GET');
+            if (!result.success) {
+                alert('查找重复失败: ' + (result.message || '未知错误'));
+                return;
+            }
+            const duplicateIds = new Set(result.clusters.flatMap(cluster => cluster.ids.slice(1)));
+            this.images.forEach(img => img.selected = duplicateIds.has(img.id));
+            alert(duplicateIds.size > 0
+                ? `找到 ${result.clusters.length} 组近似重复，已选中 ${duplicateIds.size} 张重复图片（每组保留第一张）`
+                : '没有找到近似重复的图片');
+        },
+
         // 打开详情
         openDetail(imageId) {
             this.detailImage = { ...this.images.find(img => img.id === imageId) };
@@ -2915,9 +3016,21 @@ function taggerApp() {
                 }
             }
             
+            const previousText = this.detailImage && this.detailImage.id === imageId ? this.detailImage.text : null;
             try {
                 this.showNotification('正在处理中...', 'info');
-                const result = await this.apiCall(`images/tag/${imageId}`, 'POST');
+                // 流式接收，边生成边显示
+                let streamedText = '';
+                const result = await this.streamCall(`images/tag/${imageId}`, {}, (delta) => {
+                    streamedText += delta;
+                    if (this.detailImage && this.detailImage.id === imageId) {
+                        this.detailImage.text = streamedText;
+                    }
+                });
+                
+                if (!result.success && this.detailImage && this.detailImage.id === imageId && previousText !== null) {
+                    this.detailImage.text = previousText;
+                }
                 
                 if (result.success) {
                     const index = this.images.findIndex(img => img.id === imageId);
@@ -2965,37 +3078,29 @@ function taggerApp() {
                 this.currentTaskId = taskId;
                 this.showNotification(result.message, 'info');
                 
-                // 轮询任务状态
-                const pollInterval = setInterval(async () => {
-                    const statusResult = await this.apiCall(`tasks/${taskId}`);
-                    if (statusResult.success) {
-                        this.taskStatus = statusResult.task;
-                        this.progress = (statusResult.task.completed / statusResult.task.total) * 100;
-                        
-                        if (statusResult.task.status === 'completed' || statusResult.task.status === 'cancelled') {
-                            clearInterval(pollInterval);
-                            this.isProcessing = false;
-                            this.currentTaskId = null;
-                            
-                            // 记录失败项
-                            if (statusResult.task.failed_ids && statusResult.task.failed_ids.length > 0) {
-                                this.lastFailedIds = statusResult.task.failed_ids;
-                                this.lastFailedType = 'images';
-                            }
-                            
-                            await this.loadImages();
-                            if (statusResult.task.status === 'completed') {
-                                if (statusResult.task.failed > 0) {
-                                    this.showNotification(`批量处理完成，${statusResult.task.failed} 项失败`, 'warning');
-                                } else {
-                                    this.showNotification('批量处理完成', 'success');
-                                }
-                            } else {
-                                this.showNotification('已取消批量处理', 'warning');
-                            }
+                // 订阅任务进度，逐张更新结果
+                this.watchTask(taskId, item => this.applyTaskItem(this.images, item)).then(async ({ task, synced }) => {
+                    this.isProcessing = false;
+                    this.currentTaskId = null;
+                    
+                    // 记录失败项
+                    if (task.failed_ids && task.failed_ids.length > 0) {
+                        this.lastFailedIds = task.failed_ids;
+                        this.lastFailedType = 'images';
+                    }
+                    
+                    // 推送中断时才重新加载整个列表
+                    if (!synced) await this.loadImages();
+                    if (task.status === 'completed') {
+                        if (task.failed > 0) {
+                            this.showNotification(`批量处理完成，${task.failed} 项失败`, 'warning');
+                        } else {
+                            this.showNotification('批量处理完成', 'success');
                         }
+                    } else {
+                        this.showNotification('已取消批量处理', 'warning');
                     }
-                }, 1000);
+                });
             } else {
                 this.isProcessing = false;
                 this.currentTaskId = null;
@@ -3027,43 +3132,124 @@ function taggerApp() {
                 this.currentTaskId = taskId;
                 this.showNotification(result.message, 'info');
                 
-                // 轮询任务状态
-                const pollInterval = setInterval(async () => {
-                    const statusResult = await this.apiCall(`tasks/${taskId}`);
-                    if (statusResult.success) {
-                        this.taskStatus = statusResult.task;
-                        this.progress = (statusResult.task.completed / statusResult.task.total) * 100;
-                        
-                        if (statusResult.task.status === 'completed' || statusResult.task.status === 'cancelled') {
-                            clearInterval(pollInterval);
-                            this.isProcessing = false;
-                            this.currentTaskId = null;
-                            
-                            // 记录失败项
-                            if (statusResult.task.failed_ids && statusResult.task.failed_ids.length > 0) {
-                                this.lastFailedIds = statusResult.task.failed_ids;
-                                this.lastFailedType = 'pairs';
-                            }
-                            
-                            await this.loadPairs();
-                            if (statusResult.task.status === 'completed') {
-                                if (statusResult.task.failed > 0) {
-                                    this.showNotification(`批量反推完成，${statusResult.task.failed} 项失败`, 'warning');
-                                } else {
-                                    this.showNotification('批量反推完成', 'success');
-                                }
-                            } else {
-                                this.showNotification('已取消批量反推', 'warning');
-                            }
+                // 订阅任务进度，逐组更新结果
+                this.watchTask(taskId, item => this.applyTaskItem(this.pairs, item)).then(async ({ task, synced }) => {
+                    this.isProcessing = false;
+                    this.currentTaskId = null;
+                    
+                    // 记录失败项
+                    if (task.failed_ids && task.failed_ids.length > 0) {
+                        this.lastFailedIds = task.failed_ids;
+                        this.lastFailedType = 'pairs';
+                    }
+                    
+                    // 推送中断时才重新加载整个列表
+                    if (!synced) await this.loadPairs();
+                    if (task.status === 'completed') {
+                        if (task.failed > 0) {
+                            this.showNotification(`批量反推完成，${task.failed} 项失败`, 'warning');
+                        } else {
+                            this.showNotification('批量反推完成', 'success');
                         }
+                    } else {
+                        this.showNotification('已取消批量反推', 'warning');
                     }
-                }, 1000);
+                });
             } else {
                 this.isProcessing = false;
                 this.currentTaskId = null;
             }
         },
 
+        // 订阅任务进度推送（SSE），progress 事件更新进度条，item 事件交给 onItem 逐条写回；
+        // 浏览器不支持或无法重连时回退为每秒按序号增量轮询。返回 { task, synced }，synced 为 false 时需要重新加载列表
+        // options.trackProgress 为 false 时不占用进度条（后台缩略图任务）；options.fromStart 为 true 时从第一条事件开始补发
+        watchTask(taskId, onItem, options = {}) {
+            const { trackProgress = true, fromStart = false } = options;
+            return new Promise(resolve => {
+                let synced = true;
+                let lastSeq = 0;
+                const isFinished = task => task.status === 'completed' || task.status === 'cancelled';
+                const applyProgress = task => {
+                    if (!trackProgress) return;
+                    this.taskStatus = Object.assign({}, this.taskStatus, task);
+                    this.progress = task.total ? (task.completed / task.total) * 100 : 0;
+                };
+                const finish = async task => {
+                    // 推送的进度不含失败ID列表，结束时取一次完整的任务状态
+                    const statusResult = await this.apiCall(`tasks/${taskId}`);
+                    resolve({ task: statusResult.success ? statusResult.task : task, synced });
+                };
+                const poll = () => {
+                    const pollInterval = setInterval(async () => {
+                        const statusResult = await this.apiCall(`tasks/${taskId}?since=${lastSeq}`);
+                        if (!statusResult.success) return;
+                        if (statusResult.truncated) synced = false;
+                        for (const event of statusResult.events) {
+                            if (event.event === 'item' && onItem) onItem(event.data);
+                        }
+                        lastSeq = statusResult.seq;
+                        applyProgress(statusResult.task);
+                        if (isFinished(statusResult.task)) {
+                            clearInterval(pollInterval);
+                            await finish(statusResult.task);
+                        }
+                    }, 1000);
+                };
+                
+                if (typeof EventSource === 'undefined') {
+                    poll();
+                    return;
+                }
+                const source = new EventSource(`/api/tasks/${taskId}/events${fromStart ? '?since=0' : ''}`);
+                source.addEventListener('progress', async event => {
+                    const task = JSON.parse(event.data);
+                    if (event.lastEventId) lastSeq = Number(event.lastEventId);
+                    applyProgress(task);
+                    if (isFinished(task)) {
+                        source.close();
+                        await finish(task);
+                    }
+                });
+                source.addEventListener('item', event => {
+                    if (event.lastEventId) lastSeq = Number(event.lastEventId);
+                    if (onItem) onItem(JSON.parse(event.data));
+                });
+                source.addEventListener('resync', () => {
+                    synced = false;
+                });
+                source.onerror = () => {
+                    // 连接中断时浏览器会带上 Last-Event-ID 自动重连，服务端补发遗漏的事件；无法重连时改为轮询
+                    if (source.readyState === EventSource.CLOSED) poll();
+                };
+            });
+        },
+
+        // 将推送的单个条目结果写回列表中的对应行
+        applyTaskItem(list, item) {
+            const target = list.find(entry => entry.id === item.id);
+            if (!target) return;
+            target.status = item.status;
+            if (item.text !== undefined) target.text = item.text;
+            if (item.error !== undefined) target.error_message = item.error;
+        },
+
+        // 导入后订阅后台缩略图任务，每生成一张就显示一张；kind 为 'images' 或 'pairs'
+        watchThumbnails(taskId, kind) {
+            if (!taskId || this.watchedThumbnailTasks.includes(taskId)) return;
+            this.watchedThumbnailTasks.push(taskId);
+            // 缩略图生成很快，从第一条事件开始补发，避免订阅前已完成的条目被遗漏
+            this.watchTask(taskId, item => {
+                if (!item.thumbnail) return;
+                const target = this[kind].find(entry => entry.id === item.id);
+                const info = target && item.side ? target[item.side] : target;
+                if (info) info.thumbnail = item.thumbnail;
+            }, { trackProgress: false, fromStart: true }).then(({ synced }) => {
+                this.watchedThumbnailTasks = this.watchedThumbnailTasks.filter(id => id !== taskId);
+                if (!synced) return kind === 'pairs' ? this.loadPairs() : this.loadImages();
+            });
+        },
+
         async cancelCurrentTask() {
             if (!this.currentTaskId) return;
             const result = await this.apiCall(`tasks/${this.currentTaskId}/cancel`, 'POST', {});
@@ -3103,43 +3289,37 @@ function taggerApp() {
                 this.lastFailedIds = [];
                 this.lastFailedType = '';
                 
-                // 轮询任务状态
-                const pollInterval = setInterval(async () => {
-                    const statusResult = await this.apiCall(`tasks/${taskId}`);
-                    if (statusResult.success) {
-                        this.taskStatus = statusResult.task;
-                        this.progress = (statusResult.task.completed / statusResult.task.total) * 100;
-                        
-                        if (statusResult.task.status === 'completed' || statusResult.task.status === 'cancelled') {
-                            clearInterval(pollInterval);
-                            this.isProcessing = false;
-                            this.currentTaskId = null;
-                            
-                            // 记录新的失败项
-                            if (statusResult.task.failed_ids && statusResult.task.failed_ids.length > 0) {
-                                this.lastFailedIds = statusResult.task.failed_ids;
-                                this.lastFailedType = retryType;
-                            }
-                            
-                            // 刷新列表
-                            if (retryType === 'images') {
-                                await this.loadImages();
-                            } else {
-                                await this.loadPairs();
-                            }
-                            
-                            if (statusResult.task.status === 'completed') {
-                                if (statusResult.task.failed > 0) {
-                                    this.showNotification(`重试完成，仍有 ${statusResult.task.failed} 项失败`, 'warning');
-                                } else {
-                                    this.showNotification('重试全部成功', 'success');
-                                }
-                            } else {
-                                this.showNotification('已取消重试', 'warning');
-                            }
+                // 订阅任务进度，逐项更新结果
+                const list = retryType === 'images' ? this.images : this.pairs;
+                this.watchTask(taskId, item => this.applyTaskItem(list, item)).then(async ({ task, synced }) => {
+                    this.isProcessing = false;
+                    this.currentTaskId = null;
+                    
+                    // 记录新的失败项
+                    if (task.failed_ids && task.failed_ids.length > 0) {
+                        this.lastFailedIds = task.failed_ids;
+                        this.lastFailedType = retryType;
+                    }
+                    
+                    // 推送中断时才重新加载整个列表
+                    if (!synced) {
+                        if (retryType === 'images') {
+                            await this.loadImages();
+                        } else {
+                            await this.loadPairs();
                         }
                     }
-                }, 1000);
+                    
+                    if (task.status === 'completed') {
+                        if (task.failed > 0) {
+                            this.showNotification(`重试完成，仍有 ${task.failed} 项失败`, 'warning');
+                        } else {
+                            this.showNotification('重试全部成功', 'success');
+                        }
+                    } else {
+                        this.showNotification('已取消重试', 'warning');
+                    }
+                });
             } else {
                 this.isProcessing = false;
                 this.currentTaskId = null;
@@ -3248,39 +3428,56 @@ function taggerApp() {
                 return;
             }
             
-            this.isTranslating = true;
-            let successCount = 0;
-            let failCount = 0;
+            const targets = this.selectedIds
+                .map(imageId => this.images.find(img => img.id === imageId))
+                .filter(image => image && image.text);
+            await this.translateItemsToChinese(targets);
+        },
+
+        // 批量翻译为中文：后端按 token 预算打包请求并复用翻译记忆，结果写入 chineseText 属性
+        async translateItemsToChinese(targets) {
+            if (targets.length === 0) return;
             
+            this.isTranslating = true;
             try {
-                for (const imageId of this.selectedIds) {
-                    const image = this.images.find(img => img.id === imageId);
-                    if (!image || !image.text) continue;
-                    
-                    try {
-                        const result = await this.apiCall('translate', 'POST', {
-                            text: image.text,
-                            target_lang: 'zh'  // 明确指定翻译为中文
-                        });
-                        
-                        if (result.success) {
-                            // 将翻译结果存储到图片对象的 chineseText 属性
-                            image.chineseText = result.translated;
-                            successCount++;
-                        } else {
-                            failCount++;
-                        }
-                    } catch (e) {
-                        failCount++;
+                const result = await this.apiCall('translate/batch', 'POST', {
+                    items: targets.map(item => ({ id: item.id, text: item.text })),
+                    target_lang: 'zh',  // 明确指定翻译为中文
+                    model_id: this.translateModelId,
+                    provider: this.translateProvider
+                });
+                if (!result.success) {
+                    this.showNotification('翻译失败: ' + (result.message || '未知错误'), 'error');
+                    return;
+                }
+                
+                // 订阅任务进度，译文逐条写回；命中翻译记忆的条目没有推送，结束后一次性取回全部译文
+                const byId = new Map(targets.map(item => [item.id, item]));
+                const { task } = await this.watchTask(result.task_id, item => {
+                    const target = byId.get(item.id);
+                    if (target && item.status === 'success') target.chineseText = item.text;
+                });
+                
+                const batchResult = await this.apiCall(`translate/batch/${result.task_id}`);
+                const translations = batchResult.success ? batchResult.results : {};
+                let successCount = 0;
+                for (const item of targets) {
+                    if (translations[item.id] !== undefined) {
+                        item.chineseText = translations[item.id];
+                        successCount++;
                     }
                 }
+                const failCount = targets.length - successCount;
                 
                 if (successCount > 0) {
-                    this.showNotification(`已翻译 ${successCount} 个标签`, 'success');
+                    const cached = task && task.cached ? `（${task.cached} 个来自翻译记忆）` : '';
+                    this.showNotification(`已翻译 ${successCount} 个标签${cached}`, 'success');
                 }
                 if (failCount > 0) {
                     this.showNotification(`${failCount} 个标签翻译失败`, 'warning');
                 }
+            } catch (e) {
+                this.showNotification('翻译失败: ' + e.message, 'error');
             } finally {
                 this.isTranslating = false;
             }
@@ -3338,42 +3535,10 @@ function taggerApp() {
                 return;
             }
             
-            this.isTranslating = true;
-            let successCount = 0;
-            let failCount = 0;
-            
-            try {
-                for (const pairId of this.selectedPairIds) {
-                    const pair = this.pairs.find(p => p.id === pairId);
-                    if (!pair || !pair.text) continue;
-                    
-                    try {
-                        const result = await this.apiCall('translate', 'POST', {
-                            text: pair.text,
-                            target_lang: 'zh'  // 明确指定翻译为中文
-                        });
-                        
-                        if (result.success) {
-                            // 将翻译结果存储到图片对象的 chineseText 属性
-                            pair.chineseText = result.translated;
-                            successCount++;
-                        } else {
-                            failCount++;
-                        }
-                    } catch (e) {
-                        failCount++;
-                    }
-                }
-                
-                if (successCount > 0) {
-                    this.showNotification(`已翻译 ${successCount} 个标签`, 'success');
-                }
-                if (failCount > 0) {
-                    this.showNotification(`${failCount} 个标签翻译失败`, 'warning');
-                }
-            } finally {
-                this.isTranslating = false;
-            }
+            const targets = this.selectedPairIds
+                .map(pairId => this.pairs.find(p => p.id === pairId))
+                .filter(pair => pair && pair.text);
+            await this.translateItemsToChinese(targets);
         },
 
         // 将单个图片对的中文翻译同步回英文标签
@@ -4406,7 +4571,8 @@ function taggerApp() {
                 ids: this.selectedIds,
                 format: this.imageExportFormat,
                 output_type: this.imageExportOutputType,
-                output_path: this.imageExportPath.trim()
+                output_path: this.imageExportPath.trim(),
+                skip_duplicates: this.imageExportSkipDuplicates
             });
             
             if (result.success) {
@@ -5541,36 +5707,66 @@ function taggerApp() {
                     return;
                 }
                 
-                // 调用后端 API
-                const result = await this.apiCall('chat/message', 'POST', {
+                // 调用后端 API（流式接收，收到首个片段后即显示 AI 回复）
+                const history = this.chatMessages.slice(0, -1).map(msg => ({
+                    role: msg.role,
+                    content: msg.content
+                }));
+                let replyIndex = -1;
+                const result = await this.streamCall('chat/message', {
                     message: message,
                     model: this.chatModel,
-                    history: this.chatMessages.slice(0, -1).map(msg => ({
-                        role: msg.role,
-                        content: msg.content
-                    }))
+                    history: history
+                }, (delta) => {
+                    if (replyIndex === -1) {
+                        this.isChatStreaming = true;
+                        this.chatMessages.push({
+                            role: 'assistant',
+                            content: '',
+                            time: new Date().toLocaleTimeString('zh-CN', { hour: '2-digit', minute: '2-digit' })
+                        });
+                        replyIndex = this.chatMessages.length - 1;
+                    }
+                    this.chatMessages[replyIndex].content += delta;
+                    this.$nextTick(() => {
+                        const chatContainer = this.$refs.chatMessages;
+                        if (chatContainer) {
+                            chatContainer.scrollTop = chatContainer.scrollHeight;
+                        }
+                    });
                 });
                 
                 if (result.success) {
-                    // 添加 AI 回复
-                    this.chatMessages.push({
-                        role: 'assistant',
-                        content: result.reply,
-                        time: new Date().toLocaleTimeString('zh-CN', { hour: '2-digit', minute: '2-digit' })
-                    });
+                    if (replyIndex === -1) {
+                        // 添加 AI 回复
+                        this.chatMessages.push({
+                            role: 'assistant',
+                            content: result.reply,
+                            time: new Date().toLocaleTimeString('zh-CN', { hour: '2-digit', minute: '2-digit' })
+                        });
+                    } else {
+                        this.chatMessages[replyIndex].content = result.reply;
+                    }
                     
                     // 更新当前会话
                     this.updateCurrentSession();
                 } else {
                     this.showNotification(result.message || '发送失败', 'error');
+                    if (replyIndex !== -1) {
+                        this.chatMessages.pop();
+                    }
                     this.chatMessages.pop();
                 }
             } catch (error) {
                 console.error('Chat error:', error);
                 this.showNotification('发送失败: ' + error.message, 'error');
+                if (this.isChatStreaming) {
+                    this.chatMessages.pop();
+                }
                 this.chatMessages.pop();
             } finally {
                 this.isChatLoading = false;
+                this.isChatStreaming = false;
                 
                 // 滚动到底部
                 this.$nextTick(() => {